@@ -0,0 +1,277 @@
+"""This module contains a streaming aggregation stage, computing per-device window
+statistics (min, max and mean) of the readings, so that only aggregates, or raw
+readings and aggregates, are sent upstream.
+"""
+
+import fnmatch
+import logging
+import threading
+import time
+from array import array
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# what is sent upstream for the devices of a group.
+RAW = "raw"
+AGGREGATES = "aggregates"
+BOTH = "both"
+
+FIELDS = ("temperature", "humidity", "pressure", "battery")
+
+aggregates_emitted = REGISTRY.counter(
+    "ptm_aggregation_windows_total", "Number of window aggregates emitted")
+
+_INF = float("inf")
+# the sequence number of a device without readings yet, or without sequence numbers.
+_NO_SEQUENCE = -1
+
+
+class AggregationGroup:
+    """The aggregation settings of the devices whose id matches one of the patterns.
+
+    Windows are aligned on multiples of hop seconds since the epoch. With a hop equal
+    to the window the windows are tumbling, otherwise they are sliding: every hop
+    seconds, the statistics of the last window seconds are emitted.
+    """
+
+    def __init__(self, devices=("*",), window: int = 60, hop: int = None,
+                 emit: str = AGGREGATES, fields=FIELDS):
+        """
+        :param devices: The device id patterns (fnmatch syntax) of the group.
+        :param int window: The window duration, in seconds.
+        :param int hop: The time (in seconds) between two windows, a divisor of window.
+            Defaults to window (tumbling windows).
+        :param str emit: What is sent upstream: raw, aggregates or both.
+        :param fields: The reading fields aggregated.
+        """
+        hop = hop or window
+        if window <= 0 or hop <= 0 or window % hop:
+            raise ValueError(f"invalid aggregation window {window}s, hop {hop}s")
+        if emit not in (RAW, AGGREGATES, BOTH):
+            raise ValueError(f"unknown aggregation emit mode: {emit}")
+        self.devices = list(devices)
+        self.window = window
+        self.hop = hop
+        self.panes = window // hop
+        self.emit = emit
+        self.fields = tuple(fields)
+
+    @classmethod
+    def from_dict(cls, config: dict):
+        """Creates a group from its JSON configuration, such as
+        {"devices": ["cold-room-*"], "window": 60, "hop": 10, "emit": "both"}.
+        """
+        return cls(config.get("devices", ["*"]), int(config.get("window", 60)),
+                   int(config["hop"]) if "hop" in config else None,
+                   config.get("emit", AGGREGATES), config.get("fields", FIELDS))
+
+    def matches(self, device_id: str) -> bool:
+        return any(fnmatch.fnmatchcase(device_id, pattern) for pattern in self.devices)
+
+
+class _WindowTable:
+    """The statistics of the panes (hop-long parts of a window) of the devices of a
+    group, in flat arrays: every device gets a fixed slot of ``panes`` panes, and every
+    pane the count, min, max and sum of each field. Adding a reading is O(1) and the
+    memory per device is fixed. A measurement advertised several times in a row (same
+    measurement sequence number) is only counted once.
+    """
+
+    def __init__(self, group: AggregationGroup, now: float):
+        self.group = group
+        self._slots = {}
+        self._devices = []
+        self._sequences = array("q")
+        self._epochs = array("q")
+        self._counts = array("l")
+        self._field_counts = array("l")
+        self._mins = array("d")
+        self._maxs = array("d")
+        self._sums = array("d")
+        # the last window end emitted, as a number of hops since the epoch.
+        self.emitted = int(now // group.hop)
+
+    def add(self, device_id, reading, now):
+        group = self.group
+        slot = self._slots.get(device_id)
+        if slot is None:
+            slot = self._allocate(device_id)
+        sequence = reading.get("measurement_sequence_number")
+        if sequence is not None:
+            if sequence == self._sequences[slot]:
+                return
+            self._sequences[slot] = sequence
+        epoch = int(now // group.hop)
+        pane = slot * group.panes + epoch % group.panes
+        width = len(group.fields)
+        base = pane * width
+
+        if self._epochs[pane] != epoch:
+            self._epochs[pane] = epoch
+            self._counts[pane] = 0
+            for i in range(base, base + width):
+                self._field_counts[i] = 0
+                self._mins[i] = _INF
+                self._maxs[i] = -_INF
+                self._sums[i] = 0.0
+
+        self._counts[pane] += 1
+        for i, field in enumerate(group.fields, base):
+            value = reading.get(field)
+            if value is None:
+                continue
+            self._field_counts[i] += 1
+            self._sums[i] += value
+            if value < self._mins[i]:
+                self._mins[i] = value
+            if value > self._maxs[i]:
+                self._maxs[i] = value
+
+    def next_emit(self) -> float:
+        return (self.emitted + 1) * self.group.hop
+
+    def emit(self, now):
+        """Returns (device id, aggregate) for the windows ended since the last call.
+        """
+        group = self.group
+        end = int(now // group.hop)
+        aggregates = []
+        # older windows have no pane left.
+        for window_end in range(max(self.emitted + 1, end - group.panes + 1), end + 1):
+            for slot, device_id in enumerate(self._devices):
+                aggregate = self._aggregate(slot, window_end)
+                if aggregate is not None:
+                    aggregates.append((device_id, aggregate))
+        self.emitted = max(self.emitted, end)
+        return aggregates
+
+    def _aggregate(self, slot, window_end):
+        group = self.group
+        width = len(group.fields)
+        count = 0
+        field_counts = [0] * width
+        mins = [_INF] * width
+        maxs = [-_INF] * width
+        sums = [0.0] * width
+        for pane in range(slot * group.panes, (slot + 1) * group.panes):
+            if not window_end - group.panes <= self._epochs[pane] < window_end:
+                continue
+            count += self._counts[pane]
+            for f in range(width):
+                i = pane * width + f
+                field_counts[f] += self._field_counts[i]
+                sums[f] += self._sums[i]
+                mins[f] = min(mins[f], self._mins[i])
+                maxs[f] = max(maxs[f], self._maxs[i])
+        if not count:
+            return None
+
+        aggregate = {"window_start": (window_end - group.panes) * group.hop,
+                     "window_end": window_end * group.hop,
+                     "count": count}
+        for f, field in enumerate(group.fields):
+            if field_counts[f]:
+                aggregate[field] = {"min": mins[f], "max": maxs[f],
+                                    "mean": sums[f] / field_counts[f]}
+        return aggregate
+
+    def _allocate(self, device_id):
+        group = self.group
+        slot = len(self._devices)
+        self._slots[device_id] = slot
+        self._devices.append(device_id)
+        self._sequences.append(_NO_SEQUENCE)
+        panes, values = group.panes, group.panes * len(group.fields)
+        self._epochs.extend([-1] * panes)
+        self._counts.extend([0] * panes)
+        self._field_counts.extend([0] * values)
+        self._mins.extend([_INF] * values)
+        self._maxs.extend([-_INF] * values)
+        self._sums.extend([0.0] * values)
+        return slot
+
+
+class WindowAggregator:
+    """Aggregates the readings of the devices of the configured groups, and calls
+    sink(device_id, aggregate) with the statistics of every ended window. The first
+    group matching a device id applies. Devices matching no group are not aggregated.
+
+    An aggregate is a dict such as::
+
+        {"window_start": 1600000020, "window_end": 1600000080, "count": 58,
+         "temperature": {"min": 21.2, "max": 21.9, "mean": 21.51}, ...}
+
+    with the window bounds in seconds since the epoch.
+    """
+
+    def __init__(self, groups, sink, clock=time.time):
+        """
+        :param groups: The AggregationGroups, in order of precedence.
+        :param sink: The function called with every aggregate.
+        :param clock: The wall clock the windows are aligned on.
+        """
+        self._clock = clock
+        self._sink = sink
+        now = clock()
+        self._tables = [_WindowTable(group, now) for group in groups]
+        # table of every device seen, None if it is not aggregated.
+        self._device_tables = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, device_id: str, reading: dict) -> bool:
+        """Adds a reading to the current windows of its device. Returns True if the
+        raw reading should be sent upstream as well.
+        """
+        table = self._device_tables.get(device_id, False)
+        if table is False:
+            table = self._device_tables[device_id] = next(
+                (table for table in self._tables if table.group.matches(device_id)), None)
+        if table is None:
+            return True
+        if table.group.emit != RAW:
+            now = self._clock()
+            if now >= table.next_emit():
+                # emit the ended windows before their panes are reused.
+                self.emit_due()
+            with self._lock:
+                table.add(device_id, reading, now)
+        return table.group.emit != AGGREGATES
+
+    def time_to_emit(self) -> float:
+        """Returns the time (in seconds) until the next window ends.
+        """
+        if not self._tables:
+            return _INF
+        return max(0, min(table.next_emit() for table in self._tables) - self._clock())
+
+    def emit_due(self):
+        """Sends the aggregates of the windows which ended.
+        """
+        now = self._clock()
+        with self._lock:
+            aggregates = [aggregate for table in self._tables for aggregate in table.emit(now)]
+        for device_id, aggregate in aggregates:
+            self._sink(device_id, aggregate)
+        aggregates_emitted.inc(len(aggregates))
+
+    def start(self):
+        """Starts emitting the aggregates from a background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name="aggregator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.time_to_emit()):
+            try:
+                self.emit_due()
+            except Exception:
+                logger.exception("failed to emit the window aggregates.")
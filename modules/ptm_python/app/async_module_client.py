@@ -0,0 +1,294 @@
+"""This module contains an asyncio version of ModuleClient. The paho.mqtt.client
+socket is driven by the event loop instead of a network thread, and the workload
+API is called with non-blocking connections.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import paho.mqtt.client as mqtt
+import edge.sastoken as auth
+import edge.async_edge_hsm as async_edge_hsm
+import reconnect
+from module_client import _form_sas_uri, puback_latency, unacknowledged
+from token_renewal import token_refreshes
+
+logger = logging.getLogger(__name__)
+
+# delay before retrying a failed token renewal.
+_RENEWAL_RETRY_DELAY = 1
+
+
+class AsyncModuleClient:
+    """Same surface as module_client.ModuleClient, with coroutines for the operations
+    doing network I/O. Must be created and used from a running event loop.
+    """
+
+    def __init__(self, hostname: str, device_id: str,
+                 module_id: str, module_generation_id: str,
+                 workload_uri: str, api_version: str, sastoken_ttl: int,
+                 renewal_ratio: float = 0.8, max_inflight: int = 20):
+        self._username = f"{hostname}/{device_id}/{module_id}/?api-version={api_version}"
+        self.client_id = f"{device_id}/{module_id}"
+        self.renewal_ratio = renewal_ratio
+
+        self._hsm = async_edge_hsm.AsyncIoTEdgeHsm(
+            module_id=module_id,
+            generation_id=module_generation_id,
+            workload_uri=workload_uri,
+            api_version=api_version,
+        )
+        uri = _form_sas_uri(hostname=hostname,
+                            device_id=device_id, module_id=module_id)
+        self._token = auth.AsyncRenewableSasToken(uri, self._hsm, ttl=sastoken_ttl)
+
+        self._loop = asyncio.get_event_loop()
+        self._inflight = asyncio.Semaphore(max_inflight)
+        # (future, publish time) of the unacknowledged messages, by mid.
+        self._pending = {}
+        self._on_connect = None
+        self._tasks = []
+        self._misc = None
+        self._closing = False
+        self._ssl_context = None
+        self._backoff = reconnect.Backoff()
+        self._connection_timer = reconnect.ConnectionTimer(self.client_id)
+
+        # the session is persistent, so the broker keeps the subscriptions and the
+        # QoS 1 messages in flight across reconnects.
+        self._mqtt_client = mqtt.Client(client_id=self.client_id, clean_session=False)
+        self._mqtt_client.on_connect = self._handle_connect
+        self._mqtt_client.on_publish = self._handle_publish
+        self._mqtt_client.on_disconnect = self._handle_disconnect
+        self._mqtt_client.on_socket_open = self._socket_open
+        self._mqtt_client.on_socket_close = self._socket_close
+        self._mqtt_client.on_socket_register_write = self._socket_register_write
+        self._mqtt_client.on_socket_unregister_write = self._socket_unregister_write
+        unacknowledged.add_function(
+            lambda: {(("client", self.client_id),): len(self._pending)})
+
+    async def initialize(self):
+        """Signs the SAS token and fetches the trust bundle, concurrently.
+        """
+        _, server_verification_cert = await asyncio.gather(
+            self._token.refresh(), self._hsm.get_certificate())
+
+        # kept for all the connections, so they resume the TLS session.
+        self._ssl_context = reconnect.create_ssl_context(server_verification_cert)
+        self._mqtt_client.username_pw_set(self._username, str(self._token))
+        self._mqtt_client.tls_set_context(self._ssl_context)
+
+    async def refresh(self):
+        """Renews the SAS token and sets it as the password used by the next (re)connect.
+        """
+        await self._token.refresh()
+        self._mqtt_client.username_pw_set(self._username, str(self._token))
+
+    async def connect(self, host: str, port: int = 1883, keepalive: int = 60):
+        """Connect to a remote broker. The TCP connection and TLS handshake run on an
+        executor thread, so the event loop is never blocked. Failed attempts are retried
+        with a jittered exponential backoff, as when reconnecting, so the module may
+        start before the edgeHub.
+        """
+        self._mqtt_client.connect_async(host, port, keepalive)
+        try:
+            await self._loop.run_in_executor(None, self._mqtt_client.reconnect)
+        except OSError as e:
+            logger.warning(f"Connect failed ({e}), retrying.")
+            await self._reconnect()
+        if not self._tasks:
+            self._tasks.append(self._loop.create_task(self._renew_token()))
+
+    async def disconnect(self):
+        """Disconnect from the broker and stop renewing the SAS token.
+        """
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._mqtt_client.disconnect()
+        await self._hsm.close()
+
+    async def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """Publish a message on a topic. Waits while max_inflight messages are waiting for
+        an acknowledgement, then returns a future completed when the message is sent (for
+        QoS 1, when the PUBACK is received).
+        """
+        await self._inflight.acquire()
+        start = time.monotonic()
+        try:
+            info = self._mqtt_client.publish(topic, payload, qos, retain)
+        except Exception:
+            # an invalid topic or payload, the message never takes its in-flight slot.
+            self._inflight.release()
+            raise
+        future = self._loop.create_future()
+        future.add_done_callback(lambda _: self._inflight.release())
+        if info.is_published():
+            future.set_result(info.mid)
+        else:
+            self._pending[info.mid] = (future, start)
+        return future
+
+    def subscribe(self, topic: str, qos: int = 0):
+        """Subscribe to a topic. The SUBSCRIBE packet is written by the event loop.
+        """
+        return self._mqtt_client.subscribe(topic, qos)
+
+    def message_callback_add(self, sub: str, callback):
+        """Register a callback, called with this client on the event loop, for the
+        messages received on the topics matching sub.
+        """
+        self._mqtt_client.message_callback_add(
+            sub, lambda client, userdata, message: callback(self, userdata, message))
+
+    @property
+    def on_connect(self):
+        """If implemented, called when the broker responds to our connection request."""
+        return self._on_connect
+
+    @on_connect.setter
+    def on_connect(self, func):
+        """Define the connect callback implementation, called with this client. If it
+        returns an awaitable, it is scheduled on the event loop.
+        """
+        self._on_connect = func
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._ssl_context.save_session(client.socket())
+            self._backoff.reset()
+            elapsed = self._connection_timer.connected()
+            if elapsed is not None:
+                logger.info(f"{self.client_id} reconnected after {elapsed:.3f}s.")
+        if self._on_connect is None:
+            return
+        result = self._on_connect(self, userdata, flags, rc)
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            self._loop.create_task(_log_failure(result))
+
+    def _handle_publish(self, client, userdata, mid):
+        pending = self._pending.pop(mid, None)
+        if pending is None:
+            return
+        future, start = pending
+        puback_latency.observe(time.monotonic() - start)
+        if not future.done():
+            future.set_result(mid)
+
+    def _handle_disconnect(self, client, userdata, rc):
+        if rc != 0 and not self._closing:
+            logger.warning(f"Upstream client disconnected with result code {rc}.")
+            self._connection_timer.disconnected()
+            self._loop.call_soon_threadsafe(
+                lambda: self._tasks.append(self._loop.create_task(self._reconnect())))
+
+    async def _reconnect(self):
+        delay = self._backoff.next()
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                await self._loop.run_in_executor(None, self._mqtt_client.reconnect)
+                return
+            except OSError as e:
+                delay = self._backoff.next()
+                logger.warning(f"Reconnect failed ({e}), retrying in {delay:.1f}s.")
+                # the edgeHub certificate authority may have been rotated.
+                await self._reload_trust_bundle()
+
+    async def _reload_trust_bundle(self):
+        """Trusts the certificate of the current trust bundle for the next connections.
+        """
+        try:
+            certificate = await self._hsm.get_certificate()
+        except OSError:
+            logger.exception(f"{self.client_id} failed to get the trust bundle.")
+            return
+        if self._ssl_context.trust(certificate):
+            logger.info(f"{self.client_id} trusts the new trust bundle certificate.")
+
+    async def _renew_token(self):
+        while True:
+            renew_at = self._token.expiry_time - self._token.ttl * (1 - self.renewal_ratio)
+            await asyncio.sleep(max(0, renew_at - time.time()))
+            logger.info(f"renewing {self.client_id} token.")
+            try:
+                await self.refresh()
+                token_refreshes.inc(result="success")
+            except ValueError:
+                token_refreshes.inc(result="failure")
+                logger.exception(f"failed to renew {self.client_id} token.")
+                await asyncio.sleep(_RENEWAL_RETRY_DELAY)
+
+    # paho socket callbacks. They may be called from the executor thread running
+    # reconnect(), so the event loop is only ever touched through call_soon_threadsafe.
+    # The file descriptor is read right away, as paho closes the socket after the
+    # close callback returns.
+
+    def _socket_open(self, client, userdata, sock):
+        fd = sock.fileno()
+
+        def register():
+            self._loop.add_reader(fd, self._read, sock)
+            self._misc = self._loop.create_task(self._misc_loop())
+        self._loop.call_soon_threadsafe(register)
+
+    def _socket_close(self, client, userdata, sock):
+        fd = sock.fileno()
+
+        def unregister():
+            self._loop.remove_reader(fd)
+            self._loop.remove_writer(fd)
+            if self._misc is not None:
+                self._misc.cancel()
+                self._misc = None
+        self._loop.call_soon_threadsafe(unregister)
+
+    def _socket_register_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(
+            self._loop.add_writer, sock.fileno(), self._mqtt_client.loop_write)
+
+    def _socket_unregister_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_writer, sock.fileno())
+
+    def _read(self, sock):
+        self._mqtt_client.loop_read()
+        # TLS may have decrypted data buffered which select() does not report.
+        if self._mqtt_client.socket() is sock and hasattr(sock, "pending") \
+                and sock.pending():
+            self._loop.call_soon(self._read, sock)
+
+    async def _misc_loop(self):
+        while self._mqtt_client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+async def _log_failure(awaitable):
+    try:
+        await awaitable
+    except Exception:
+        logger.exception("Upstream connect callback failed.")
+
+
+async def create_from_environment(sastoken_ttl: int = 3600, renewal_ratio: float = 0.8,
+                                  max_inflight: int = 20) -> AsyncModuleClient:
+    """Creates an AsyncModuleClient from edge module environment, with its SAS token
+    and TLS context ready.
+
+    :param int sastoken_ttl: The time to live (in seconds) for the created SasToken used for
+        authentication. Default is 3600 seconds (1 hour)
+    :param float renewal_ratio: The fraction of sastoken_ttl after which the token is
+        renewed. Default is 0.8
+    :param int max_inflight: The maximum number of unacknowledged messages. Default is 20
+    """
+    client = AsyncModuleClient(os.environ["IOTEDGE_IOTHUBHOSTNAME"],
+                               os.environ["IOTEDGE_DEVICEID"],
+                               os.environ["IOTEDGE_MODULEID"],
+                               os.environ["IOTEDGE_MODULEGENERATIONID"],
+                               os.environ["IOTEDGE_WORKLOADURI"],
+                               os.environ["IOTEDGE_APIVERSION"],
+                               sastoken_ttl, renewal_ratio, max_inflight)
+    await client.initialize()
+    return client
@@ -0,0 +1,339 @@
+"""This module contains the handling of the messages sent to the translated devices:
+direct method calls, cloud-to-device messages and device twin desired properties.
+Received messages are routed through a prefix trie of topic filters and handled on a
+pool of worker threads, off the MQTT network threads.
+"""
+
+import itertools
+import json
+import logging
+import threading
+import urllib.parse
+
+import pipeline
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+commands_handled = REGISTRY.counter(
+    "ptm_device_commands_total", "Number of messages handled for the devices by kind and result")
+
+# the number of topic filters subscribed to in one SUBSCRIBE packet.
+_SUBSCRIBE_BATCH = 64
+
+
+class TopicTrie:
+    """MQTT topic filters, with their + and # wildcards, in a prefix trie of their
+    levels: matching a topic costs one lookup per level (and per matching wildcard)
+    whatever the number of filters.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, topic_filter: str, value):
+        """Sets the value of a topic filter.
+        """
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.value = value
+
+    def remove(self, topic_filter: str):
+        """Removes a topic filter, if present.
+        """
+        path = [self._root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].value = None
+        # prune the nodes left without value nor children.
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path)):
+            if node.value is not None or node.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> list:
+        """Returns the values of the filters matching a topic.
+        """
+        values = []
+        nodes = [self._root]
+        for index, level in enumerate(topic.split("/")):
+            matched = []
+            for node in nodes:
+                # wildcards do not match the first level of the $-topics.
+                if index > 0 or not level.startswith("$"):
+                    rest = node.children.get("#")
+                    if rest is not None and rest.value is not None:
+                        values.append(rest.value)
+                    single = node.children.get("+")
+                    if single is not None:
+                        matched.append(single)
+                child = node.children.get(level)
+                if child is not None:
+                    matched.append(child)
+            if not matched:
+                return values
+            nodes = matched
+
+        for node in nodes:
+            if node.value is not None:
+                values.append(node.value)
+            # "a/#" also matches "a".
+            rest = node.children.get("#")
+            if rest is not None and rest.value is not None:
+                values.append(rest.value)
+        return values
+
+
+class _Node:
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+
+class MessageRouter:
+    """Calls handler(client, message) for the received messages matching the topic
+    filter of the handler, on a pipeline.Stage of worker threads. The messages of a
+    device ("$iothub/{device_id}/...") are always handled by the same worker, in order.
+    """
+
+    def __init__(self, workers: int = 2, capacity: int = 1000):
+        """
+        :param int workers: The number of worker threads.
+        :param int capacity: The maximum number of messages waiting for a worker. The
+            oldest ones are dropped when it is reached.
+        """
+        self._routes = TopicTrie()
+        self._stage = pipeline.Stage("commands", self._handle, capacity,
+                                     pipeline.DROP_OLDEST, workers,
+                                     key=lambda item: _device_id_from_topic(item[1].topic))
+
+    def route(self, topic_filter: str, handler):
+        """Routes the messages matching a topic filter to a handler.
+        """
+        self._routes.add(topic_filter, handler)
+
+    def attach(self, client):
+        """Receives the messages of a client, or of the clients of a ConnectionPool.
+        """
+        client.on_message = self.receive
+
+    def receive(self, client, userdata, message):
+        """The message callback of the attached clients. Runs on their network thread.
+        """
+        self._stage.submit((client, message))
+
+    def start(self):
+        self._stage.start()
+
+    def stop(self):
+        self._stage.stop()
+
+    def _handle(self, item):
+        client, message = item
+        handlers = self._routes.match(message.topic)
+        if not handlers:
+            logger.debug(f"no handler for a message received on {message.topic}.")
+        for handler in handlers:
+            handler(client, message)
+
+
+class DeviceCommands:
+    """Subscribes to the messages of the translated devices, and dispatches them:
+
+    - direct method calls, ``$iothub/{device_id}/methods/post/{name}/?$rid={id}``, to
+      the handler registered for the method, whose (status, payload) result is sent
+      back as the method response;
+    - cloud-to-device messages, ``$iothub/{device_id}/messages/c2d/post/...``, whose
+      JSON body is ``{"method": name, "payload": {...}}``, to the same handlers,
+      without response;
+    - device twin desired properties, requested when a client connects and then
+      received as patches, to the handler registered for each property.
+
+    Every device is subscribed to on the connection of the pool it is pinned to, when
+    it connects and whenever the device registry changes. The subscriptions, twin
+    requests and method responses are sent on the connections themselves, never
+    through a store.StoreAndForward, so they neither wait behind the stored telemetry
+    nor depend on its drain rate.
+    """
+
+    def __init__(self, pool, registry, router: MessageRouter):
+        """
+        :param pool: The ConnectionPool of the upstream ModuleClients, not wrapped in
+            StoreAndForward.
+        :param registry: The DeviceRegistry of the translated devices.
+        :param MessageRouter router: The router the messages are received with.
+        """
+        self._pool = pool
+        self._registry = registry
+        self._methods = {}
+        self._properties = {}
+        self._versions = {}
+        self._request_ids = itertools.count(1)
+        # the subscribed devices, updated from the network and registry threads.
+        self._subscribed = set()
+        self._lock = threading.Lock()
+
+        router.route("$iothub/+/methods/post/#", self._handle_method)
+        router.route("$iothub/+/messages/c2d/post/#", self._handle_c2d)
+        router.route("$iothub/+/twin/res/#", self._handle_twin)
+        router.route("$iothub/+/twin/desired/#", self._handle_patch)
+        router.attach(pool)
+        registry.add_listener(self._update_subscriptions)
+
+    def method(self, name: str, handler):
+        """Registers the handler of a method, called with (device_id, payload) and
+        returning (status, response payload).
+        """
+        self._methods[name] = handler
+
+    def desired_property(self, name: str, handler):
+        """Registers the handler of a desired property, called with (device_id, value),
+        where a None value means the property was removed.
+        """
+        self._properties[name] = handler
+
+    def on_connect(self, client):
+        """To be called when a client connected. Subscribes to the messages of the
+        devices pinned to it and requests their twins.
+
+        :param client: The client which connected, or the StoreAndForward wrapping it.
+        """
+        client = self._connection(client)
+        with self._lock:
+            device_ids = [device_id for device_id in self._registry.device_ids()
+                          if self._pool.client_for(device_id).client_id == client.client_id]
+            self._subscribed.update(device_ids)
+        self._subscribe(client, device_ids)
+        for device_id in device_ids:
+            client.publish(f"$iothub/{device_id}/twin/get/?$rid={next(self._request_ids)}",
+                           qos=0)
+
+    def _connection(self, client):
+        """Returns the ModuleClient of the pool with the client id of a client.
+        """
+        for connection in self._pool.clients:
+            if connection.client_id == client.client_id:
+                return connection
+        return client
+
+    def _update_subscriptions(self):
+        with self._lock:
+            device_ids = self._registry.device_ids()
+            added = device_ids - self._subscribed
+            removed = self._subscribed - device_ids
+            self._subscribed = device_ids
+        for device_id in removed:
+            self._versions.pop(device_id, None)
+        for client in self._pool.clients:
+            self._subscribe(client, [device_id for device_id in added
+                                     if self._pool.client_for(device_id) is client])
+            topics = [topic for device_id in removed
+                      if self._pool.client_for(device_id) is client
+                      for topic in _device_topics(device_id)]
+            if topics:
+                client.unsubscribe(topics)
+
+    @staticmethod
+    def _subscribe(client, device_ids):
+        topics = [(topic, 0) for device_id in device_ids for topic in _device_topics(device_id)]
+        for start in range(0, len(topics), _SUBSCRIBE_BATCH):
+            client.subscribe(topics[start:start + _SUBSCRIBE_BATCH])
+
+    def _handle_method(self, client, message):
+        # topic: $iothub/{device_id}/methods/post/{name}/?$rid={request_id}
+        path, _, query = message.topic.partition("?")
+        levels = path.rstrip("/").split("/")
+        device_id, name = levels[1], levels[4]
+        request_id = urllib.parse.parse_qs(query).get("$rid", [""])[0]
+
+        status, response = self._call(device_id, name, message.payload, "method")
+        client.publish(f"$iothub/{device_id}/methods/res/{status}/?$rid={request_id}",
+                       json.dumps(response), qos=0)
+
+    def _handle_c2d(self, client, message):
+        device_id = _device_id_from_topic(message.topic)
+        try:
+            command = json.loads(message.payload)
+            name, payload = command["method"], json.dumps(command.get("payload"))
+        except (ValueError, KeyError, TypeError):
+            commands_handled.inc(kind="c2d", result="invalid")
+            logger.warning(f"ignoring an invalid cloud-to-device message for {device_id}.")
+            return
+        status, response = self._call(device_id, name, payload, "c2d")
+        if status != 200:
+            logger.warning(f"cloud-to-device {name} command for {device_id} failed "
+                           f"with status {status}: {response}")
+
+    def _call(self, device_id, name, payload, kind):
+        handler = self._methods.get(name)
+        if handler is None:
+            commands_handled.inc(kind=kind, result="unknown")
+            return 404, {"message": f"unknown method {name}"}
+        try:
+            status, response = handler(device_id, json.loads(payload or "null") or {})
+        except ValueError as e:
+            status, response = 400, {"message": str(e)}
+        except Exception:
+            logger.exception(f"{name} method of {device_id} failed.")
+            status, response = 500, {"message": "internal error"}
+        commands_handled.inc(kind=kind, result=str(status))
+        return status, response
+
+    def _handle_twin(self, client, message):
+        # topic: $iothub/{device_id}/twin/res/{status}/?$rid={request_id}
+        device_id = _device_id_from_topic(message.topic)
+        status = message.topic.partition("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        if status != "200":
+            logger.warning(f"twin request of {device_id} failed with status {status}.")
+            return
+        try:
+            desired = json.loads(message.payload)["desired"]
+        except (ValueError, KeyError, TypeError):
+            logger.exception(f"cannot decode the twin of {device_id}.")
+            return
+        self._versions[device_id] = desired.get("$version")
+        self._apply(device_id, desired, "twin")
+
+    def _handle_patch(self, client, message):
+        device_id = _device_id_from_topic(message.topic)
+        try:
+            patch = json.loads(message.payload)
+        except ValueError:
+            logger.exception(f"cannot decode the desired properties patch of {device_id}.")
+            return
+        version, known = patch.get("$version"), self._versions.get(device_id)
+        if known is not None and version is not None and version <= known:
+            # already part of the twin received when connecting.
+            return
+        self._versions[device_id] = version
+        self._apply(device_id, patch, "desired")
+
+    def _apply(self, device_id, properties, kind):
+        for name, handler in self._properties.items():
+            if name not in properties:
+                continue
+            try:
+                handler(device_id, properties[name])
+                commands_handled.inc(kind=kind, result="applied")
+            except Exception:
+                commands_handled.inc(kind=kind, result="failed")
+                logger.exception(f"failed to apply the {name} desired property of {device_id}.")
+
+
+def _device_topics(device_id):
+    return (f"$iothub/{device_id}/methods/post/#",
+            f"$iothub/{device_id}/messages/c2d/post/#",
+            f"$iothub/{device_id}/twin/res/#",
+            f"$iothub/{device_id}/twin/desired/#")
+
+
+def _device_id_from_topic(topic: str) -> str:
+    # topics have the form "$iothub/{device_id}/..."
+    return topic.split("/", 2)[1]
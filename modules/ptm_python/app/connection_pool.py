@@ -0,0 +1,153 @@
+"""This module contains a pool of ModuleClient connections which shards the translated
+devices across several MQTT connections, each with its own network loop thread
+and SAS token lifecycle.
+"""
+
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import module_client
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """A set of ModuleClients with the same surface as a single ModuleClient.
+
+    Each device id is pinned to one connection by a stable hash of the id, so all the
+    messages of a device go through the same connection (and keep their order), while a
+    slow or reconnecting connection only delays the devices pinned to it.
+    """
+
+    def __init__(self, clients):
+        """
+        :param clients: The ModuleClients forming the pool, at least one.
+        """
+        if not clients:
+            raise ValueError("a connection pool needs at least one client")
+        self.clients = list(clients)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def shard_index(self, device_id: str) -> int:
+        """Returns the index of the connection the device is pinned to.
+        """
+        return zlib.crc32(device_id.encode("utf-8")) % len(self.clients)
+
+    def client_for(self, device_id: str):
+        """Returns the connection the device is pinned to.
+        """
+        return self.clients[self.shard_index(device_id)]
+
+    def connect(self, host: str, port: int = 1883, keepalive: int = 60):
+        """Connect all the clients to a remote broker.
+        """
+        for client in self.clients:
+            client.connect(host, port, keepalive)
+
+    def disconnect(self):
+        """Disconnect all the clients.
+        """
+        for client in self.clients:
+            client.disconnect()
+
+    def refresh(self):
+        """Renews the SAS token of every client.
+        """
+        for client in self.clients:
+            client.refresh()
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """Publish a message on an "$iothub/{device_id}/..." topic, through the connection
+        the device is pinned to.
+        """
+        return self.client_for(_device_id_from_topic(topic)).publish(
+            topic, payload, qos, retain)
+
+    def max_inflight_messages_set(self, inflight: int):
+        """Set the maximum number of in-flight messages of every client.
+        """
+        for client in self.clients:
+            client.max_inflight_messages_set(inflight)
+
+    @property
+    def on_connect(self):
+        return self.clients[0].on_connect
+
+    @on_connect.setter
+    def on_connect(self, func):
+        """Define the connect callback of every client. The callback receives the
+        ModuleClient which connected.
+        """
+        for client in self.clients:
+            client.on_connect = func
+
+    @property
+    def on_publish(self):
+        return self.clients[0].on_publish
+
+    @on_publish.setter
+    def on_publish(self, func):
+        """Define the publish callback of every client. The callback receives the
+        ModuleClient which published the message.
+        """
+        for client in self.clients:
+            client.on_publish = func
+
+    @property
+    def on_message(self):
+        return self.clients[0].on_message
+
+    @on_message.setter
+    def on_message(self, func):
+        """Define the message callback of every client. The callback receives the
+        ModuleClient which received the message.
+        """
+        for client in self.clients:
+            client.on_message = func
+
+    def loop_start(self):
+        """Starts the network loop thread (and token renewal) of every client.
+        """
+        for client in self.clients:
+            client.loop_start()
+
+
+def create_from_environment(size: int, sastoken_ttl: int = 3600,
+                            renewal_ratio: float = 0.8,
+                            signing_workers: int = 4) -> ConnectionPool:
+    """Creates a pool of ``size`` ModuleClients from edge module environment.
+
+    The clients are created concurrently and share a TokenManager, a single client as
+    well: the module identity token is signed once for all the connections, and renewed
+    for all of them at once.
+
+    Every connection authenticates with the module identity, and edgeHub only keeps one
+    connection per identity: a pool of several connections is for brokers accepting
+    several connections of an identity, not for edgeHub.
+
+    :param int size: The number of connections.
+    :param int sastoken_ttl: The time to live (in seconds) of the SasTokens.
+    :param float renewal_ratio: The fraction of sastoken_ttl after which tokens are renewed.
+    :param int signing_workers: The maximum number of concurrent HSM signing requests.
+    """
+    tokens = module_client.create_token_manager(sastoken_ttl, renewal_ratio, signing_workers)
+    if size == 1:
+        # a single connection keeps the module client id.
+        return ConnectionPool([module_client.create_from_environment(
+            sastoken_ttl, renewal_ratio, tokens=tokens)])
+
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        clients = list(executor.map(
+            lambda shard: module_client.create_from_environment(
+                sastoken_ttl, renewal_ratio, shard, tokens),
+            range(size)))
+    logger.info(f"created a pool of {size} upstream connections.")
+    return ConnectionPool(clients)
+
+
+def _device_id_from_topic(topic: str) -> str:
+    # topics have the form "$iothub/{device_id}/..."
+    return topic.split("/", 2)[1]
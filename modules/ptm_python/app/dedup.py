@@ -0,0 +1,200 @@
+"""This module contains a per-sensor suppression stage which drops repeated or
+insignificant BLE advertisements before they are translated and sent upstream.
+"""
+
+import threading
+import time
+from array import array
+
+from metrics import REGISTRY
+
+suppressed = REGISTRY.counter(
+    "ptm_dedup_suppressed_total", "Number of readings suppressed by policy")
+forwarded = REGISTRY.counter(
+    "ptm_dedup_forwarded_total", "Number of readings forwarded by reason")
+
+# the number of neighbouring slots inspected before a slot is recycled.
+_PROBES = 8
+_EMPTY = -1
+_NAN = float("nan")
+
+
+def mac_to_int(mac: str) -> int:
+    """Converts a MAC address such as "FE:36:EA:1E:62:AF" to a 48-bit integer.
+    """
+    return int(mac.replace(":", "").replace("-", ""), 16)
+
+
+class Deadband:
+    """Thresholds under which a change of a measured value is considered insignificant.
+    A threshold of None means that field is not compared.
+    """
+
+    def __init__(self, temperature: float = None, humidity: float = None,
+                 pressure: float = None):
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+
+    def __bool__(self):
+        return any(v is not None for v in (self.temperature, self.humidity, self.pressure))
+
+
+class SuppressionTable:
+    """Keeps the last forwarded reading of each sensor in a fixed size, open addressing
+    table and decides whether a new reading needs to be sent upstream.
+
+    Policies are evaluated in this order:
+
+    1. heartbeat: a reading is always forwarded once ``heartbeat`` seconds have passed
+       since the last forwarded reading of that sensor.
+    2. duplicate: a reading with the same ``measurement_sequence_number`` as the last
+       forwarded one is dropped.
+    3. interval: a reading arriving less than ``min_interval`` seconds after the last
+       forwarded one is dropped.
+    4. deadband: a reading whose temperature, humidity and pressure are all within the
+       deadband of the last forwarded values is dropped.
+
+    When the table is full the least recently forwarded sensor in the probe window is
+    forgotten, so memory use never grows beyond ``capacity`` entries.
+
+    Alert readings (see the priority module) are only checked against the duplicate
+    policy, so a threshold alert is never held back by the interval or deadband.
+
+    ``min_interval`` may be overridden per sensor with set_min_interval, to tune the
+    reporting rate of a device remotely. An overridden interval longer than the
+    heartbeat also delays the heartbeat.
+    """
+
+    def __init__(self, capacity: int = 1024, drop_duplicates: bool = True,
+                 deadband: Deadband = None, min_interval: float = 0,
+                 heartbeat: float = 60, clock=time.monotonic):
+        """
+        :param int capacity: Maximum number of sensors tracked at once.
+        :param bool drop_duplicates: Drop readings with an already forwarded sequence number.
+        :param Deadband deadband: Thresholds for the deadband policy (optional).
+        :param float min_interval: Minimum time (in seconds) between two forwarded readings.
+        :param float heartbeat: Time (in seconds) after which a reading is always forwarded.
+            0 disables the heartbeat.
+        """
+        # round the capacity up to a power of two so a mask can replace the modulo.
+        size = 1 << max(capacity - 1, 1).bit_length()
+        self._mask = size - 1
+        self._clock = clock
+        # sensors of different ingest workers may share a probe window.
+        self._lock = threading.Lock()
+
+        self.drop_duplicates = drop_duplicates
+        self.deadband = deadband or Deadband()
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+        # min_interval overrides, by MAC address as an integer.
+        self._intervals = {}
+
+        self._keys = array("q", [_EMPTY]) * size
+        self._sequence = array("q", [_EMPTY]) * size
+        self._forwarded_at = array("d", [0.0]) * size
+        self._temperature = array("d", [_NAN]) * size
+        self._humidity = array("d", [_NAN]) * size
+        self._pressure = array("d", [_NAN]) * size
+
+    def accept(self, mac: str, reading: dict, alert: bool = False) -> bool:
+        """Returns True when the reading should be forwarded upstream.
+        """
+        key = mac_to_int(mac)
+        with self._lock:
+            now = self._clock()
+            slot, known = self._find(key)
+            reason = self._suppression_reason(slot, key, reading, now, alert) \
+                if known else None
+            if reason is None:
+                self._store(slot, reading, now)
+
+        if reason is not None:
+            suppressed.inc(policy=reason)
+            return False
+        forwarded.inc(reason="changed" if known else "new")
+        return True
+
+    def set_min_interval(self, mac: str, min_interval: float = None):
+        """Overrides the minimum time (in seconds) between two forwarded readings of a
+        sensor. None goes back to the table min_interval.
+        """
+        key = mac_to_int(mac)
+        with self._lock:
+            if min_interval is None:
+                self._intervals.pop(key, None)
+            else:
+                self._intervals[key] = min_interval
+
+    def _suppression_reason(self, slot, key, reading, now, alert):
+        elapsed = now - self._forwarded_at[slot]
+        heartbeat = self.heartbeat
+        min_interval = self._intervals.get(key) if self._intervals else None
+        if min_interval is None:
+            min_interval = self.min_interval
+        elif heartbeat:
+            heartbeat = max(heartbeat, min_interval)
+        if heartbeat and elapsed >= heartbeat:
+            return None
+
+        sequence = reading.get("measurement_sequence_number")
+        if self.drop_duplicates and sequence is not None \
+                and sequence == self._sequence[slot]:
+            return "duplicate"
+
+        if alert:
+            return None
+
+        if elapsed < min_interval:
+            return "interval"
+
+        if self.deadband and self._within_deadband(slot, reading):
+            return "deadband"
+
+        return None
+
+    def _within_deadband(self, slot, reading):
+        deadband = self.deadband
+        for threshold, field, last in (
+                (deadband.temperature, "temperature", self._temperature),
+                (deadband.humidity, "humidity", self._humidity),
+                (deadband.pressure, "pressure", self._pressure)):
+            if threshold is None:
+                continue
+            value = reading.get(field)
+            # a missing value never compares as "within" (NaN comparisons are False).
+            if value is None or not abs(value - last[slot]) <= threshold:
+                return False
+        return True
+
+    def _store(self, slot, reading, now):
+        sequence = reading.get("measurement_sequence_number")
+        self._sequence[slot] = _EMPTY if sequence is None else sequence
+        self._forwarded_at[slot] = now
+        self._temperature[slot] = _as_float(reading.get("temperature"))
+        self._humidity[slot] = _as_float(reading.get("humidity"))
+        self._pressure[slot] = _as_float(reading.get("pressure"))
+
+    def _find(self, key):
+        """Returns (slot, known) for the key, claiming or recycling a slot if needed.
+        """
+        home = (key * 0x9E3779B1) & self._mask
+        victim = home
+        for probe in range(_PROBES):
+            slot = (home + probe) & self._mask
+            current = self._keys[slot]
+            if current == key:
+                return slot, True
+            if current == _EMPTY:
+                victim = slot
+                break
+            if self._forwarded_at[slot] < self._forwarded_at[victim]:
+                victim = slot
+
+        self._keys[victim] = key
+        return victim, False
+
+
+def _as_float(value):
+    return _NAN if value is None else float(value)
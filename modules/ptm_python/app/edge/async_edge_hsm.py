@@ -0,0 +1,205 @@
+"""This module contains an asyncio version of IoTEdgeHsm, talking HTTP/1.1 to the
+IoT Edge workload API over non-blocking (unix) socket connections kept alive
+between requests.
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import time
+import urllib
+
+import edge.user_agent as user_agent
+from edge.edge_hsm import request_failures, request_latency
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncIoTEdgeHsm:
+    """
+    An object communicating with the Azure IoT Edge HSM, the same way as
+    edge.edge_hsm.IoTEdgeHsm does, except that get_certificate and sign are coroutines.
+    """
+
+    def __init__(self, module_id, generation_id, workload_uri, api_version,
+                 timeout=10, retries=3, backoff=0.5, max_connections=4):
+        """
+        :param str module_id: The module id
+        :param str api_version: The API version
+        :param str generation_id: The module generation id
+        :param str workload_uri: The workload uri
+        :param float timeout: The timeout (in seconds) of a workload API request
+        :param int retries: The number of times a failed request is retried
+        :param float backoff: The delay (in seconds) before the first retry, doubled
+            for every following retry
+        :param int max_connections: The maximum number of idle connections kept alive
+        """
+        self.module_id = urllib.parse.quote(module_id, safe="")
+        self.api_version = api_version
+        self.generation_id = generation_id
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+
+        self._address = _parse_workload_uri(workload_uri)
+        self._query = urllib.parse.urlencode({"api-version": api_version})
+        self._user_agent = urllib.parse.quote(user_agent.get_iothub_user_agent(), safe="")
+        self._idle = []
+
+    async def get_certificate(self):
+        """
+        Return the server verification certificate from the trust bundle.
+
+        :raises: OSError if unable to retrieve the certificate.
+        """
+        body = await self._request(
+            "trust-bundle", "Unable to get trust bundle from Edge", "GET", "/trust-bundle")
+        try:
+            bundle = json.loads(body)
+        except ValueError as e:
+            raise OSError("Unable to decode trust bundle") from e
+        try:
+            return bundle["certificate"]
+        except KeyError as e:
+            raise OSError("No certificate in trust bundle") from e
+
+    async def sign(self, data_str):
+        """
+        Use the IoTEdge HSM to sign a piece of string data.
+
+        :param str data_str: The data string to sign
+
+        :return: The base64-encoded signature.
+
+        :raises: OSError if unable to sign the data.
+        """
+        encoded_data_str = base64.b64encode(data_str.encode("utf-8")).decode()
+        sign_request = {"keyId": "primary",
+                        "algo": "HMACSHA256", "data": encoded_data_str}
+        path = f"/modules/{self.module_id}/genid/{self.generation_id}/sign"
+
+        body = await self._request(
+            "sign", "Unable to sign data", "POST", path,
+            json.dumps(sign_request).encode("utf-8"))
+        try:
+            sign_response = json.loads(body)
+        except ValueError as e:
+            raise OSError("Unable to decode signed data") from e
+        try:
+            return sign_response["digest"]
+        except KeyError as e:
+            raise OSError("No signed data received") from e
+
+    async def close(self):
+        """Closes the idle connections.
+        """
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def _request(self, operation, error_message, method, path, body=b""):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                status, response = await asyncio.wait_for(
+                    self._send(method, path, body), self.timeout)
+                if status >= 400:
+                    raise _HttpError(status)
+                request_latency.observe(time.monotonic() - start, operation=operation)
+                return response
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    _HttpError) as e:
+                request_failures.inc(operation=operation)
+                retryable = not isinstance(e, _HttpError) or e.status >= 500
+                if not retryable or attempt == self.retries:
+                    raise OSError(error_message) from e
+                logger.warning(
+                    f"{operation} request to Edge failed ({e!r}), retrying in {delay}s.")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _send(self, method, path, body):
+        reader, writer = await self._connection()
+        request = (
+            f"{method} {path}?{self._query} HTTP/1.1\r\n"
+            f"Host: localhost\r\n"
+            f"User-Agent: {self._user_agent}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"\r\n").encode("latin-1")
+        try:
+            writer.write(request + body)
+            await writer.drain()
+            status, headers, response = await _read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get("connection", "").lower() == "close" \
+                or len(self._idle) >= self.max_connections:
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+        return status, response
+
+    async def _connection(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            # the server may have closed an idle connection.
+            if not reader.at_eof():
+                return reader, writer
+            writer.close()
+        if self._address[0] == "unix":
+            return await asyncio.open_unix_connection(self._address[1])
+        return await asyncio.open_connection(self._address[1], self._address[2])
+
+
+class _HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP status {status}")
+        self.status = status
+
+
+async def _read_response(reader):
+    """Reads an HTTP/1.1 response. Returns (status, headers, body).
+    """
+    status_line = await reader.readuntil(b"\r\n")
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readuntil(b"\r\n")
+        if line == b"\r\n":
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                # skip the (empty) trailers.
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    else:
+        body = await reader.readexactly(int(headers.get("content-length", "0")))
+    return status, headers, body
+
+
+def _parse_workload_uri(uri):
+    """
+    Converts an IOTEDGE_WORKLOADURI value, such as "unix:///var/run/iotedge/workload.sock"
+    or "http://localhost:15581/", into ("unix", path) or ("tcp", host, port).
+    """
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme == "unix":
+        return ("unix", parsed.path)
+    return ("tcp", parsed.hostname, parsed.port or 80)
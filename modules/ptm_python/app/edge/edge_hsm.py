@@ -7,6 +7,8 @@
 import base64
 import json
 import logging
+import threading
+import time
 import urllib
 
 import requests
@@ -14,10 +16,16 @@ import requests_unixsocket
 
 import edge.user_agent as user_agent
 from edge.signing_mechanism import SigningMechanism
+from metrics import REGISTRY
 
-requests_unixsocket.monkeypatch()
 logger = logging.getLogger(__name__)
 
+request_latency = REGISTRY.histogram(
+    "ptm_hsm_request_seconds", "Latency of the workload API requests by operation",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+request_failures = REGISTRY.counter(
+    "ptm_hsm_request_failures_total", "Number of failed workload API attempts by operation")
+
 
 class IoTEdgeHsm(SigningMechanism):
     """
@@ -32,7 +40,8 @@ class IoTEdgeHsm(SigningMechanism):
        SharedAccessSignature string which can be used to authenticate with Iot Edge
     """
 
-    def __init__(self, module_id, generation_id, workload_uri, api_version):
+    def __init__(self, module_id, generation_id, workload_uri, api_version,
+                 timeout=10, retries=3, backoff=0.5, trust_bundle_ttl=3600):
         """
         Constructor for instantiating a Azure IoT Edge HSM object
 
@@ -40,49 +49,84 @@ class IoTEdgeHsm(SigningMechanism):
         :param str api_version: The API version
         :param str generation_id: The module generation id
         :param str workload_uri: The workload uri
+        :param float timeout: The timeout (in seconds) of a workload API request
+        :param int retries: The number of times a failed request is retried
+        :param float backoff: The delay (in seconds) before the first retry, doubled
+            for every following retry
+        :param float trust_bundle_ttl: The time (in seconds) the trust bundle is cached
         """
         self.module_id = urllib.parse.quote(module_id, safe="")
         self.api_version = api_version
         self.generation_id = generation_id
         self.workload_uri = _format_socket_uri(workload_uri)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.trust_bundle_ttl = trust_bundle_ttl
+
+        self._sign_url = "{workload_uri}modules/{module_id}/genid/{gen_id}/sign".format(
+            workload_uri=self.workload_uri, module_id=self.module_id, gen_id=self.generation_id
+        )
+        self._trust_bundle_url = self.workload_uri + "trust-bundle"
+        self._user_agent = user_agent.get_iothub_user_agent()
 
-    def get_certificate(self):
+        # A session keeps the unix socket connections to the workload API alive.
+        self._session = requests_unixsocket.Session()
+        self._certificate = None
+        self._certificate_time = 0
+        self._certificate_lock = threading.Lock()
+
+    def get_certificate(self, max_age=None):
         """
         Return the server verification certificate from the trust bundle that can be used to
         validate the server-side SSL TLS connection that we use to talk to Edge
 
+        The trust bundle is cached: it is fetched again once the cached one is older than
+        max_age seconds (trust_bundle_ttl by default). If that fails, the cached
+        certificate is returned.
+
+        :param float max_age: The maximum age (in seconds) of the cached trust bundle, 0
+            to always fetch it.
+
         :return: The server verification certificate to use for connections to the Azure IoT Edge
         instance, as a PEM certificate in string form.
 
         :raises: IoTEdgeError if unable to retrieve the certificate.
         """
-        r = requests.get(
-            self.workload_uri + "trust-bundle",
-            params={"api-version": self.api_version},
-            headers={
-                "User-Agent": urllib.parse.quote_plus(user_agent.get_iothub_user_agent())},
+        if max_age is None:
+            max_age = self.trust_bundle_ttl
+        with self._certificate_lock:
+            if self._certificate is not None \
+                    and time.monotonic() - self._certificate_time < max_age:
+                return self._certificate
+            try:
+                self._certificate = self._fetch_certificate()
+            except OSError:
+                if self._certificate is None:
+                    raise
+                logger.exception("Unable to refresh the trust bundle, keeping the cached one.")
+                return self._certificate
+            self._certificate_time = time.monotonic()
+            return self._certificate
+
+    def _fetch_certificate(self):
+        r = self._request(
+            "trust-bundle",
+            "Unable to get trust bundle from Edge",
+            "GET",
+            self._trust_bundle_url,
+            headers={"User-Agent": urllib.parse.quote_plus(self._user_agent)},
         )
-        # Validate that the request was successful
-        try:
-            r.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            raise OSError(
-                message="Unable to get trust bundle from Edge"
-            ) from e
         # Decode the trust bundle
         try:
             bundle = r.json()
         except ValueError as e:
-            raise OSError(
-                message="Unable to decode trust bundle"
-            ) from e
+            raise OSError("Unable to decode trust bundle") from e
         # Retrieve the certificate
         try:
             cert = bundle["certificate"]
         except KeyError as e:
-            raise OSError(
-                message="No certificate in trust bundle"
-            ) from e
+            raise OSError("No certificate in trust bundle") from e
         return cert
 
     def sign(self, data_str):
@@ -99,34 +143,56 @@ class IoTEdgeHsm(SigningMechanism):
         """
         encoded_data_str = base64.b64encode(data_str.encode("utf-8")).decode()
 
-        path = "{workload_uri}modules/{module_id}/genid/{gen_id}/sign".format(
-            workload_uri=self.workload_uri, module_id=self.module_id, gen_id=self.generation_id
-        )
         sign_request = {"keyId": "primary",
                         "algo": "HMACSHA256", "data": encoded_data_str}
 
-        r = requests.post(  # can we use json field instead of data?
-            url=path,
-            params={"api-version": self.api_version},
-            headers={
-                "User-Agent": urllib.parse.quote(user_agent.get_iothub_user_agent(), safe="")},
+        r = self._request(  # can we use json field instead of data?
+            "sign",
+            "Unable to sign data",
+            "POST",
+            self._sign_url,
+            headers={"User-Agent": urllib.parse.quote(self._user_agent, safe="")},
             data=json.dumps(sign_request),
         )
-        try:
-            r.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            raise OSError(message="Unable to sign data") from e
         try:
             sign_response = r.json()
         except ValueError as e:
-            raise OSError(message="Unable to decode signed data") from e
+            raise OSError("Unable to decode signed data") from e
         try:
             signed_data_str = sign_response["digest"]
         except KeyError as e:
-            raise OSError(message="No signed data received") from e
+            raise OSError("No signed data received") from e
 
         return signed_data_str  # what format is this? string? bytes?
 
+    def _request(self, operation, error_message, method, url, **kwargs):
+        """
+        Send a request to the workload API, retrying connection errors, timeouts and
+        server errors with an exponential backoff.
+
+        :raises: OSError if the request still fails after all the retries.
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                r = self._session.request(
+                    method, url, params={"api-version": self.api_version},
+                    timeout=self.timeout, **kwargs)
+                r.raise_for_status()
+                request_latency.observe(time.monotonic() - start, operation=operation)
+                return r
+            except requests.exceptions.RequestException as e:
+                request_failures.inc(operation=operation)
+                retryable = not isinstance(e, requests.exceptions.HTTPError) \
+                    or e.response.status_code >= 500
+                if not retryable or attempt == self.retries:
+                    raise OSError(error_message) from e
+                logger.warning(
+                    "{} request to Edge failed ({}), retrying in {}s.".format(operation, e, delay))
+                time.sleep(delay)
+                delay *= 2
+
 
 def _format_socket_uri(old_uri):
     """
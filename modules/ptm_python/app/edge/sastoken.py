@@ -54,16 +54,19 @@ class RenewableSasToken(object):
         """
         Refresh the SasToken lifespan, giving it a new expiry time, and generating a new token.
         """
-        self._expiry_time = int(time.time() + self.ttl)
-        self._token = self._build_token()
+        # build the token first so that a signing failure leaves the current token intact.
+        expiry_time = int(time.time() + self.ttl)
+        token = self._build_token(expiry_time)
+        self._expiry_time, self._token = expiry_time, token
 
-    def _build_token(self):
+    def _build_token(self, expiry_time):
         """Buid SasToken representation
 
+        :param int expiry_time: Time that the token will expire (in UTC, since epoch)
+
         :returns: String representation of the token
         """
-        url_encoded_uri = urllib.parse.quote(self._uri, safe="")
-        message = url_encoded_uri + "\n" + str(self.expiry_time)
+        message = self._signing_message(expiry_time)
         try:
             signature = self._signing_mechanism.sign(message)
         except Exception as e:
@@ -71,19 +74,29 @@ class RenewableSasToken(object):
             # So we catch all of them.
             raise ValueError(
                 "Unable to build SasToken from given values", e)
+        return self._format_token(signature, expiry_time)
+
+    def _signing_message(self, expiry_time):
+        """Returns the string to sign for a token expiring at expiry_time"""
+        url_encoded_uri = urllib.parse.quote(self._uri, safe="")
+        return url_encoded_uri + "\n" + str(expiry_time)
+
+    def _format_token(self, signature, expiry_time):
+        """Returns the string representation of a token from its signature"""
+        url_encoded_uri = urllib.parse.quote(self._uri, safe="")
         url_encoded_signature = urllib.parse.quote(signature, safe="")
         if self._key_name:
             token = self._auth_rule_token_format.format(
                 resource=url_encoded_uri,
                 signature=url_encoded_signature,
-                expiry=str(self.expiry_time),
+                expiry=str(expiry_time),
                 keyname=self._key_name,
             )
         else:
             token = self._simple_token_format.format(
                 resource=url_encoded_uri,
                 signature=url_encoded_signature,
-                expiry=str(self.expiry_time),
+                expiry=str(expiry_time),
             )
         return token
 
@@ -93,6 +106,42 @@ class RenewableSasToken(object):
         return self._expiry_time
 
 
+class AsyncRenewableSasToken(RenewableSasToken):
+    """Renewable Shared Access Signature Token signed by an asynchronous signing mechanism.
+
+    The token is empty until the .refresh() coroutine has been awaited once.
+    """
+
+    def __init__(self, uri, signing_mechanism, key_name=None, ttl=3600):
+        """
+        :param str uri: URI of the resouce to be accessed
+        :param signing_mechanism: A signing mechanism whose sign method is a coroutine
+        :param str key_name: Symmetric Key Name (optional)
+        :param int ttl: Time to live for the token, in seconds (default 3600)
+        """
+        self._uri = uri
+        self._signing_mechanism = signing_mechanism
+        self._key_name = key_name
+        self._expiry_time = None  # This will be overwritten by the .refresh() coroutine
+        self._token = None  # This will be overwritten by the .refresh() coroutine
+
+        self.ttl = ttl
+
+    async def refresh(self):
+        """
+        Refresh the SasToken lifespan, giving it a new expiry time, and generating a new token.
+        """
+        expiry_time = int(time.time() + self.ttl)
+        try:
+            signature = await self._signing_mechanism.sign(
+                self._signing_message(expiry_time))
+        except Exception as e:
+            raise ValueError(
+                "Unable to build SasToken from given values", e)
+        self._expiry_time = expiry_time
+        self._token = self._format_token(signature, expiry_time)
+
+
 REQUIRED_SASTOKEN_FIELDS = ["sr", "sig", "se"]
 VALID_SASTOKEN_FIELDS = REQUIRED_SASTOKEN_FIELDS + ["skn"]
 
@@ -0,0 +1,164 @@
+"""This module contains the payload encoders used to serialize a batch of decoded
+RuuviTag readings, and the helper building the telemetry topic with the matching
+message properties.
+"""
+
+import json
+import struct
+import urllib.parse
+import zlib
+
+from timestamps import FIELD
+
+# IoT Hub system properties set through the topic property bag.
+CONTENT_TYPE = "$.ct"
+CONTENT_ENCODING = "$.ce"
+
+
+class JsonEncoder:
+    """Encodes a batch as a compact JSON array of reading objects.
+    """
+
+    name = "json"
+
+    def __init__(self):
+        self.properties = {CONTENT_TYPE: "application/json", CONTENT_ENCODING: "utf-8"}
+        self._encoder = json.JSONEncoder(separators=(",", ":"), default=_to_dict)
+
+    def encode(self, readings) -> bytes:
+        return self._encoder.encode(readings).encode("utf-8")
+
+
+class RuuviBinaryEncoder:
+    """Encodes a batch as fixed size records of the decoded RuuviTag fields.
+
+    The payload is a header (format version, record count) followed by one record
+    per reading, all little endian::
+
+        uint8   data_format
+        int16   temperature, in 0.005 degC
+        uint16  humidity, in 0.0025 %RH
+        uint16  pressure, in Pa - 50000
+        int16   acceleration_x, acceleration_y, acceleration_z, in mG
+        uint16  battery, in mV
+        int8    tx_power, in dBm
+        uint8   movement_counter
+        uint16  measurement_sequence_number
+        uint32  capture time, in milliseconds after the header timestamp
+
+    with the header timestamp the capture time of the oldest reading of the batch, in
+    milliseconds since epoch (0 if no reading has one).
+
+    Missing fields are encoded with the RAWv2 "invalid" values: the minimum of signed
+    fields and the maximum of unsigned ones. So are the values out of the range of
+    their field, such as a humidity of 163.84 %RH or more, rather than failing the
+    whole batch.
+    """
+
+    name = "binary"
+    version = 2
+
+    _header = struct.Struct("<BHQ")
+    _record = struct.Struct("<BhHHhhhHbBHI")
+
+    def __init__(self):
+        self.properties = {CONTENT_TYPE: "application/octet-stream",
+                           "format": f"ruuvi-v{self.version}"}
+
+    def encode(self, readings) -> bytes:
+        record = self._record
+        buffer = bytearray(self._header.size + record.size * len(readings))
+        times = [reading.get(FIELD) for reading in readings]
+        base = min((t for t in times if t is not None), default=0)
+        self._header.pack_into(buffer, 0, self.version, len(readings), base)
+        offset = self._header.size
+        for reading, timestamp in zip(readings, times):
+            get = reading.get
+            record.pack_into(
+                buffer, offset,
+                _scale(get("data_format"), 1, *_UINT8),
+                _scale(get("temperature"), 200, *_INT16),
+                _scale(get("humidity"), 400, *_UINT16),
+                _scale(get("pressure"), 100, *_UINT16, offset=-50000),
+                _scale(get("acceleration_x"), 1, *_INT16),
+                _scale(get("acceleration_y"), 1, *_INT16),
+                _scale(get("acceleration_z"), 1, *_INT16),
+                _scale(get("battery"), 1, *_UINT16),
+                _scale(get("tx_power"), 1, *_INT8),
+                _scale(get("movement_counter"), 1, *_UINT8),
+                _scale(get("measurement_sequence_number"), 1, *_UINT16),
+                _scale(None if timestamp is None else timestamp - base, 1, *_UINT32))
+            offset += record.size
+        return bytes(buffer)
+
+
+class DeflateEncoder:
+    """Compresses the output of another encoder with zlib (deflate).
+    """
+
+    def __init__(self, encoder, level: int = 6):
+        self._encoder = encoder
+        self.level = level
+        self.name = f"{encoder.name}+deflate"
+        self.properties = dict(encoder.properties, compression="deflate")
+
+    def encode(self, readings) -> bytes:
+        return zlib.compress(self._encoder.encode(readings), self.level)
+
+
+ENCODERS = {
+    JsonEncoder.name: JsonEncoder,
+    RuuviBinaryEncoder.name: RuuviBinaryEncoder,
+}
+
+
+def create_encoder(name: str = "json", compression: str = "none"):
+    """Creates an encoder by name, optionally compressed.
+
+    :param str name: The encoding, json or binary.
+    :param str compression: The batch compression, none or deflate.
+    """
+    try:
+        encoder = ENCODERS[name]()
+    except KeyError:
+        raise ValueError(f"unknown payload encoding: {name}")
+    if compression == "deflate":
+        return DeflateEncoder(encoder)
+    if compression != "none":
+        raise ValueError(f"unknown payload compression: {compression}")
+    return encoder
+
+
+def events_topic(device_id: str, encoder, properties: dict = None) -> str:
+    """Returns the telemetry topic of a device, with the encoder properties, and the
+    given message properties, in the property bag.
+    """
+    if properties:
+        properties = dict(encoder.properties, **properties)
+    else:
+        properties = encoder.properties
+    properties = urllib.parse.urlencode(properties, safe="$")
+    return f"$iothub/{device_id}/messages/events/{properties}"
+
+
+def _to_dict(value):
+    # the readings of the sensor sources, see sources.Reading.
+    try:
+        return value.to_dict()
+    except AttributeError:
+        raise TypeError(f"{type(value).__name__} is not JSON serializable") from None
+
+
+# the valid minimum, maximum and missing value of the binary record fields.
+_INT8 = (-0x7F, 0x7F, -0x80)
+_UINT8 = (0, 0xFE, 0xFF)
+_INT16 = (-0x7FFF, 0x7FFF, -0x8000)
+_UINT16 = (0, 0xFFFE, 0xFFFF)
+_UINT32 = (0, 0xFFFFFFFE, 0xFFFFFFFF)
+
+
+def _scale(value, factor, low, high, missing, offset=0):
+    # the comparison is False for NaN, which is encoded as missing too.
+    if value is None or not low <= value * factor + offset <= high:
+        return missing
+    return int(round(value * factor)) + offset
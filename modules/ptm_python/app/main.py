@@ -1,76 +1,564 @@
 
+import asyncio
+import contextlib
 import json
 import logging
 import os
 import sys
+import threading
 import time
 
-from ruuvitag_sensor.ruuvi import RuuviTagSensor
-
-import module_client
+import aggregation
+import commands
+import encoding
+import metrics
+import pipeline
+import priority
+import raw
+import scanners
+import sources
+import store
+import timestamps
+import twin
+from dedup import Deadband, SuppressionTable
+from publisher import AsyncBatchingPublisher, ShardedPublisher
+from registry import DeviceRegistry, FileWatcher
 
 # A map of sensors' MAC to device id.
 # All devices need to be pre-created in IoT Hub.
-authorized_devices = json.loads(os.environ["AUTHORIZED_DEVICES"])
+authorized_devices = DeviceRegistry(json.loads(os.environ.get("AUTHORIZED_DEVICES", "{}")))
+
+# The map may also be read from a JSON file, reloaded when it changes, and from the
+# authorizedDevices desired property of the module twin. The last update wins.
+authorized_devices_file = os.environ.get("AUTHORIZED_DEVICES_FILE")
+authorized_devices_file_poll = int(
+    os.environ.get("AUTHORIZED_DEVICES_FILE_POLL_MS", "5000")) / 1000
+authorized_devices_from_twin = \
+    os.environ.get("AUTHORIZED_DEVICES_FROM_TWIN", "true").lower() == "true"
 
+# Level of the module logs. DEBUG adds the per-message lines, see LOG_SAMPLE_RATE.
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     datefmt='%Y-%m-%d %H:%M:%S')
 
+# Batching options: a device batch is published when it reaches BATCH_MAX_SIZE readings
+# or when its oldest reading is BATCH_MAX_DELAY_MS old, whichever comes first.
+batch_max_size = int(os.environ.get("BATCH_MAX_SIZE", "20"))
+batch_max_delay = int(os.environ.get("BATCH_MAX_DELAY_MS", "1000")) / 1000
+max_inflight_messages = int(os.environ.get("MAX_INFLIGHT_MESSAGES", "20"))
+
+# Readings are published in message classes, each with its own QoS level, batch window,
+# buffer and drop policy, highest priority first: threshold alerts before telemetry.
+# MESSAGE_CLASSES (a JSON object) overrides the settings of the built-in alert and
+# telemetry classes, or adds classes, by name, see priority.MessageClass. The class of a
+# sensor is set by its AUTHORIZED_DEVICES entry, telemetry by default.
+message_classes = priority.create_classes(
+    json.loads(os.environ.get("MESSAGE_CLASSES", "{}")), batch_max_size, batch_max_delay)
+
+# Payload encoding (json or binary) and batch compression (none or deflate).
+encoder = encoding.create_encoder(
+    os.environ.get("PAYLOAD_ENCODING", "json"),
+    os.environ.get("PAYLOAD_COMPRESSION", "none"))
+
+# Forward the undecoded advertisements instead of decoded readings, see raw.py.
+raw_passthrough = os.environ.get("RAW_PASSTHROUGH", "false").lower() == "true"
+if raw_passthrough:
+    encoder = raw.RawEncoder()
+    raw_batch_size = max(message_class.max_batch_size
+                         for message_class in message_classes.values())
+    batch_factory = lambda: raw.RawBatch(raw_batch_size)
+else:
+    batch_factory = list
+
+# Window statistics of the readings, sent instead of or along with them, for the
+# devices of the groups of AGGREGATION (a JSON list), see aggregation.AggregationGroup.
+aggregation_groups = [aggregation.AggregationGroup.from_dict(group)
+                      for group in json.loads(os.environ.get("AGGREGATION", "[]"))]
+if aggregation_groups and raw_passthrough:
+    logging.warning("AGGREGATION does not apply to raw advertisements, ignoring it.")
+    aggregation_groups = []
+if aggregation_groups and not encoder.name.startswith(encoding.JsonEncoder.name):
+    raise ValueError("AGGREGATION requires the json payload encoding")
+
+# SAS token lifetime, renewed in the background once SASTOKEN_RENEWAL_RATIO of it elapsed.
+sastoken_ttl = int(os.environ.get("SASTOKEN_TTL", "3600"))
+sastoken_renewal_ratio = float(os.environ.get("SASTOKEN_RENEWAL_RATIO", "0.8"))
+
+# Number of upstream connections the devices are sharded across. They all authenticate
+# with the module identity, the only one the workload API signs tokens for, and edgeHub
+# keeps a single connection per identity (a new one closes the previous one). Several
+# connections are only used with UPSTREAM_SHARED_IDENTITY, for brokers accepting several
+# connections of an identity, such as the benchmark broker, otherwise one is used.
+upstream_connections = int(os.environ.get("UPSTREAM_CONNECTIONS", "1"))
+upstream_shared_identity = \
+    os.environ.get("UPSTREAM_SHARED_IDENTITY", "false").lower() == "true"
+if upstream_connections > 1 and not upstream_shared_identity:
+    logging.warning(f"edgeHub accepts a single connection per identity, ignoring "
+                    f"UPSTREAM_CONNECTIONS={upstream_connections} without "
+                    f"UPSTREAM_SHARED_IDENTITY and using one connection.")
+    upstream_connections = 1
+# Maximum number of concurrent SAS token signing requests to the HSM.
+sastoken_signing_workers = int(os.environ.get("SASTOKEN_SIGNING_WORKERS", "4"))
+
+# Store-and-forward options. Messages are stored on disk when STORE_DIR is set,
+# which should be a volume mounted in the module container to survive restarts.
+store_dir = os.environ.get("STORE_DIR")
+store_segment_size = int(os.environ.get("STORE_SEGMENT_SIZE", str(1 << 20)))
+store_max_bytes = int(os.environ.get("STORE_MAX_BYTES", str(64 << 20)))
+store_eviction = os.environ.get("STORE_EVICTION", store.DROP_OLDEST)
+store_drain_rate = float(os.environ.get("STORE_DRAIN_RATE", "100"))
+
+# Bluetooth adapters to scan with, each in its own process, such as "hci0,hci1".
+# The default adapter is used, in the module process, if empty.
+ble_adapters = [adapter.strip() for adapter in os.environ.get("BLE_ADAPTERS", "").split(",")
+                if adapter.strip()]
+
+# Sensor protocols to translate, such as "ruuvitag,xiaomi", see sources.SOURCES, or
+# plugins given as "module:Class". RuuviTags are read with the ruuvitag_sensor library
+# if empty.
+sensor_sources = [name.strip() for name in os.environ.get("SENSOR_SOURCES", "").split(",")
+                  if name.strip()]
+if sensor_sources and (raw_passthrough or ble_adapters):
+    raise ValueError("SENSOR_SOURCES cannot be combined with RAW_PASSTHROUGH or BLE_ADAPTERS")
+
+# Number of worker threads handling the direct methods, cloud-to-device messages and
+# twin desired properties of the translated devices, 0 disables them.
+command_workers = int(os.environ.get("COMMAND_WORKERS", "2"))
+
+# Run the upstream client on an asyncio event loop instead of network threads. The
+# asyncio mode uses a single connection, does not store messages on disk and does not
+# handle the device commands.
+async_client = os.environ.get("ASYNC_CLIENT", "false").lower() == "true"
+if async_client and command_workers > 0:
+    logging.warning("COMMAND_WORKERS is not supported with ASYNC_CLIENT, the direct "
+                    "methods, cloud-to-device messages and twins of the devices are "
+                    "not handled.")
+    command_workers = 0
+
+# Readings are buffered between the scanner and the workers translating and publishing
+# them, so a slow upstream never stalls the scanner. When the buffer is full, the
+# oldest or newest reading is dropped, or the scanner waits (block).
+ingest_queue_size = int(os.environ.get("INGEST_QUEUE_SIZE", "1000"))
+ingest_overflow = os.environ.get("INGEST_OVERFLOW", pipeline.DROP_OLDEST)
+ingest_workers = int(os.environ.get("INGEST_WORKERS", "1"))
+
+
+# Port of the Prometheus metrics endpoint (http://<module>:<port>/metrics), off if empty.
+metrics_port = os.environ.get("METRICS_PORT", "")
+
+# Only one in LOG_SAMPLE_RATE per-message log lines is written, 0 disables them.
+log_sample_rate = int(os.environ.get("LOG_SAMPLE_RATE", "100"))
+
+advertisements = metrics.REGISTRY.counter(
+    "ptm_ble_advertisements_total", "Number of advertisements received by sensor MAC address")
+authorizations = metrics.REGISTRY.counter(
+    "ptm_authorization_lookups_total", "Number of sensor lookups by result")
+
+
+class LogSampler:
+    """Lets through one in every rate calls, so per-message logging has a bounded cost.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._count = 0
+
+    def __call__(self) -> bool:
+        if self.rate <= 0:
+            return False
+        self._count += 1
+        if self._count < self.rate:
+            return False
+        self._count = 0
+        return True
+
+
+sample_log = LogSampler(log_sample_rate)
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """ Logs the time a startup phase takes.
+    """
+    start = time.monotonic()
+    yield
+    logging.info(f"startup: {name} took {time.monotonic() - start:.3f}s.")
+
+
+def _optional_float(name):
+    value = os.environ.get(name, "")
+    return float(value) if value else None
+
+
+# Suppression of repeated advertisements, see dedup.SuppressionTable for the policies.
+suppression = SuppressionTable(
+    capacity=int(os.environ.get("DEDUP_TABLE_SIZE", "1024")),
+    drop_duplicates=os.environ.get("DEDUP_DROP_DUPLICATES", "true").lower() == "true",
+    deadband=Deadband(
+        temperature=_optional_float("DEDUP_DEADBAND_TEMPERATURE"),
+        humidity=_optional_float("DEDUP_DEADBAND_HUMIDITY"),
+        pressure=_optional_float("DEDUP_DEADBAND_PRESSURE")),
+    min_interval=int(os.environ.get("DEDUP_MIN_INTERVAL_MS", "0")) / 1000,
+    heartbeat=int(os.environ.get("DEDUP_HEARTBEAT_MS", "60000")) / 1000)
+
 
 def on_connect(client, userdata, flags, rc):
     """ The callback for when the client receives a CONNACK response from the server.
     """
-    logging.info(f"Upstream client connected with result code {str(rc)}")
+    logging.info(
+        f"Upstream client {client.client_id} connected with result code {str(rc)}")
 
-    # code 4 means bad username or password
-    # which in our case means expired token.
+    # code 4 means bad username or password which in our case means expired token.
+    # Tokens are renewed in the background before they expire, so this is only a fallback.
+    # With an AsyncModuleClient, refresh returns a coroutine scheduled by the client.
     if rc == 4:
         logging.info(f"Trying to refresh the SAS token.")
-        client.refresh()
+        return client.refresh()
+
+    if rc == 0 and device_commands is not None:
+        device_commands.on_connect(client)
+    if rc == 0 and desired_properties is not None:
+        return desired_properties.on_connect(client)
+
+
+# reads the module twin desired properties, when enabled.
+desired_properties = None
 
 
-def publish_upstream(client, mac, payload):
+def on_desired_properties(properties, complete):
+    """ The callback for when the module twin desired properties are received.
+    """
+    if "authorizedDevices" not in properties:
+        return
+    devices = properties["authorizedDevices"] or {}
+    if complete or properties["authorizedDevices"] is None:
+        authorized_devices.replace(devices)
+    else:
+        authorized_devices.patch(devices)
+
+
+def watch_desired_properties(client):
+    global desired_properties
+    if authorized_devices_from_twin:
+        identity = f"{os.environ['IOTEDGE_DEVICEID']}/{os.environ['IOTEDGE_MODULEID']}"
+        desired_properties = twin.DesiredProperties(client, identity, on_desired_properties)
+
+
+# handles the messages sent to the translated devices, when enabled.
+device_commands = None
+command_router = None
+
+
+def set_reporting_interval(device_id, interval_ms):
+    """ Sets the minimum time between two readings of a device sent upstream, None or 0
+    to go back to DEDUP_MIN_INTERVAL_MS.
+    """
+    if interval_ms is not None and (not isinstance(interval_ms, (int, float))
+                                    or interval_ms < 0):
+        raise ValueError(f"invalid reporting interval: {interval_ms!r}")
+    macs = authorized_devices.device_macs(device_id)
+    for mac in macs:
+        suppression.set_min_interval(mac, interval_ms / 1000 if interval_ms else None)
+    logging.info(f"reporting interval of {device_id} set to "
+                 f"{f'{interval_ms}ms' if interval_ms else 'the default'}.")
+    return macs
+
+
+def on_set_reporting_interval(device_id, payload):
+    """ The setReportingInterval direct method (or cloud-to-device command), with a
+    payload such as {"intervalMs": 30000}.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("expected an object payload")
+    interval_ms = payload.get("intervalMs")
+    if not set_reporting_interval(device_id, interval_ms):
+        return 404, {"message": f"unknown device {device_id}"}
+    return 200, {"intervalMs": interval_ms}
+
+
+def create_device_commands(pool):
+    global device_commands, command_router
+    if command_workers > 0:
+        command_router = commands.MessageRouter(command_workers, ingest_queue_size)
+        device_commands = commands.DeviceCommands(pool, authorized_devices, command_router)
+        device_commands.method("setReportingInterval", on_set_reporting_interval)
+        device_commands.desired_property("reportingIntervalMs", set_reporting_interval)
+    return device_commands
+
+
+def publish_upstream(publisher, mac, payload):
     """ The callback for when a message is received from a sensor.
     """
 
-    # This check for authorized devices should not be needed
-    # given that it should already be enforced by the ruuvitag library
-    if mac in authorized_devices:
-        device_id = authorized_devices[mac]
-        logging.info(
-            f"publishing message for {device_id} [{mac}]: {str(payload)}.")
-        client.publish(
-            f"$iothub/{device_id}/messages/events", str(payload), qos=1)
+    # This check for authorized devices should not be needed given that it should
+    # already be enforced by the ruuvitag library, but the registry may have changed.
+    advertisements.inc(mac=mac)
+    device_id = authorized_devices.lookup(mac)
+    if device_id is not None:
+        authorizations.inc(result="authorized")
+        classifier = authorized_devices.classifier(mac)
+        message_class = None if classifier is None else classifier.classify(payload)
+        alert = message_class == priority.ALERT
+        # the window statistics cover every measurement, including the ones the
+        # suppression policies hold back. Alerts are aggregated as well, but always sent.
+        if aggregator is not None and not aggregator.add(device_id, payload) and not alert:
+            return
+        if not suppression.accept(mac, payload, alert):
+            return
+
+        if sample_log() and logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                f"queueing {message_class or priority.TELEMETRY} message for {device_id} "
+                f"[{mac}]: {str(payload)} (1 in {sample_log.rate} messages logged).")
+        publisher.submit(device_id, payload, message_class)
+    else:
+        authorizations.inc(result="unknown")
+        if sample_log():
+            logging.warning(
+                f"ignoring message from an unknown sensor (MAC address: {mac}).")
+
+
+# computes the window statistics, when AGGREGATION is set.
+aggregator = None
+
+
+def create_aggregator(publisher):
+    global aggregator
+    if aggregation_groups:
+        aggregator = aggregation.WindowAggregator(aggregation_groups, publisher.submit)
+    return aggregator
+
+
+# last manufacturer data forwarded per sensor, in raw passthrough mode.
+last_raw_data = {}
+
+
+def publish_raw(publisher, mac, advertisement):
+    """ The callback for when an advertisement is received in raw passthrough mode.
+    Identical consecutive advertisements of a sensor are dropped.
+    """
+    advertisements.inc(mac=mac)
+    device_id = authorized_devices.lookup(mac)
+    if device_id is None:
+        authorizations.inc(result="unknown")
+        if sample_log():
+            logging.warning(
+                f"ignoring message from an unknown sensor (MAC address: {mac}).")
+        return
+    authorizations.inc(result="authorized")
+    data = advertisement[3]
+    if last_raw_data.get(mac) == data:
+        return
+    last_raw_data[mac] = data
+    publisher.submit(device_id, advertisement)
+
+
+def start_scanners():
+    """ Starts one scanner process per configured bluetooth adapter, if any.
+    """
+    if not ble_adapters:
+        return None
+    adapter_scanners = scanners.AdapterScanners(
+        ble_adapters, authorized_devices, raw_passthrough, ingest_queue_size)
+    adapter_scanners.start()
+    return adapter_scanners
+
+
+def scan(callback, adapter_scanners=None):
+    """ Listens for the authorized sensors, calling callback((mac, reading)) with
+    either a decoded reading or a raw advertisement, stamped with its capture time.
+    Blocks until the scanner stops. The registry is the scanner MAC filter, so its
+    updates apply right away.
+    """
+    if adapter_scanners is not None:
+        adapter_scanners.run(callback)
+    elif raw_passthrough:
+        raw.scan(lambda mac, advertisement: callback((mac, advertisement)),
+                 authorized_devices)
+    elif sensor_sources:
+        sources.SourceSet([sources.create_source(name) for name in sensor_sources],
+                          authorized_devices).run(callback)
     else:
-        logging.warning(
-            f"ignoring message from an unknown sensor (MAC address: {mac}).")
+        # imported here since it is slow to import, and scanning runs on its own thread.
+        from ruuvitag_sensor.ruuvi import RuuviTagSensor
+        RuuviTagSensor.get_datas(
+            lambda data: callback((data[0], timestamps.stamp(data[1]))), authorized_devices)
+
+
+def watch_file():
+    if not authorized_devices_file:
+        return None
+    watcher = FileWatcher(authorized_devices_file, authorized_devices,
+                          authorized_devices_file_poll)
+    watcher.start()
+    return watcher
+
+
+def dispatch(publisher, data):
+    timestamp = data[1][1] if raw_passthrough else data[1].get(timestamps.FIELD)
+    if timestamp is not None:
+        timestamps.observe("ingest", (timestamp,))
+    if raw_passthrough:
+        publish_raw(publisher, data[0], data[1])
+    else:
+        publish_upstream(publisher, data[0], data[1])
 
 
 def main():
+    started = time.monotonic()
     logging.info("Azure IoT Edge Protocol Translation Module (PTM) Sample")
+    # scanner processes are forked first, while the module has a single thread.
+    with startup_phase("scanner processes"):
+        adapter_scanners = start_scanners()
+    watcher = watch_file()
+
+    # scanning starts right away: readings are buffered by the ingest stage, whose
+    # workers start once the upstream connections and the publisher below are ready.
+    # Readings of a sensor are always handled by the same worker, in order.
+    ingest = pipeline.Stage("ingest", lambda data: dispatch(publisher, data),
+                            ingest_queue_size, ingest_overflow, ingest_workers,
+                            key=lambda data: data[0])
+    logging.info("listening for sensors data.")
+    scanner = threading.Thread(target=scan, args=(ingest.submit, adapter_scanners),
+                               name="scanner", daemon=True)
+    scanner.start()
 
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
     gateway_hostname = os.environ["IOTEDGE_GATEWAYHOSTNAME"]
 
-    # create a client from environment variables.
-    client = module_client.create_from_environment()
-    client.on_connect = on_connect
-    client.connect(gateway_hostname, port=8883)
+    # create the upstream connections from environment variables. The SAS tokens are
+    # signed while the trust bundle is fetched.
+    with startup_phase("upstream credentials"):
+        import connection_pool
+        pool = connection_pool.create_from_environment(
+            upstream_connections, sastoken_ttl, sastoken_renewal_ratio,
+            sastoken_signing_workers)
+    # the twin is read by the first connection, and the device commands answered by
+    # the connections, bypassing the store.
+    watch_desired_properties(pool.clients[0])
+    create_device_commands(pool)
+    # the capture to PUBACK latency is tracked by the publishers, or by the stores.
+    latency = timestamps.LatencyTracker()
+    if store_dir:
+        logging.info(f"storing outgoing messages in {store_dir}.")
+        pool = connection_pool.ConnectionPool([
+            store.StoreAndForward(
+                client,
+                store.SegmentQueue(os.path.join(store_dir, str(shard)),
+                                   store_segment_size, store_max_bytes, store_eviction),
+                drain_rate=store_drain_rate,
+                max_inflight=max_inflight_messages,
+                latency=latency)
+            for shard, client in enumerate(pool.clients)])
+    pool.on_connect = on_connect
+    pool.max_inflight_messages_set(max_inflight_messages)
 
-    def callback(data):
-        publish_upstream(client, data[0], data[1])
+    publisher = ShardedPublisher(pool,
+                                 max_inflight=max_inflight_messages,
+                                 encoder=encoder,
+                                 batch_factory=batch_factory,
+                                 classes=message_classes.values(),
+                                 latency=latency)
+    create_aggregator(publisher)
 
-    # start the mqtt client loop.
+    # start the mqtt client loops, which connect in the background.
     logging.info("starting mqtt client loop.")
-    client.loop_start()
+    if command_router is not None:
+        command_router.start()
+    pool.connect(gateway_hostname, port=8883)
+    pool.loop_start()
+    publisher.start()
+    if aggregator is not None:
+        aggregator.start()
+    ingest.start()
+    logging.info(f"startup: ready in {time.monotonic() - started:.3f}s.")
+
+    scanner.join()
+
+    ingest.stop()
+    if aggregator is not None:
+        aggregator.stop()
+    publisher.stop()
+    if command_router is not None:
+        command_router.stop()
+    if watcher is not None:
+        watcher.stop()
+    logging.info("exiting.")
+
+
+async def main_async():
+    started = time.monotonic()
+    logging.info("Azure IoT Edge Protocol Translation Module (PTM) Sample (asyncio)")
+    # scanner processes are forked first, while the module has a single thread.
+    with startup_phase("scanner processes"):
+        adapter_scanners = start_scanners()
+    watcher = watch_file()
 
-    # listening for sensors data.
+    loop = asyncio.get_event_loop()
+    readings = asyncio.Queue(maxsize=ingest_queue_size)
+    pipeline.queue_depth.add_function(lambda: {(("stage", "ingest"),): readings.qsize()})
+
+    def callback(data):
+        # runs on the scanning thread.
+        if ingest_overflow == pipeline.BLOCK:
+            asyncio.run_coroutine_threadsafe(readings.put(data), loop).result()
+        else:
+            loop.call_soon_threadsafe(
+                pipeline.offer, readings, data, ingest_overflow, "ingest")
+
+    # the ruuvitag library only has a blocking API, so it scans on an executor thread.
+    # Scanning starts right away, readings wait in the queue until the client is ready.
     logging.info("listening for sensors data.")
-    RuuviTagSensor.get_datas(callback, list(authorized_devices.keys()))
+    scanner = loop.run_in_executor(None, scan, callback, adapter_scanners)
 
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+    gateway_hostname = os.environ["IOTEDGE_GATEWAYHOSTNAME"]
+
+    # create a client from environment variables.
+    with startup_phase("upstream credentials"):
+        import async_module_client
+        client = await async_module_client.create_from_environment(
+            sastoken_ttl, sastoken_renewal_ratio, max_inflight_messages)
+    client.on_connect = on_connect
+    watch_desired_properties(client)
+    with startup_phase("upstream connection"):
+        await client.connect(gateway_hostname, port=8883)
+
+    publisher = AsyncBatchingPublisher(client,
+                                       encoder=encoder,
+                                       batch_factory=batch_factory,
+                                       classes=message_classes.values(),
+                                       latency=timestamps.LatencyTracker())
+    create_aggregator(publisher)
+    logging.info(f"startup: ready in {time.monotonic() - started:.3f}s.")
+
+    while not (scanner.done() and readings.empty()):
+        try:
+            timeout = publisher.time_to_flush()
+            if aggregator is not None:
+                timeout = min(timeout, aggregator.time_to_emit())
+            data = await asyncio.wait_for(readings.get(), timeout)
+            dispatch(publisher, data)
+        except asyncio.TimeoutError:
+            pass
+        if aggregator is not None:
+            aggregator.emit_due()
+        await publisher.flush_due()
+
+    if aggregator is not None:
+        aggregator.emit_due()
+    await publisher.flush_due(force=True)
+    await client.disconnect()
+    if watcher is not None:
+        watcher.stop()
     logging.info("exiting.")
 
 
 if __name__ == "__main__":
-    main()
+    if async_client:
+        asyncio.run(main_async())
+    else:
+        main()
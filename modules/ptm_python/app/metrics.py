@@ -0,0 +1,188 @@
+"""This module contains lightweight, thread-safe counters, gauges and histograms used
+to instrument the protocol translation pipeline, and an HTTP endpoint exposing them
+in the Prometheus text format.
+"""
+
+import bisect
+import http.server
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    """A monotonically increasing counter, optionally split by label values.
+    """
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: int = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> int:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of all label sets and their values.
+        """
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge:
+    """A value read from a callable when the metrics are collected, optionally split by
+    label values. The callable returns either a number or a {labels tuple: value} dict.
+    """
+
+    def __init__(self, name: str, description: str = "", function=None):
+        self.name = name
+        self.description = description
+        self._functions = [function] if function is not None else []
+
+    def add_function(self, function):
+        """Adds a callable whose values are summed with the other callables' values.
+        """
+        self._functions.append(function)
+
+    def snapshot(self) -> dict:
+        values = {}
+        for function in self._functions:
+            value = function()
+            if not isinstance(value, dict):
+                value = {(): value}
+            for key, v in value.items():
+                values[key] = values.get(key, 0) + v
+        return values
+
+
+class Histogram:
+    """A cumulative histogram with fixed upper bounds, optionally split by label values.
+    """
+
+    def __init__(self, name: str, description: str = "", buckets=(1, 2, 5, 10, 20, 50, 100)):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # one slot per bucket plus +Inf, then sum and count.
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self) -> dict:
+        """Returns label sets mapped to (bucket counts, sum, count).
+        Bucket counts are not cumulative, the last one is the +Inf bucket.
+        """
+        with self._lock:
+            return {key: (series[:-2], series[-2], series[-1])
+                    for key, series in self._series.items()}
+
+
+class Registry:
+    """A named collection of metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        return self._get_or_create(name, lambda: Counter(name, description))
+
+    def gauge(self, name: str, description: str = "") -> Gauge:
+        return self._get_or_create(name, lambda: Gauge(name, description))
+
+    def histogram(self, name: str, description: str = "", buckets=None) -> Histogram:
+        def factory():
+            if buckets is None:
+                return Histogram(name, description)
+            return Histogram(name, description, buckets)
+        return self._get_or_create(name, factory)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def _get_or_create(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def exposition(self) -> str:
+        """Returns all the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics():
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            snapshot = metric.snapshot()
+            for key in sorted(snapshot):
+                if kind != "histogram":
+                    lines.append(f"{metric.name}{_labels(key)} {snapshot[key]}")
+                    continue
+                counts, total, count = snapshot[key]
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    labels = _labels(key + (("le", bound),))
+                    lines.append(f"{metric.name}_bucket{labels} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(key)} {total}")
+                lines.append(f"{metric.name}_count{_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key):
+    if not key:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in key)
+    return "{" + pairs + "}"
+
+
+# default registry shared by the whole module.
+REGISTRY = Registry()
+
+
+def start_http_server(port: int, registry: Registry = REGISTRY):
+    """Serves the metrics of the registry on http://0.0.0.0:{port}/metrics from a
+    background thread. Returns the server.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics endpoint: " + format, *args)
+
+    server = http.server.ThreadingHTTPServer(("", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"serving metrics on port {port}.")
+    return server
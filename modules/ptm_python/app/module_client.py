@@ -4,92 +4,318 @@ to create one from edge module environmet.
 
 import logging
 import os
-import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import paho.mqtt.client as mqtt
 import edge.sastoken as auth
 import edge.edge_hsm as edge_hsm
+import reconnect
+from metrics import REGISTRY
+from token_manager import TokenManager
+from token_renewal import TokenRenewalScheduler
+
+puback_latency = REGISTRY.histogram(
+    "ptm_upstream_puback_seconds", "Time between publishing a message and its acknowledgement",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+unacknowledged = REGISTRY.gauge(
+    "ptm_upstream_unacknowledged_messages", "Number of published messages not yet acknowledged")
+
+logger = logging.getLogger(__name__)
+
+
+class _Client(mqtt.Client):
+    """A paho client whose reconnect delays follow a reconnect.Backoff, instead of the
+    plain exponential backoff of paho, and which calls before_reconnect, if set, on the
+    network loop thread before every reconnect attempt.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backoff = reconnect.Backoff()
+        self.before_reconnect = None
+
+    def _reconnect_wait(self):
+        with self._reconnect_delay_mutex:
+            # paho clears the delay when a connection is accepted.
+            if self._reconnect_delay is None:
+                self.backoff.reset()
+            delay = self.backoff.next()
+            self._reconnect_min_delay = self._reconnect_max_delay = delay
+        super()._reconnect_wait()
+        if self.before_reconnect is not None:
+            self.before_reconnect()
 
 
 class ModuleClient:
     def __init__(self, hostname: str, device_id: str,
                  module_id: str, module_generation_id: str,
-                 workload_uri: str, api_version: str, sastoken_ttl: int):
+                 workload_uri: str, api_version: str, sastoken_ttl: int,
+                 renewal_ratio: float = 0.8, client_id: str = None, tokens=None):
+        """
+        :param tokens: An optional TokenManager minting and renewing the SAS token, and
+            whose signing mechanism is used. By default the client has its own.
+        """
         self._username = f"{hostname}/{device_id}/{module_id}/?api-version={api_version}"
 
-        # Use an HSM for authentication in the general case
-        hsm = edge_hsm.IoTEdgeHsm(
-            module_id=module_id,
-            generation_id=module_generation_id,
-            workload_uri=workload_uri,
-            api_version=api_version,
-        )
-
         # Create SasToken
         uri = _form_sas_uri(hostname=hostname,
                             device_id=device_id, module_id=module_id)
+        self._token_lock = threading.Lock()
+
+        # Use an HSM for authentication in the general case
+        if tokens is None:
+            hsm = edge_hsm.IoTEdgeHsm(
+                module_id=module_id,
+                generation_id=module_generation_id,
+                workload_uri=workload_uri,
+                api_version=api_version,
+            )
+        else:
+            hsm = tokens.signing_mechanism
 
-        self._token = auth.RenewableSasToken(
-            uri, hsm, ttl=sastoken_ttl)
+        # The trust bundle is fetched while the token is signed.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            server_verification_cert = executor.submit(hsm.get_certificate)
+            if tokens is None:
+                self._token = auth.RenewableSasToken(
+                    uri, hsm, ttl=sastoken_ttl)
 
-        # Create TLS context
-        server_verification_cert = hsm.get_certificate()
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-        context.load_verify_locations(cadata=server_verification_cert)
+                # Renew the token in the background before it expires.
+                self._token_renewal = TokenRenewalScheduler(
+                    self._token, self.refresh, renewal_ratio, name=module_id)
+            else:
+                self._token = tokens.token(uri)
+                self._token_renewal = tokens.schedule(
+                    self._token, self._set_password, name=client_id or module_id)
+            server_verification_cert = server_verification_cert.result()
 
-        # Create mqtt client
-        self._mqtt_client = mqtt.Client(client_id=f"{device_id}/{module_id}")
+        # Create TLS context, kept for all the connections so they resume the TLS session.
+        # The trust bundle is checked for a new certificate before reconnecting.
+        self._hsm = hsm
+        self._ssl_context = reconnect.create_ssl_context(server_verification_cert)
+        self._reconnect_failed = False
+
+        # Create mqtt client. The session is persistent, so the broker keeps the
+        # subscriptions and the QoS 1 messages in flight across reconnects.
+        self.client_id = client_id or f"{device_id}/{module_id}"
+        self._mqtt_client = _Client(client_id=self.client_id, clean_session=False)
         self._mqtt_client.username_pw_set(self._username, str(self._token))
-        self._mqtt_client.tls_set_context(context)
+        self._mqtt_client.tls_set_context(self._ssl_context)
+        self._mqtt_client.before_reconnect = self._reload_trust_bundle
+
+        self._connection_timer = reconnect.ConnectionTimer(self.client_id)
+        self._connect_started = None
+        self._on_connect = None
+        self._on_disconnect = None
+        self._on_message = None
+        self._mqtt_client.on_connect = self._handle_connect
+        self._mqtt_client.on_disconnect = self._handle_disconnect
+
+        # publish time of the unacknowledged messages, by mid.
+        self._publish_times = {}
+        self._on_publish = None
+        self._mqtt_client.on_publish = self._handle_publish
+        unacknowledged.add_function(
+            lambda: {(("client", self.client_id),): len(self._publish_times)})
 
     def refresh(self):
-        self._token.refresh()
-        self._mqtt_client.username_pw_set(self._username, str(self._token))
+        """Renews the SAS token and sets it as the password used by the next (re)connect.
+        """
+        with self._token_lock:
+            self._token.refresh()
+            self._mqtt_client.username_pw_set(self._username, str(self._token))
+
+    def _set_password(self):
+        with self._token_lock:
+            self._mqtt_client.username_pw_set(self._username, str(self._token))
 
     def connect(self, host: str, port: int = 1883, keepalive: int = 60):
-        """Connect to a remote broker.
+        """Connect to a remote broker. Does not block: the connection is made by the
+        network loop thread, see loop_start, which also reconnects after a connection
+        loss with a jittered exponential backoff.
         """
-        self._mqtt_client.connect(host, port, keepalive)
+        self._connect_started = time.monotonic()
+        self._mqtt_client.connect_async(host, port, keepalive)
+
+    def disconnect(self):
+        """Disconnect from the broker and stop renewing the SAS token.
+        """
+        self._token_renewal.stop()
+        self._mqtt_client.disconnect()
 
     def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
-        """Publish a message on a topic.
+        """Publish a message on a topic. Returns a paho.mqtt.client.MQTTMessageInfo.
+        """
+        start = time.monotonic()
+        info = self._mqtt_client.publish(topic, payload, qos, retain)
+        if qos > 0:
+            self._publish_times[info.mid] = start
+            # the acknowledgement may have been handled before the time was recorded.
+            if info.is_published():
+                self._publish_times.pop(info.mid, None)
+        return info
+
+    def subscribe(self, topic, qos: int = 0):
+        """Subscribe to a topic, or to a list of (topic, qos) tuples in one request.
+        See paho.mqtt.client.subscribe
         """
-        self._mqtt_client.publish(topic, payload, qos, retain)
+        return self._mqtt_client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic):
+        """Unsubscribe from a topic, or from a list of topics in one request.
+        See paho.mqtt.client.unsubscribe
+        """
+        return self._mqtt_client.unsubscribe(topic)
+
+    def message_callback_add(self, sub: str, callback):
+        """Register a callback, called with this client, for the messages received on
+        the topics matching sub. See paho.mqtt.client.message_callback_add
+        """
+
+        # wrap callback to replace mqtt_client with module_client.
+        def wrapper(client, userdata, message):
+            callback(self, userdata, message)
+
+        self._mqtt_client.message_callback_add(sub, wrapper)
+
+    @property
+    def on_message(self):
+        """If implemented, called when a message matching no message_callback_add
+        subscription is received."""
+        return self._on_message
+
+    @on_message.setter
+    def on_message(self, func):
+        """ Define the message callback implementation, called with this client.
+        See paho.mqtt.client.on_message
+        """
+        self._on_message = func
+        if func is None:
+            self._mqtt_client.on_message = None
+        else:
+            self._mqtt_client.on_message = \
+                lambda client, userdata, message: func(self, userdata, message)
 
     @property
     def on_connect(self):
         """If implemented, called when the broker responds to our connection
         request."""
-        return self._mqtt_client.on_connect
+        return self._on_connect
 
     @on_connect.setter
     def on_connect(self, func):
-        """ Define the connect callback implementation. See paho.mqtt.client.on_connect
+        """ Define the connect callback implementation, called with this client.
+        See paho.mqtt.client.on_connect
         """
+        self._on_connect = func
 
-        # wrap on_connect to replace mqtt_client with module_client.
-        def callback(client, userdata, flags, rc):
-            func(self, userdata, flags, rc)
+    def _reload_trust_bundle(self):
+        """Trusts the certificate of the current trust bundle, so a rotated edgeHub
+        certificate authority does not prevent reconnecting. The cached trust bundle is
+        fetched again once expired, and right away after a failed attempt.
+        """
+        max_age = 0 if self._reconnect_failed else None
+        # cleared by the connection, if it succeeds.
+        self._reconnect_failed = True
+        try:
+            certificate = self._hsm.get_certificate(max_age)
+        except OSError:
+            logger.exception(f"{self.client_id} failed to get the trust bundle.")
+            return
+        if self._ssl_context.trust(certificate):
+            logger.info(f"{self.client_id} trusts the new trust bundle certificate.")
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._reconnect_failed = False
+            self._ssl_context.save_session(client.socket())
+            elapsed = self._connection_timer.connected()
+            if elapsed is not None:
+                logger.info(f"{self.client_id} reconnected after {elapsed:.3f}s.")
+            elif self._connect_started is not None:
+                logger.info(f"{self.client_id} connected in "
+                            f"{time.monotonic() - self._connect_started:.3f}s.")
+                self._connect_started = None
+        if self._on_connect is not None:
+            self._on_connect(self, userdata, flags, rc)
+
+    @property
+    def on_publish(self):
+        """If implemented, called when a message has been sent to the broker
+        (for QoS 1 that is when the PUBACK is received)."""
+        return self._on_publish
+
+    @on_publish.setter
+    def on_publish(self, func):
+        """ Define the publish callback implementation, called with this client.
+        See paho.mqtt.client.on_publish
+        """
+        self._on_publish = func
 
-        self._mqtt_client.on_connect = callback
+    def _handle_publish(self, client, userdata, mid):
+        start = self._publish_times.pop(mid, None)
+        if start is not None:
+            puback_latency.observe(time.monotonic() - start)
+        if self._on_publish is not None:
+            self._on_publish(self, userdata, mid)
+
+    @property
+    def on_disconnect(self):
+        """If implemented, called when the client disconnects from the broker."""
+        return self._on_disconnect
+
+    @on_disconnect.setter
+    def on_disconnect(self, func):
+        """ Define the disconnect callback implementation, called with this client.
+        See paho.mqtt.client.on_disconnect
+        """
+        self._on_disconnect = func
+
+    def _handle_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            logger.warning(f"{self.client_id} disconnected with result code {rc}.")
+            self._connection_timer.disconnected()
+        if self._on_disconnect is not None:
+            self._on_disconnect(self, userdata, rc)
+
+    def max_inflight_messages_set(self, inflight: int):
+        """Set the maximum number of QoS>0 messages that can be part way through their
+        network flow at once. See paho.mqtt.client.max_inflight_messages_set
+        """
+        self._mqtt_client.max_inflight_messages_set(inflight)
 
     def loop_forever(self):
         """This function call loop_forever() on inner mqtt client. See paho.mqtt.client.loop_forever
+        The SAS token renewal is started as well.
         """
-        self._mqtt_client.loop_forever()
+        self._token_renewal.start()
+        self._mqtt_client.loop_forever(retry_first_connection=True)
 
     def loop_start(self):
         """This function call loop_start() on inner mqtt client. See paho.mqtt.client.loop_start
+        The SAS token renewal is started as well.
         """
+        self._token_renewal.start()
         self._mqtt_client.loop_start()
 
 
-def create_from_environment(sastoken_ttl: int = 3600) -> ModuleClient:
+def create_from_environment(sastoken_ttl: int = 3600, renewal_ratio: float = 0.8,
+                            shard: int = None, tokens=None) -> ModuleClient:
     """Creates a paho.mqtt.client from edge module environmet. The returned object
     has proper authentication context (username and password) already set.
 
     :param int sastoken_ttl: The time to live (in seconds) for the created SasToken used for
         authentication. Default is 3600 seconds (1 hour)
+    :param float renewal_ratio: The fraction of sastoken_ttl after which the token is
+        renewed in the background. Default is 0.8
+    :param int shard: When several connections are opened with the module identity, the
+        index of this one. It is appended to the MQTT client id to keep them unique.
+        edgeHub does not accept several connections of an identity, whatever their
+        client ids, see connection_pool.create_from_environment.
+    :param tokens: An optional TokenManager, see create_token_manager. Its ttl and
+        renewal ratio apply instead of sastoken_ttl and renewal_ratio.
     """
 
     # Get the Edge container variables
@@ -100,10 +326,31 @@ def create_from_environment(sastoken_ttl: int = 3600) -> ModuleClient:
     workload_uri = os.environ["IOTEDGE_WORKLOADURI"]
     api_version = os.environ["IOTEDGE_APIVERSION"]
 
+    client_id = None if shard is None else f"{device_id}/{module_id}/{shard}"
+
     client = ModuleClient(hostname, device_id, module_id,
-                          module_generation_id, workload_uri, api_version, sastoken_ttl)
+                          module_generation_id, workload_uri, api_version, sastoken_ttl,
+                          renewal_ratio, client_id, tokens)
     return client
 
 
+def create_token_manager(sastoken_ttl: int = 3600, renewal_ratio: float = 0.8,
+                         max_workers: int = 4) -> TokenManager:
+    """Creates a TokenManager signing with the HSM of the edge module environment,
+    to share between the clients of the module.
+
+    :param int sastoken_ttl: The time to live (in seconds) of the SasTokens.
+    :param float renewal_ratio: The fraction of sastoken_ttl after which tokens are renewed.
+    :param int max_workers: The maximum number of concurrent signing requests.
+    """
+    hsm = edge_hsm.IoTEdgeHsm(
+        module_id=os.environ["IOTEDGE_MODULEID"],
+        generation_id=os.environ["IOTEDGE_MODULEGENERATIONID"],
+        workload_uri=os.environ["IOTEDGE_WORKLOADURI"],
+        api_version=os.environ["IOTEDGE_APIVERSION"],
+    )
+    return TokenManager(hsm, sastoken_ttl, renewal_ratio, max_workers)
+
+
 def _form_sas_uri(hostname, device_id, module_id) -> str:
     return f"{hostname}/devices/{device_id}/modules/{module_id}"
@@ -0,0 +1,166 @@
+"""This module contains the bounded buffers decoupling the BLE scanner from the
+upstream publishing, so that a slow upstream connection never stalls the radio.
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# overflow policies, what happens to an item submitted to a full buffer.
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+
+queue_depth = REGISTRY.gauge(
+    "ptm_pipeline_queue_depth", "Number of items waiting in a pipeline stage by stage")
+dropped = REGISTRY.counter(
+    "ptm_pipeline_dropped_total", "Number of items dropped by a full pipeline stage")
+
+
+class RingBuffer:
+    """A bounded FIFO buffer for one producer and one consumer thread.
+
+    This is not a lock-free ring: items are kept in a collections.deque, whose append
+    and popleft are atomic under the GIL, and a threading.Semaphore counting the items
+    wakes up the consumer (another one counts the free slots with the block policy).
+    The semaphores take their internal lock only for the time of a counter update, so
+    the producer only waits for long when the buffer is full with the block policy.
+    """
+
+    def __init__(self, capacity: int, overflow: str = DROP_OLDEST):
+        """
+        :param int capacity: The maximum number of items.
+        :param str overflow: What to do with an item put in a full buffer: drop-oldest
+            evicts the oldest item, drop-newest drops the new one and block waits.
+        """
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        self.capacity = capacity
+        self.overflow = overflow
+        self._items = collections.deque(maxlen=capacity if overflow == DROP_OLDEST else None)
+        self._available = threading.Semaphore(0)
+        self._slots = threading.Semaphore(capacity) if overflow == BLOCK else None
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item) -> bool:
+        """Adds an item. Returns False if an item, the new or the oldest one, was dropped.
+        """
+        complete = True
+        if self._slots is not None:
+            self._slots.acquire()
+        elif len(self._items) >= self.capacity:
+            if self.overflow == DROP_NEWEST:
+                return False
+            # the deque evicts the oldest item.
+            complete = False
+        self._items.append(item)
+        self._available.release()
+        return complete
+
+    def get(self, timeout: float = None):
+        """Removes and returns the oldest item.
+
+        :raises: queue.Empty if there is none after timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not self._available.acquire(timeout=remaining):
+                raise queue.Empty
+            try:
+                item = self._items.popleft()
+            except IndexError:
+                # the item this count was for has been evicted.
+                continue
+            if self._slots is not None:
+                self._slots.release()
+            return item
+
+
+class Stage:
+    """Calls handler(item) for the submitted items on worker threads, each draining
+    its own RingBuffer. Items with the same key always go to the same worker, so
+    they are handled in order.
+    """
+
+    def __init__(self, name: str, handler, capacity: int = 1000,
+                 overflow: str = DROP_OLDEST, workers: int = 1, key=None):
+        """
+        :param str name: The stage name, used in logs and metrics.
+        :param handler: The function called with every item.
+        :param int capacity: The maximum number of items waiting, across all workers.
+        :param str overflow: The overflow policy, see RingBuffer.
+        :param int workers: The number of worker threads.
+        :param key: A function returning the key of an item, used to pick its worker.
+        """
+        self.name = name
+        self.overflow = overflow
+        self._handler = handler
+        self._key = key
+        capacity = max(1, -(-capacity // workers))
+        self._buffers = [RingBuffer(capacity, overflow) for _ in range(workers)]
+        self._threads = []
+        self._running = False
+        queue_depth.add_function(
+            lambda: {(("stage", name),): sum(len(buffer) for buffer in self._buffers)})
+
+    def submit(self, item):
+        """Queues an item for a worker. Depending on the overflow policy, waits while
+        the worker's buffer is full or drops an item.
+        """
+        if len(self._buffers) == 1 or self._key is None:
+            buffer = self._buffers[0]
+        else:
+            buffer = self._buffers[hash(self._key(item)) % len(self._buffers)]
+        if not buffer.put(item):
+            dropped.inc(stage=self.name, policy=self.overflow)
+
+    def start(self):
+        self._running = True
+        for index, buffer in enumerate(self._buffers):
+            thread = threading.Thread(target=self._run, args=(buffer,),
+                                      name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Handles the queued items, then stops the workers.
+        """
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def _run(self, buffer):
+        while self._running or len(buffer):
+            try:
+                item = buffer.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._handler(item)
+            except Exception:
+                logger.exception(f"{self.name} stage failed to handle an item.")
+
+
+def offer(items, item, overflow: str, stage: str) -> bool:
+    """Adds an item to a full or not asyncio.Queue, from the event loop thread,
+    applying a drop policy. Returns False if an item was dropped.
+    """
+    if not items.full():
+        items.put_nowait(item)
+        return True
+    dropped.inc(stage=stage, policy=overflow)
+    if overflow == DROP_NEWEST:
+        return False
+    items.get_nowait()
+    items.put_nowait(item)
+    return False
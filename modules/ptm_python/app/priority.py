@@ -0,0 +1,131 @@
+"""This module contains the message classes of the publish path: every reading is sent
+upstream in a class, such as alert or telemetry, with its own QoS level, batch window,
+buffer and drop policy, and the publisher sends the batches of the classes in order of
+priority.
+"""
+
+import pipeline
+
+# the built-in classes.
+ALERT = "alert"
+TELEMETRY = "telemetry"
+
+
+class MessageClass:
+    """The publishing settings of a class of messages.
+
+    Lower ``priority`` values are sent first. A class may only publish while fewer than
+    ``inflight_share`` of the publisher's max_inflight messages are waiting for a
+    PUBACK, so a congested link keeps room for the classes with a larger share: with
+    the defaults, telemetry is throttled at 80% of the window while alerts still go
+    through.
+    """
+
+    def __init__(self, name: str, priority: int = 0, qos: int = 1,
+                 max_batch_size: int = 20, max_delay: float = 1.0, capacity: int = 0,
+                 overflow: str = pipeline.DROP_OLDEST, inflight_share: float = 1.0):
+        """
+        :param str name: The class name.
+        :param int priority: The class priority, 0 being the highest.
+        :param int qos: The QoS level the batches of the class are published with.
+        :param int max_batch_size: Maximum number of readings in a single message.
+        :param float max_delay: Maximum time (in seconds) a reading is held before
+            publishing, 0 to publish it right away.
+        :param int capacity: Maximum number of readings of the class buffered by a
+            publisher, 0 for no limit.
+        :param str overflow: What to do with a reading when the buffer is full:
+            drop-oldest drops the oldest batch, drop-newest the new reading.
+        :param float inflight_share: Fraction of max_inflight the class may use.
+        """
+        if qos not in (0, 1):
+            raise ValueError(f"invalid QoS level {qos} for message class {name}")
+        if overflow not in (pipeline.DROP_OLDEST, pipeline.DROP_NEWEST):
+            raise ValueError(f"unknown overflow policy {overflow} for message class {name}")
+        if not 0 < inflight_share <= 1:
+            raise ValueError(f"inflight share of message class {name} must be in ]0, 1]")
+        self.name = name
+        self.priority = priority
+        self.qos = qos
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.capacity = capacity
+        self.overflow = overflow
+        self.inflight_share = inflight_share
+
+    def __repr__(self):
+        return f"MessageClass({self.name}, priority={self.priority}, qos={self.qos})"
+
+    def inflight_limit(self, max_inflight: int) -> int:
+        return max(1, int(max_inflight * self.inflight_share))
+
+    def updated(self, config: dict):
+        """Returns a copy of the class with the settings of its JSON configuration, such
+        as {"qos": 0, "maxDelayMs": 5000, "capacity": 10000, "overflow": "drop-oldest"}.
+        """
+        return MessageClass(
+            self.name,
+            int(config.get("priority", self.priority)),
+            int(config.get("qos", self.qos)),
+            int(config.get("maxBatchSize", self.max_batch_size)),
+            int(config["maxDelayMs"]) / 1000 if "maxDelayMs" in config else self.max_delay,
+            int(config.get("capacity", self.capacity)),
+            config.get("overflow", self.overflow),
+            float(config.get("inflightShare", self.inflight_share)))
+
+
+def create_classes(config: dict, max_batch_size: int = 20, max_delay: float = 1.0) -> dict:
+    """Returns the message classes by name: the built-in alert and telemetry classes,
+    updated and completed by config, a map of class name to settings (see
+    MessageClass.updated).
+
+    :param dict config: The class settings, by class name.
+    :param int max_batch_size: The default maximum batch size.
+    :param float max_delay: The default batch window (in seconds) of telemetry, and of
+        the classes defined by config.
+    """
+    classes = {
+        ALERT: MessageClass(ALERT, 0, 1, max_batch_size, 0, 1000, pipeline.DROP_OLDEST, 1.0),
+        TELEMETRY: MessageClass(TELEMETRY, 1, 1, max_batch_size, max_delay, 0,
+                                pipeline.DROP_OLDEST, 0.8),
+    }
+    for name, settings in config.items():
+        base = classes.get(name) or MessageClass(
+            name, 1, 1, max_batch_size, max_delay, 0, pipeline.DROP_OLDEST, 0.8)
+        classes[name] = base.updated(settings)
+    return classes
+
+
+class DeviceClassifier:
+    """Picks the class of the readings of a device: its configured class, or alert for
+    readings outside the thresholds of the device.
+    """
+
+    __slots__ = ("message_class", "thresholds")
+
+    def __init__(self, message_class: str = TELEMETRY, thresholds: dict = None):
+        """
+        :param str message_class: The class of the device readings.
+        :param dict thresholds: The (min, max) bounds of the fields of a normal
+            reading, by field name, either bound being None when not checked.
+        """
+        self.message_class = message_class
+        self.thresholds = tuple((thresholds or {}).items())
+
+    @classmethod
+    def from_dict(cls, config: dict):
+        """Creates a classifier from the JSON configuration of a device, such as
+        {"deviceId": "cold-room-1", "class": "telemetry",
+        "alerts": {"temperature": {"min": 2, "max": 8}}}.
+        """
+        thresholds = {field: (bounds.get("min"), bounds.get("max"))
+                      for field, bounds in config.get("alerts", {}).items()}
+        return cls(config.get("class", TELEMETRY), thresholds)
+
+    def classify(self, reading) -> str:
+        for field, (low, high) in self.thresholds:
+            value = reading.get(field)
+            if value is None:
+                continue
+            if (low is not None and value < low) or (high is not None and value > high):
+                return ALERT
+        return self.message_class
@@ -0,0 +1,458 @@
+"""This module contains a batching publisher which groups sensor readings per device
+and sends each group upstream as a single encoded message, instead of one MQTT
+message per reading. Readings are batched per message class (see the priority
+module), and the batches of the classes are sent in order of priority.
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+import pipeline
+import timestamps
+from encoding import JsonEncoder, events_topic
+from metrics import REGISTRY
+from priority import TELEMETRY, MessageClass
+
+logger = logging.getLogger(__name__)
+
+flush_size = REGISTRY.histogram(
+    "ptm_publisher_flush_size", "Number of readings per published batch",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+flush_reason = REGISTRY.counter(
+    "ptm_publisher_flushes_total", "Number of published batches by flush reason")
+readings_published = REGISTRY.counter(
+    "ptm_publisher_readings_total", "Number of readings handed to the upstream client")
+encode_latency = REGISTRY.histogram(
+    "ptm_publisher_encode_seconds", "Time spent encoding a batch",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025))
+buffered_readings = REGISTRY.gauge(
+    "ptm_publisher_buffered_readings", "Number of readings waiting to be published")
+# the IoT Hub message property holding the time a message was created on the device.
+CREATION_TIME = "iothub-creation-time-utc"
+
+dropped_readings = REGISTRY.counter(
+    "ptm_publisher_dropped_readings_total",
+    "Number of readings dropped by a full message class buffer by class and policy")
+failed_batches = REGISTRY.counter(
+    "ptm_publisher_failed_batches_total",
+    "Number of batches dropped because encoding or publishing them failed, by class")
+
+
+class _ClassBatches:
+    """The batches of the devices in one message class, and the ones ready to be
+    published, oldest first.
+    """
+
+    def __init__(self, message_class: MessageClass, batch_factory):
+        self.message_class = message_class
+        self._batch_factory = batch_factory
+        # device_id -> (deadline, batch)
+        self.batches = {}
+        # full or due batches: (device_id, batch, reason)
+        self.ready = collections.deque()
+        self.buffered = 0
+
+    def add(self, device_id, reading, now) -> bool:
+        """Adds a reading to the batch of a device. Returns True if a batch was started
+        or is ready, which may change when the next batch is due.
+        """
+        message_class = self.message_class
+        if message_class.capacity and self.buffered >= message_class.capacity:
+            if message_class.overflow == pipeline.DROP_NEWEST:
+                dropped_readings.inc(message_class=message_class.name,
+                                     policy=message_class.overflow)
+                return False
+            self._drop_oldest()
+
+        entry = self.batches.get(device_id)
+        started = entry is None
+        if started:
+            entry = self.batches[device_id] = (
+                now + message_class.max_delay, self._batch_factory())
+        batch = entry[1]
+        batch.append(reading)
+        self.buffered += 1
+        if len(batch) >= message_class.max_batch_size:
+            # the next reading of the device starts a new batch.
+            del self.batches[device_id]
+            self.ready.append((device_id, batch, "size"))
+            return True
+        return started
+
+    def take_due(self, now, force: bool = False):
+        """Moves the batches past their deadline (all of them when force is set) to the
+        ready ones.
+        """
+        for device_id, (deadline, batch) in list(self.batches.items()):
+            if force or deadline <= now:
+                del self.batches[device_id]
+                self.ready.append((device_id, batch, "shutdown" if force else "time"))
+
+    def next_deadline(self):
+        if not self.batches:
+            return None
+        return min(deadline for deadline, _ in self.batches.values())
+
+    def pop(self):
+        """Removes and returns the oldest ready batch, as (device_id, batch, reason).
+        """
+        item = self.ready.popleft()
+        self.buffered -= len(item[1])
+        return item
+
+    def _drop_oldest(self):
+        if self.ready:
+            _, batch, _ = self.ready.popleft()
+        else:
+            device_id = min(self.batches, key=lambda key: self.batches[key][0])
+            batch = self.batches.pop(device_id)[1]
+        self.buffered -= len(batch)
+        dropped_readings.inc(len(batch), message_class=self.message_class.name,
+                             policy=pipeline.DROP_OLDEST)
+
+
+def _create_queues(classes, default_class, batch_factory, max_batch_size, max_delay, qos):
+    if not classes:
+        classes = [MessageClass(TELEMETRY, 0, qos, max_batch_size, max_delay)]
+        default_class = TELEMETRY
+    queues = sorted((_ClassBatches(message_class, batch_factory) for message_class in classes),
+                    key=lambda queue: queue.message_class.priority)
+    by_name = {queue.message_class.name: queue for queue in queues}
+    if default_class not in by_name:
+        raise ValueError(f"unknown default message class: {default_class}")
+    return queues, by_name, by_name[default_class]
+
+
+def _failed(message_class, device_id, batch):
+    # called from an exception handler.
+    failed_batches.inc(message_class=message_class.name)
+    logger.exception(f"dropping a {message_class.name} batch of {len(batch)} reading(s) "
+                     f"for {device_id}, it could not be published.")
+
+
+def _message_properties(times):
+    # the creation time of a batch is the capture time of its oldest reading.
+    if not times:
+        return None
+    return {CREATION_TIME: timestamps.creation_time(min(times))}
+
+
+class BatchingPublisher:
+    """Coalesces readings per message class and device id and publishes them in batches.
+
+    A device batch is flushed when it reaches the ``max_batch_size`` readings of its
+    class or when its oldest reading is the ``max_delay`` seconds of its class old,
+    whichever comes first. At most ``max_inflight`` batches are waiting for a PUBACK at
+    any time, and a class only publishes while fewer than its share of them are: once
+    its limit is reached, the batches of the class wait for acknowledgements while the
+    classes with a larger share keep going. Ready batches are sent in order of class
+    priority.
+
+    Every message carries the capture time of its oldest reading as its
+    iothub-creation-time-utc property, and the latency from capture to PUBACK of the
+    QoS 1 messages is reported to the ``latency`` tracker: by the publisher, or by the
+    client when it sends the messages later (a store.StoreAndForward), in which case
+    the capture times are handed to its publish.
+
+    A batch is a list of readings unless a ``batch_factory`` is given, in which case it
+    is whatever the factory returns: any object with append and len, that the encoder
+    knows how to encode.
+    """
+
+    def __init__(self, client, max_batch_size: int = 20, max_delay: float = 1.0,
+                 max_inflight: int = 20, qos: int = 1, encoder=None, batch_factory=list,
+                 classes=None, default_class: str = TELEMETRY, latency=None):
+        """
+        :param client: The upstream client, anything with a ModuleClient compatible publish.
+        :param int max_batch_size: Maximum number of readings in a single message.
+        :param float max_delay: Maximum time (in seconds) a reading is held before publishing.
+        :param int max_inflight: Maximum number of unacknowledged messages.
+        :param int qos: The QoS level used to publish batches.
+        :param encoder: The payload encoder (see the encoding module), JSON by default.
+        :param batch_factory: A callable creating an empty batch, list by default.
+        :param classes: The MessageClasses, which replace max_batch_size, max_delay and
+            qos. All the readings form a single class if None.
+        :param str default_class: The class of the readings submitted without one.
+        :param timestamps.LatencyTracker latency: The tracker of the capture to PUBACK
+            latency, optional.
+        """
+        self._client = client
+        self._encoder = encoder or JsonEncoder()
+        self._latency = latency
+        self._client_stores = getattr(client, "stores_capture_times", False)
+        self.max_inflight = max_inflight
+        self._queues, self._classes, self._default = _create_queues(
+            classes, default_class, batch_factory, max_batch_size, max_delay, qos)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._inflight = []
+        # (device_id, capture times) of the messages in flight, by mid.
+        self._captures = {}
+        self._running = False
+        self._thread = None
+        buffered_readings.add_function(self._buffered)
+
+    def start(self):
+        """Starts the background flush thread.
+        """
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="batching-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, flush: bool = True):
+        """Stops the flush thread, optionally publishing everything still buffered.
+        """
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            with self._lock:
+                for queue in self._queues:
+                    queue.take_due(time.monotonic(), force=True)
+            while any(queue.ready for queue in self._queues):
+                self._publish_next()
+
+    def submit(self, device_id: str, reading, message_class: str = None):
+        """Adds a reading to the batch of the given device, in the given class or the
+        default one. Never blocks on the network.
+        """
+        queue = self._classes.get(message_class, self._default)
+        with self._lock:
+            if queue.add(device_id, reading, time.monotonic()):
+                # a new deadline may be earlier than the one the flush thread sleeps on.
+                self._wakeup.notify()
+
+    def on_publish(self, client, userdata, mid):
+        """Must be called when the upstream client receives a PUBACK.
+        """
+        with self._lock:
+            capture = self._captures.pop(mid, None)
+            self._wakeup.notify()
+        if capture is not None:
+            self._latency.acknowledged(*capture)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                for queue in self._queues:
+                    queue.take_due(now)
+            self._publish_next()
+
+    def _publish_next(self):
+        """Publishes the ready batch of the highest priority class with an in-flight
+        slot, or waits for one, for an acknowledgement or for the next deadline.
+        """
+        with self._lock:
+            acknowledged = self._prune_inflight()
+            queue = next((queue for queue in self._queues if queue.ready and len(self._inflight)
+                          < queue.message_class.inflight_limit(self.max_inflight)), None)
+            if queue is None:
+                if any(queue.ready for queue in self._queues):
+                    # the timeout guards against an acknowledgement racing the check above.
+                    self._wakeup.wait(1.0)
+                elif self._running:
+                    timeout = self._next_deadline() - time.monotonic()
+                    if timeout > 0:
+                        self._wakeup.wait(timeout)
+            else:
+                device_id, batch, reason = queue.pop()
+        for capture in acknowledged:
+            self._latency.acknowledged(*capture)
+        if queue is not None:
+            self._publish(queue.message_class, device_id, batch, reason)
+
+    def _prune_inflight(self):
+        """Forgets the acknowledged messages. Returns the captures of the ones whose
+        acknowledgement was handled before their capture times were recorded.
+        """
+        inflight = []
+        acknowledged = []
+        for info in self._inflight:
+            if not info.is_published():
+                inflight.append(info)
+            elif self._captures:
+                capture = self._captures.pop(info.mid, None)
+                if capture is not None:
+                    acknowledged.append(capture)
+        self._inflight = inflight
+        return acknowledged
+
+    def _next_deadline(self):
+        deadlines = [deadline for deadline in (queue.next_deadline() for queue in self._queues)
+                     if deadline is not None]
+        return min(deadlines) if deadlines else time.monotonic() + 1.0
+
+    def _publish(self, message_class, device_id, batch, reason):
+        """Publishes a batch. A batch failing to encode or publish is dropped, so the
+        flush thread keeps publishing the others.
+        """
+        try:
+            self._send(message_class, device_id, batch, reason)
+        except Exception:
+            _failed(message_class, device_id, batch)
+
+    def _send(self, message_class, device_id, batch, reason):
+        start = time.monotonic()
+        payload = self._encoder.encode(batch)
+        encode_latency.observe(time.monotonic() - start)
+        times = timestamps.capture_times(batch)
+        timestamps.observe("publish", times)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"publishing {message_class.name} batch of {len(batch)} reading(s) "
+                         f"for {device_id} ({reason}).")
+        topic = events_topic(device_id, self._encoder, _message_properties(times))
+        if self._client_stores:
+            info = self._client.publish(topic, payload, qos=message_class.qos,
+                                        capture_times=times)
+        else:
+            info = self._client.publish(topic, payload, qos=message_class.qos)
+        if info is not None and message_class.qos > 0:
+            with self._lock:
+                self._inflight.append(info)
+                if times and self._latency is not None:
+                    self._captures[info.mid] = (device_id, times)
+
+        flush_size.observe(len(batch))
+        flush_reason.inc(reason=reason, message_class=message_class.name)
+        readings_published.inc(len(batch))
+
+    def _buffered(self):
+        return sum(queue.buffered for queue in self._queues)
+
+
+class ShardedPublisher:
+    """Runs one BatchingPublisher per connection of a ConnectionPool, so a connection
+    waiting for acknowledgements does not hold back the devices pinned to the others.
+    """
+
+    def __init__(self, pool, **options):
+        """
+        :param pool: The ConnectionPool to publish through.
+        :param options: BatchingPublisher options, applied to every shard.
+        """
+        self._pool = pool
+        self.publishers = []
+        for client in pool.clients:
+            publisher = BatchingPublisher(client, **options)
+            client.on_publish = publisher.on_publish
+            self.publishers.append(publisher)
+
+    def start(self):
+        for publisher in self.publishers:
+            publisher.start()
+
+    def stop(self, flush: bool = True):
+        for publisher in self.publishers:
+            publisher.stop(flush)
+
+    def submit(self, device_id: str, reading, message_class: str = None):
+        """Adds a reading to the batch of the given device, on its pinned connection.
+        """
+        self.publishers[self._pool.shard_index(device_id)].submit(
+            device_id, reading, message_class)
+
+
+class AsyncBatchingPublisher:
+    """The asyncio counterpart of BatchingPublisher, publishing through an
+    AsyncModuleClient. It has no thread of its own: the owner of the event loop calls
+    submit for every reading and awaits flush_due, at the latest after time_to_flush
+    seconds. flush_due waits while the client has max_inflight messages in flight, which
+    pushes back on whoever feeds the readings. Due batches are sent in order of class
+    priority; the in-flight shares of the classes do not apply, the client having a
+    single in-flight window.
+    """
+
+    def __init__(self, client, max_batch_size: int = 20, max_delay: float = 1.0,
+                 qos: int = 1, encoder=None, batch_factory=list, classes=None,
+                 default_class: str = TELEMETRY, latency=None):
+        """
+        :param client: The AsyncModuleClient to publish through.
+        :param int max_batch_size: Maximum number of readings in a single message.
+        :param float max_delay: Maximum time (in seconds) a reading is held before publishing.
+        :param int qos: The QoS level used to publish batches.
+        :param encoder: The payload encoder (see the encoding module), JSON by default.
+        :param batch_factory: A callable creating an empty batch, list by default.
+        :param classes: The MessageClasses, which replace max_batch_size, max_delay and
+            qos. All the readings form a single class if None.
+        :param str default_class: The class of the readings submitted without one.
+        :param timestamps.LatencyTracker latency: The tracker of the capture to PUBACK
+            latency, optional.
+        """
+        self._client = client
+        self._encoder = encoder or JsonEncoder()
+        self._latency = latency
+        self._queues, self._classes, self._default = _create_queues(
+            classes, default_class, batch_factory, max_batch_size, max_delay, qos)
+        buffered_readings.add_function(self._buffered)
+
+    def submit(self, device_id: str, reading, message_class: str = None):
+        """Adds a reading to the batch of the given device, in the given class or the
+        default one.
+        """
+        queue = self._classes.get(message_class, self._default)
+        queue.add(device_id, reading, time.monotonic())
+
+    def _buffered(self):
+        return sum(queue.buffered for queue in self._queues)
+
+    def time_to_flush(self) -> float:
+        """Returns the time (in seconds) until the next batch is due.
+        """
+        if any(queue.ready for queue in self._queues):
+            return 0
+        deadlines = [deadline for deadline in (queue.next_deadline() for queue in self._queues)
+                     if deadline is not None]
+        if not deadlines:
+            return max(queue.message_class.max_delay for queue in self._queues)
+        return max(0, min(deadlines) - time.monotonic())
+
+    async def flush_due(self, force: bool = False):
+        """Publishes the batches which are full or past their deadline (all of them when
+        force is set), highest priority class first.
+        """
+        now = time.monotonic()
+        for queue in self._queues:
+            queue.take_due(now, force)
+
+        for queue in self._queues:
+            message_class = queue.message_class
+            while queue.ready:
+                device_id, batch, reason = queue.pop()
+                try:
+                    await self._send(message_class, device_id, batch, reason)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # the batch is dropped, the others are still published.
+                    _failed(message_class, device_id, batch)
+
+    async def _send(self, message_class, device_id, batch, reason):
+        start = time.monotonic()
+        payload = self._encoder.encode(batch)
+        encode_latency.observe(time.monotonic() - start)
+        times = timestamps.capture_times(batch)
+        timestamps.observe("publish", times)
+        sent = await self._client.publish(
+            events_topic(device_id, self._encoder, _message_properties(times)),
+            payload, qos=message_class.qos)
+        if times and self._latency is not None and message_class.qos > 0:
+            sent.add_done_callback(
+                lambda _, device_id=device_id, times=times:
+                self._latency.acknowledged(device_id, times))
+        flush_size.observe(len(batch))
+        flush_reason.inc(reason=reason, message_class=message_class.name)
+        readings_published.inc(len(batch))
@@ -0,0 +1,122 @@
+"""This module contains the raw passthrough mode, which forwards the undecoded
+manufacturer data of BLE advertisements upstream, leaving the decoding to the cloud.
+
+Advertisements are read straight from the ruuvitag_sensor BLE adapter and copied
+into preallocated, fixed-size record buffers, so the ingest path does no decoding
+and creates no dict per message.
+"""
+
+import struct
+
+from encoding import CONTENT_TYPE
+from timestamps import CLOCK
+
+# maximum length of the data of a legacy advertisement.
+MAX_DATA_LENGTH = 31
+
+_MANUFACTURER_SPECIFIC_DATA = 0xFF
+_TIMESTAMP = struct.Struct("<Q")
+
+
+class RawBatch:
+    """A batch of raw advertisements in a preallocated buffer of fixed-size records::
+
+        uint8[6] mac
+        uint64   timestamp, in milliseconds since epoch
+        int8     rssi, in dBm
+        uint8    data length
+        uint8[31] manufacturer data, zero padded
+    """
+
+    record = struct.Struct(f"<6sQbB{MAX_DATA_LENGTH}s")
+
+    def __init__(self, capacity: int):
+        self._buffer = bytearray(self.record.size * capacity)
+        self._view = memoryview(self._buffer)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, advertisement):
+        """Copies an advertisement, a (mac, timestamp, rssi, data) tuple, in the buffer.
+        """
+        mac, timestamp, rssi, data = advertisement
+        self.record.pack_into(
+            self._buffer, self._count * self.record.size, mac, timestamp, rssi, len(data), data)
+        self._count += 1
+
+    def capture_times(self) -> list:
+        """Returns the timestamps of the advertisements, in milliseconds since epoch.
+        """
+        size = self.record.size
+        return [_TIMESTAMP.unpack_from(self._buffer, index * size + 6)[0]
+                for index in range(self._count)]
+
+    def view(self) -> memoryview:
+        """Returns a view on the records written so far.
+        """
+        return self._view[:self._count * self.record.size]
+
+
+class RawEncoder:
+    """Encodes a RawBatch as a header (format version, record count) followed by its
+    records.
+    """
+
+    name = "raw"
+    version = 1
+
+    _header = struct.Struct("<BH")
+
+    def __init__(self):
+        self.properties = {CONTENT_TYPE: "application/octet-stream",
+                           "format": f"ruuvi-raw-v{self.version}"}
+
+    def encode(self, batch: RawBatch) -> bytes:
+        return self._header.pack(self.version, len(batch)) + batch.view()
+
+
+def parse_advertisement(report: bytes):
+    """Returns (manufacturer data, rssi) from the part of an HCI LE advertising report
+    following the address: data length, advertising data structures, rssi. The
+    manufacturer data is None when the advertisement has none.
+    """
+    length = report[0]
+    end = 1 + length
+    rssi = report[end] - 256 if report[end] > 127 else report[end]
+
+    offset = 1
+    while offset < end:
+        structure_length = report[offset]
+        if structure_length == 0:
+            break
+        if report[offset + 1] == _MANUFACTURER_SPECIFIC_DATA:
+            return report[offset + 2:offset + 1 + structure_length], rssi
+        offset += 1 + structure_length
+    return None, rssi
+
+
+def scan(callback, macs, bt_device: str = ""):
+    """Calls callback(mac, (mac bytes, timestamp, rssi, manufacturer data)) for every
+    advertisement of the given MAC addresses with manufacturer data. Runs until the
+    scanner stops.
+
+    :param callback: The function called for every advertisement.
+    :param macs: The MAC addresses to listen to, as "AA:BB:CC:DD:EE:FF" strings. Any
+        container, checked for every advertisement, so it may change while scanning.
+    :param str bt_device: The bluetooth device to scan with (e.g. hci1), default one if empty.
+    """
+    # imported here since importing ruuvitag_sensor.ruuvi selects the BLE adapter.
+    from ruuvitag_sensor.ruuvi import ble
+
+    for mac, report in ble.get_datas([], bt_device):
+        if mac not in macs:
+            continue
+        try:
+            data, rssi = parse_advertisement(bytes.fromhex(report))
+        except (ValueError, IndexError):
+            continue
+        if data is None or len(data) > MAX_DATA_LENGTH:
+            continue
+        callback(mac, (bytes.fromhex(mac.replace(":", "")), CLOCK.now_ms(), rssi, data))
@@ -0,0 +1,122 @@
+"""This module contains the pieces of the upstream connection lifecycle shared by the
+clients: the jittered reconnect backoff, the TLS context resuming sessions across
+reconnects, and the reconnect metrics.
+"""
+
+import random
+import ssl
+import time
+
+from metrics import REGISTRY
+
+disconnects = REGISTRY.counter(
+    "ptm_upstream_disconnects_total", "Number of unexpected upstream disconnections by client")
+reconnect_latency = REGISTRY.histogram(
+    "ptm_upstream_reconnect_seconds",
+    "Time between an upstream disconnection and the next accepted connection",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+tls_handshakes = REGISTRY.counter(
+    "ptm_upstream_tls_handshakes_total", "Number of upstream TLS handshakes by session (new or resumed)")
+
+
+class Backoff:
+    """Exponential backoff with "decorrelated jitter": every delay is drawn between
+    min_delay and three times the previous one, capped at max_delay. Clients which lost
+    their connection at the same time, to an edgeHub restart for instance, spread their
+    reconnects instead of all retrying at once.
+    """
+
+    def __init__(self, min_delay: float = 1, max_delay: float = 60):
+        """
+        :param float min_delay: The minimum (and first) delay, in seconds.
+        :param float max_delay: The maximum delay, in seconds.
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._delay = None
+
+    def next(self) -> float:
+        """Returns the next delay, in seconds.
+        """
+        if self._delay is None:
+            self._delay = random.uniform(self.min_delay / 2, self.min_delay)
+        else:
+            self._delay = min(self.max_delay,
+                              random.uniform(self.min_delay, self._delay * 3))
+        return self._delay
+
+    def reset(self):
+        """Starts over from min_delay, after a successful connection.
+        """
+        self._delay = None
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """An SSLContext offering the session of the last connection, so reconnects resume
+    it with an abbreviated TLS handshake instead of a full one. Reuse the same context
+    for every connection of a client.
+
+    The certificates it trusts can be added to while it is in use, see trust, so a
+    rotated certificate authority applies to the next connection.
+    """
+
+    session = None
+    trusted = frozenset()
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None and "session" not in kwargs:
+            kwargs["session"] = self.session
+        return super().wrap_socket(sock, *args, **kwargs)
+
+    def save_session(self, sock):
+        """Keeps the session of a connected socket for the next connection.
+        """
+        session = getattr(sock, "session", None)
+        if session is None:
+            return
+        tls_handshakes.inc(session="resumed" if sock.session_reused else "new")
+        self.session = session
+
+    def trust(self, certificate: str) -> bool:
+        """Trusts a PEM certificate for the next connections, along with the ones
+        already trusted. Returns False if it already was.
+        """
+        if certificate in self.trusted:
+            return False
+        self.load_verify_locations(cadata=certificate)
+        self.trusted = self.trusted | {certificate}
+        return True
+
+
+def create_ssl_context(server_verification_cert: str) -> ResumingSSLContext:
+    """Returns a context verifying the server with the given PEM certificate.
+    """
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS)
+    context.trust(server_verification_cert)
+    return context
+
+
+class ConnectionTimer:
+    """Measures the time from an unexpected disconnection to the next accepted
+    connection of a client.
+    """
+
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self._disconnected_at = None
+
+    def disconnected(self):
+        disconnects.inc(client=self.client_id)
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+
+    def connected(self):
+        """Returns the time (in seconds) it took to reconnect, None on the first
+        connection.
+        """
+        if self._disconnected_at is None:
+            return None
+        elapsed = time.monotonic() - self._disconnected_at
+        self._disconnected_at = None
+        reconnect_latency.observe(elapsed)
+        return elapsed
@@ -0,0 +1,218 @@
+"""This module contains the registry of the authorized sensors, mapping their MAC
+address to the IoT Hub device id their readings are sent as, and a file watcher
+keeping it up to date.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from dedup import mac_to_int
+from priority import DeviceClassifier
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceRegistry:
+    """The authorized sensors, by MAC address.
+
+    Lookups read the current snapshot, a dict keyed by the MAC addresses as 48-bit
+    integers, without taking any lock. Updates build a new snapshot and swap it in
+    (copy-on-write), so readers see either the old or the new registry, never a mix.
+
+    The registry is also a live scan filter: ``mac in registry`` and ``len(registry)``
+    reflect the current snapshot, so a scanner given the registry as its MAC list
+    picks up changes without being restarted.
+
+    A sensor is mapped either to a device id or to a device object, such as
+    {"deviceId": "cold-room-1", "class": "telemetry", "alerts": {...}}, which also
+    sets the message class of its readings, see priority.DeviceClassifier.
+    """
+
+    def __init__(self, devices: dict = None):
+        """
+        :param dict devices: The initial map of MAC address to device id or object.
+        """
+        # serializes the updates, readers never take it.
+        self._lock = threading.Lock()
+        self._devices = {}
+        # classifiers of the sensors mapped to a device object, by MAC address.
+        self._classifiers = {}
+        self._listeners = []
+        if devices:
+            self.replace(devices)
+
+    def lookup(self, mac: str):
+        """Returns the device id of a MAC address, None if it is not authorized.
+        """
+        return self._devices.get(mac_to_int(mac))
+
+    def classifier(self, mac: str):
+        """Returns the DeviceClassifier of a MAC address, None if it has none.
+        """
+        return self._classifiers.get(mac_to_int(mac)) if self._classifiers else None
+
+    def __contains__(self, mac) -> bool:
+        return mac_to_int(mac) in self._devices
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def __repr__(self):
+        return f"DeviceRegistry({len(self._devices)} devices)"
+
+    def macs(self):
+        """Returns the authorized MAC addresses, as "AA:BB:CC:DD:EE:FF" strings.
+        """
+        return [_int_to_mac(key) for key in self._devices]
+
+    def device_ids(self) -> set:
+        """Returns the device ids of the authorized sensors.
+        """
+        return set(self._devices.values())
+
+    def device_macs(self, device_id: str):
+        """Returns the MAC addresses of the sensors translated to a device id.
+        """
+        return [_int_to_mac(key) for key, value in self._devices.items() if value == device_id]
+
+    def add_listener(self, callback):
+        """Registers a function called without arguments after every update.
+        """
+        self._listeners.append(callback)
+
+    def replace(self, devices: dict):
+        """Replaces the whole registry.
+
+        :param dict devices: The map of MAC address to device id or object.
+        """
+        snapshot, classifiers = _normalize(devices)
+        with self._lock:
+            self._devices = snapshot
+            self._classifiers = classifiers
+        logger.info(f"device registry replaced, {len(snapshot)} authorized sensor(s).")
+        self._notify()
+
+    def patch(self, changes: dict):
+        """Adds, updates or, when their device id is None, removes sensors.
+
+        :param dict changes: The map of MAC address to device id, object or None.
+        """
+        removed = [mac for mac, device_id in changes.items() if device_id is None]
+        added, added_classifiers = _normalize(
+            {mac: device_id for mac, device_id in changes.items() if device_id is not None})
+        with self._lock:
+            snapshot = dict(self._devices)
+            snapshot.update(added)
+            classifiers = dict(self._classifiers)
+            for key in added:
+                classifiers.pop(key, None)
+            classifiers.update(added_classifiers)
+            for mac in removed:
+                try:
+                    key = mac_to_int(mac)
+                except ValueError:
+                    continue
+                snapshot.pop(key, None)
+                classifiers.pop(key, None)
+            self._devices = snapshot
+            self._classifiers = classifiers
+        logger.info(f"device registry patched ({len(added)} set, {len(removed)} removed), "
+                    f"{len(snapshot)} authorized sensor(s).")
+        self._notify()
+
+    def _notify(self):
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception:
+                logger.exception("device registry listener failed.")
+
+
+class FileWatcher:
+    """Replaces the content of a DeviceRegistry with a JSON file mapping MAC addresses
+    to device ids, whenever the file changes. The file is polled from a background
+    thread.
+    """
+
+    def __init__(self, path: str, registry: DeviceRegistry, interval: float = 5):
+        """
+        :param str path: The path of the JSON file.
+        :param DeviceRegistry registry: The registry to update.
+        :param float interval: The time (in seconds) between two checks of the file.
+        """
+        self.path = path
+        self.interval = interval
+        self._registry = registry
+        self._signature = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Loads the file, then starts watching it.
+        """
+        self.check()
+        self._thread = threading.Thread(target=self._run, name="registry-watcher",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def check(self):
+        """Reloads the file if it changed since the last check. A file which cannot be
+        read or parsed is logged and the registry kept as is.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            if self._signature is not None:
+                logger.warning(f"cannot read the device registry file {self.path}: {e}")
+            return
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if signature == self._signature:
+            return
+        self._signature = signature
+
+        try:
+            with open(self.path) as f:
+                devices = json.load(f)
+            if not isinstance(devices, dict):
+                raise ValueError("expected a map of MAC address to device id")
+        except (OSError, ValueError) as e:
+            logger.error(f"ignoring the device registry file {self.path}: {e}")
+            return
+        self._registry.replace(devices)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+
+def _normalize(devices):
+    snapshot = {}
+    classifiers = {}
+    for mac, device_id in devices.items():
+        try:
+            if len(mac) != 17:
+                raise ValueError(mac)
+            key = mac_to_int(mac)
+        except (TypeError, ValueError):
+            logger.warning(f"ignoring the invalid MAC address {mac!r} of {device_id}.")
+            continue
+        if isinstance(device_id, dict):
+            try:
+                classifiers[key] = DeviceClassifier.from_dict(device_id)
+                device_id = device_id["deviceId"]
+            except (KeyError, TypeError, AttributeError):
+                logger.warning(f"ignoring the invalid device {device_id!r} of {mac}.")
+                continue
+        snapshot[key] = device_id
+    return snapshot, classifiers
+
+
+def _int_to_mac(key):
+    return ":".join(f"{key >> shift & 0xFF:02X}" for shift in range(40, -8, -8))
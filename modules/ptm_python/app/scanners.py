@@ -0,0 +1,268 @@
+"""This module contains the concurrent scanning of several bluetooth adapters, one
+process per adapter, whose advertisements are merged and deduplicated, with
+per-adapter reception statistics.
+"""
+
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+import timestamps
+from metrics import REGISTRY
+from raw import MAX_DATA_LENGTH, parse_advertisement
+
+logger = logging.getLogger(__name__)
+
+adapter_advertisements = REGISTRY.counter(
+    "ptm_ble_adapter_advertisements_total", "Number of advertisements received by adapter")
+adapter_duplicates = REGISTRY.counter(
+    "ptm_ble_adapter_duplicates_total",
+    "Number of advertisements already received by another adapter, by adapter")
+adapter_missed = REGISTRY.counter(
+    "ptm_ble_adapter_missed_total",
+    "Number of measurements received by other adapters only, by adapter")
+adapter_dropped = REGISTRY.counter(
+    "ptm_ble_adapter_dropped_total",
+    "Number of advertisements dropped because the scanner queue was full, by adapter")
+adapter_rssi = REGISTRY.histogram(
+    "ptm_ble_adapter_rssi_dbm", "RSSI of the received advertisements by adapter",
+    buckets=(-100, -90, -80, -70, -60, -50, -40))
+lost_measurements = REGISTRY.gauge(
+    "ptm_ble_lost_measurements",
+    "Number of measurements missed by all adapters, from sequence number gaps")
+
+# how often (in seconds) a scanner process checks for MAC filter updates.
+_FILTER_POLL_INTERVAL = 1
+# how often (in seconds) the drop counters of the scanner processes are read, busy or not.
+_DROPS_INTERVAL = 1
+# the number of recent measurements of a sensor remembered, as adapters do not
+# deliver their advertisements in the same order.
+_WINDOW = 8
+# larger sequence number gaps are taken as a sensor restart rather than a loss.
+_MAX_SEQUENCE_GAP = 1000
+
+
+class AdapterScanners:
+    """Scans with several bluetooth adapters at once, each in its own process.
+
+    The advertisements of all the adapters are put on a shared queue, and the ones
+    received by more than one adapter are dropped: a measurement is identified by
+    the sensor MAC address and its measurement sequence number (or, for data formats
+    without one, by its content). The scanner processes filter advertisements with a
+    copy of the authorized MAC addresses, updated when the registry changes.
+    """
+
+    def __init__(self, adapters, registry, raw_mode: bool = False, queue_size: int = 1000):
+        """
+        :param adapters: The bluetooth adapters, such as ["hci0", "hci1"].
+        :param registry: The DeviceRegistry of the authorized sensors.
+        :param bool raw_mode: Forward raw advertisements (see raw.scan) instead of
+            decoded readings.
+        :param int queue_size: The maximum number of advertisements waiting in the
+            shared queue. Scanners drop advertisements while it is full.
+        """
+        self.adapters = list(adapters)
+        self.raw_mode = raw_mode
+        self._registry = registry
+        # fork, not spawn, so children do not re-import the main module.
+        self._context = multiprocessing.get_context("fork")
+        self._queue = self._context.Queue(queue_size)
+        self._dropped = self._context.Array("Q", len(self.adapters))
+        self._processes = []
+        self._controls = []
+        self._controls_lock = threading.Lock()
+        self._sensors = {}
+        lost_measurements.add_function(
+            lambda: sum(sensor.span - sensor.unique for sensor in list(self._sensors.values())))
+
+    def start(self):
+        """Starts the scanner processes. Call it before starting any thread, so no
+        lock is held in the forked processes.
+        """
+        macs = self._registry.macs()
+        for index, adapter in enumerate(self.adapters):
+            receiver, sender = self._context.Pipe(duplex=False)
+            process = self._context.Process(
+                target=_scan, name=f"scanner-{adapter}", daemon=True,
+                args=(index, adapter, self.raw_mode, macs, receiver, self._queue,
+                      self._dropped))
+            process.start()
+            receiver.close()
+            self._processes.append(process)
+            self._controls.append(sender)
+        self._registry.add_listener(self._update_filter)
+        logger.info(f"scanning with adapters {', '.join(self.adapters)}.")
+
+    def run(self, callback):
+        """Calls callback((mac, reading)) for every new measurement, until all the
+        scanner processes exit.
+        """
+        dropped = [0] * len(self.adapters)
+        # the drops happen when the queue is full, so they are not only counted when idle.
+        count_drops_at = time.monotonic() + _DROPS_INTERVAL
+        while any(process.is_alive() for process in self._processes) \
+                or not self._queue.empty():
+            try:
+                item = self._queue.get(timeout=_DROPS_INTERVAL)
+            except queue.Empty:
+                item = None
+            now = time.monotonic()
+            if now >= count_drops_at:
+                self._count_drops(dropped)
+                count_drops_at = now + _DROPS_INTERVAL
+            if item is None:
+                continue
+
+            index, mac, rssi, key, reading = item
+
+            adapter = self.adapters[index]
+            adapter_advertisements.inc(adapter=adapter)
+            if rssi is not None:
+                adapter_rssi.observe(rssi, adapter=adapter)
+            if self._accept(index, mac, key):
+                callback((mac, reading))
+            else:
+                adapter_duplicates.inc(adapter=adapter)
+        self._count_drops(dropped)
+
+        for process in self._processes:
+            if process.exitcode:
+                logger.error(f"{process.name} exited with code {process.exitcode}.")
+
+    def stop(self):
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+
+    def _accept(self, index, mac, key):
+        sensor = self._sensors.get(mac)
+        if sensor is None:
+            sensor = self._sensors[mac] = _Sensor()
+        for measurement in sensor.window:
+            if measurement[0] == key:
+                measurement[1] |= 1 << index
+                return False
+
+        sensor.window.append([key, 1 << index])
+        if len(sensor.window) > _WINDOW:
+            # the oldest measurement will not be received anymore.
+            mask = sensor.window.pop(0)[1]
+            for other, adapter in enumerate(self.adapters):
+                if not mask & 1 << other:
+                    adapter_missed.inc(adapter=adapter)
+        if isinstance(key, int):
+            sensor.count(key)
+        return True
+
+    def _count_drops(self, counted):
+        for index, adapter in enumerate(self.adapters):
+            value = self._dropped[index]
+            if value != counted[index]:
+                adapter_dropped.inc(value - counted[index], adapter=adapter)
+                counted[index] = value
+
+    def _update_filter(self):
+        macs = self._registry.macs()
+        with self._controls_lock:
+            for control in self._controls:
+                try:
+                    control.send(macs)
+                except OSError:
+                    # the scanner process exited.
+                    pass
+
+
+class _Sensor:
+    """The recent measurements of a sensor, as [key, bitmask of the adapters which
+    received it], and the sequence numbers received: span is the number of sequence
+    numbers between the first and the highest received one, unique the number of
+    them received.
+    """
+
+    __slots__ = ("window", "highest", "span", "unique")
+
+    def __init__(self):
+        self.window = []
+        self.highest = None
+        self.span = 0
+        self.unique = 0
+
+    def count(self, sequence):
+        self.unique += 1
+        if self.highest is None:
+            self.highest, self.span = sequence, 1
+            return
+        ahead = (sequence - self.highest) & 0xFFFF
+        if (self.highest - sequence) & 0xFFFF < _MAX_SEQUENCE_GAP:
+            # received late, by a slower adapter.
+            return
+        if ahead < _MAX_SEQUENCE_GAP:
+            self.span += ahead
+        else:
+            # the sensor restarted, the span starts over.
+            self.span, self.unique = 1, 1
+        self.highest = sequence
+
+
+class _Filter:
+    """The MAC addresses a scanner process forwards, all of them if empty. Updates
+    from the parent process are read at most every _FILTER_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, macs, control):
+        self._macs = set(macs)
+        self._control = control
+        self._next_poll = 0
+
+    def __contains__(self, mac):
+        now = time.monotonic()
+        if now >= self._next_poll:
+            self._next_poll = now + _FILTER_POLL_INTERVAL
+            while self._control.poll():
+                self._macs = set(self._control.recv())
+        return not self._macs or mac in self._macs
+
+
+def _scan(index, adapter, raw_mode, macs, control, output, dropped):
+    """Scanner process: puts (adapter index, mac, rssi, key, reading) tuples on the
+    output queue for the advertisements of the filtered MAC addresses.
+    """
+    # imported here since importing ruuvitag_sensor.ruuvi selects the BLE adapter.
+    from ruuvitag_sensor.data_formats import DataFormats
+    from ruuvitag_sensor.decoder import get_decoder
+    from ruuvitag_sensor.ruuvi import ble
+
+    wanted = _Filter(macs, control)
+    for mac, report in ble.get_datas([], adapter):
+        if mac not in wanted:
+            continue
+        try:
+            data, rssi = parse_advertisement(bytes.fromhex(report))
+        except (ValueError, IndexError):
+            continue
+
+        if raw_mode:
+            if data is None or len(data) > MAX_DATA_LENGTH:
+                continue
+            key = bytes(data)
+            reading = (bytes.fromhex(mac.replace(":", "")), timestamps.CLOCK.now_ms(), rssi, key)
+        else:
+            data_format, encoded = DataFormats.convert_data(report)
+            if encoded is None:
+                continue
+            reading = get_decoder(data_format).decode_data(encoded)
+            if reading is None:
+                continue
+            key = reading.get("measurement_sequence_number")
+            if key is None:
+                key = tuple(sorted(reading.items()))
+            # stamped after the key, which other adapters compute without it.
+            timestamps.stamp(reading)
+
+        try:
+            output.put_nowait((index, mac, rssi, key, reading))
+        except queue.Full:
+            dropped[index] += 1
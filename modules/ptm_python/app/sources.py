@@ -0,0 +1,335 @@
+"""This module contains the sensor source plugins, translating other sensor protocols
+than the RuuviTag library one. Every source decodes its protocol on its own worker
+thread into Reading records, all fed to the same callback as (mac, reading) tuples.
+
+The BLE protocols share one scanner: it only splits the advertisements in their
+advertising data structures and hands the data of each structure to the protocol
+registered for its type and identifier (company id or service UUID), in a single
+dict lookup, so adding protocols does not add to the cost of every advertisement.
+"""
+
+import importlib
+import logging
+import queue
+import struct
+import threading
+
+import pipeline
+import timestamps
+
+logger = logging.getLogger(__name__)
+
+# advertising data structure types.
+_SERVICE_DATA_16 = 0x16
+_MANUFACTURER_SPECIFIC_DATA = 0xFF
+
+
+class Reading:
+    """A decoded sensor reading. Readings are slotted objects, subclassed per protocol
+    with its own fields, rather than dicts. They are read like decoded RuuviTag dicts
+    (get, [] and to_dict), so the suppression, aggregation and encoding stages handle
+    both the same way. Missing values are None. The timestamp is the capture time, in
+    milliseconds since epoch, see the timestamps module.
+    """
+
+    __slots__ = ("temperature", "humidity", "pressure", "battery",
+                 "measurement_sequence_number", "rssi", "timestamp")
+
+    # the protocol name, also written in the encoded readings.
+    protocol = None
+    # all the slots, in order, set by __init_subclass__.
+    fields = __slots__
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = tuple(field for klass in reversed(cls.__mro__)
+                           for field in klass.__dict__.get("__slots__", ()))
+
+    def __init__(self, **values):
+        for field in self.fields:
+            setattr(self, field, values.get(field))
+
+    def get(self, field: str, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def __getitem__(self, field: str):
+        value = getattr(self, field, None)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def to_dict(self) -> dict:
+        values = {"protocol": self.protocol}
+        for field in self.fields:
+            value = getattr(self, field)
+            if value is not None:
+                values[field] = value
+        return values
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+
+class RuuviReading(Reading):
+    __slots__ = ("data_format", "acceleration", "acceleration_x", "acceleration_y",
+                 "acceleration_z", "tx_power", "movement_counter", "mac")
+    protocol = "ruuvitag"
+
+
+class EddystoneTlmReading(Reading):
+    __slots__ = ("advertisement_count", "uptime")
+    protocol = "eddystone-tlm"
+
+
+class XiaomiReading(Reading):
+    __slots__ = ("battery_level",)
+    protocol = "xiaomi"
+
+
+class Source:
+    """A sensor protocol. Subclasses implement run, which calls emit((mac, reading))
+    with every decoded Reading until stop is called, on the worker thread of the
+    source. Readings emitted without a timestamp are stamped when they are emitted.
+    """
+
+    name = None
+
+    def run(self, emit):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class BleProtocol(Source):
+    """A BLE advertisement protocol. The BleScanner hands it the data of the advertising
+    data structures matching one of its keys, (structure type, company id or 16-bit
+    service UUID), and decode returns their Reading, or None to ignore them.
+
+    The advertisements are buffered in a RingBuffer, dropping the oldest ones if the
+    protocol worker falls behind.
+    """
+
+    keys = ()
+
+    def __init__(self, capacity: int = 1000):
+        self._buffer = pipeline.RingBuffer(capacity, pipeline.DROP_OLDEST)
+        self._running = True
+
+    def decode(self, data: bytes):
+        raise NotImplementedError
+
+    def offer(self, mac, data, rssi):
+        """Called by the scanner thread for every matching advertisement.
+        """
+        if not self._buffer.put((mac, data, rssi, timestamps.CLOCK.now_ms())):
+            pipeline.dropped.inc(stage=self.name, policy=pipeline.DROP_OLDEST)
+
+    def run(self, emit):
+        while self._running:
+            try:
+                mac, data, rssi, timestamp = self._buffer.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                reading = self.decode(data)
+            except (ValueError, IndexError, struct.error):
+                continue
+            if reading is not None:
+                reading.rssi = rssi
+                reading.timestamp = timestamp
+                emit((mac, reading))
+
+    def stop(self):
+        self._running = False
+
+
+class RuuviTagProtocol(BleProtocol):
+    """RuuviTag data formats 3 and 5 (manufacturer data of company 0x0499), decoded
+    with the ruuvitag_sensor library decoders.
+    """
+
+    name = "ruuvitag"
+    keys = ((_MANUFACTURER_SPECIFIC_DATA, 0x0499),)
+
+    _formats = (3, 5)
+
+    def __init__(self, capacity: int = 1000):
+        super().__init__(capacity)
+        self._decoders = {}
+
+    def decode(self, data):
+        decoder = self._decoders.get(data[2])
+        if decoder is None:
+            if data[2] not in self._formats:
+                return None
+            from ruuvitag_sensor.decoder import get_decoder
+            decoder = self._decoders[data[2]] = get_decoder(data[2])
+        values = decoder.decode_data(data[2:].hex())
+        return None if values is None else RuuviReading(**values)
+
+
+class EddystoneTlmProtocol(BleProtocol):
+    """Eddystone telemetry (TLM) frames, unencrypted version: battery voltage, beacon
+    temperature, advertisement count and uptime.
+    """
+
+    name = "eddystone-tlm"
+    keys = ((_SERVICE_DATA_16, 0xFEAA),)
+
+    _frame = struct.Struct(">BBHhII")
+
+    def decode(self, data):
+        # service data: UUID, frame type (0x20), version (0), then the telemetry.
+        if len(data) < 2 + self._frame.size or data[2] != 0x20 or data[3] != 0:
+            return None
+        _, _, battery, temperature, count, uptime = self._frame.unpack_from(data, 2)
+        return EddystoneTlmReading(
+            battery=battery or None,
+            temperature=None if temperature == -0x8000 else temperature / 256,
+            advertisement_count=count,
+            uptime=uptime / 10)
+
+
+class XiaomiProtocol(BleProtocol):
+    """Xiaomi thermometers (LYWSD03MMC and alike) running the ATC1441 or pvvx custom
+    firmware, which advertise their readings in clear as environmental sensing service
+    data. The encrypted MiBeacon format of the stock firmware is not supported.
+    """
+
+    name = "xiaomi"
+    keys = ((_SERVICE_DATA_16, 0x181A),)
+
+    _atc = struct.Struct(">6shBBHB")
+    _pvvx = struct.Struct("<6shHHBBB")
+
+    def decode(self, data):
+        if len(data) == 2 + self._atc.size:
+            _, temperature, humidity, level, battery, counter = self._atc.unpack_from(data, 2)
+            temperature, humidity = temperature / 10, float(humidity)
+        elif len(data) == 2 + self._pvvx.size:
+            _, temperature, humidity, battery, level, counter, _ = \
+                self._pvvx.unpack_from(data, 2)
+            temperature, humidity = temperature / 100, humidity / 100
+        else:
+            return None
+        return XiaomiReading(temperature=temperature, humidity=humidity, battery=battery,
+                             battery_level=level, measurement_sequence_number=counter)
+
+
+class BleScanner:
+    """Scans with one bluetooth adapter for the advertisements of the authorized
+    sensors, and dispatches them to the BleProtocols.
+    """
+
+    def __init__(self, protocols, macs, bt_device: str = ""):
+        """
+        :param protocols: The BleProtocols to dispatch advertisements to.
+        :param macs: The MAC addresses to listen to. Any container, checked for every
+            advertisement, so it may change while scanning.
+        :param str bt_device: The bluetooth device to scan with, default one if empty.
+        """
+        self._protocols = {key: protocol for protocol in protocols for key in protocol.keys}
+        self._macs = macs
+        self.bt_device = bt_device
+
+    def run(self):
+        # imported here since importing ruuvitag_sensor.ruuvi selects the BLE adapter.
+        from ruuvitag_sensor.ruuvi import ble
+
+        protocols = self._protocols
+        for mac, report in ble.get_datas([], self.bt_device):
+            if mac not in self._macs:
+                continue
+            try:
+                report = bytes.fromhex(report)
+                length = report[0]
+                end = 1 + length
+                rssi = report[end] - 256 if report[end] > 127 else report[end]
+                offset = 1
+                while offset < end:
+                    structure_length = report[offset]
+                    if structure_length == 0:
+                        break
+                    # type, then at least the company id or service UUID.
+                    if structure_length >= 3:
+                        data = report[offset + 2:offset + 1 + structure_length]
+                        protocol = protocols.get(
+                            (report[offset + 1], data[0] | data[1] << 8))
+                        if protocol is not None:
+                            protocol.offer(mac, data, rssi)
+                    offset += 1 + structure_length
+            except (ValueError, IndexError):
+                continue
+
+
+# the built-in sources, by name.
+SOURCES = {
+    RuuviTagProtocol.name: RuuviTagProtocol,
+    EddystoneTlmProtocol.name: EddystoneTlmProtocol,
+    XiaomiProtocol.name: XiaomiProtocol,
+}
+
+
+def create_source(name: str) -> Source:
+    """Creates a built-in source by name, or a plugin one from its "module:Class" path,
+    such as "modbus_source:ModbusSource" for a Source subclass in an importable module.
+    """
+    if name in SOURCES:
+        return SOURCES[name]()
+    module, sep, attribute = name.partition(":")
+    if not sep:
+        raise ValueError(f"unknown sensor source: {name}")
+    return getattr(importlib.import_module(module), attribute)()
+
+
+class SourceSet:
+    """Runs sources, each on its own worker thread, plus one BleScanner shared by the
+    BLE protocols.
+    """
+
+    def __init__(self, sources, macs, bt_device: str = ""):
+        """
+        :param sources: The Sources to run.
+        :param macs: The MAC addresses the BLE scanner listens to, see BleScanner.
+        :param str bt_device: The bluetooth device to scan with, default one if empty.
+        """
+        self.sources = list(sources)
+        protocols = [source for source in self.sources if isinstance(source, BleProtocol)]
+        self._scanner = BleScanner(protocols, macs, bt_device) if protocols else None
+
+    def run(self, callback):
+        """Calls callback((mac, reading)) for every reading of every source, from their
+        worker threads. Blocks until the BLE scanner, or all the sources, stop.
+        """
+        threads = [threading.Thread(target=self._run_source, args=(source, callback),
+                                    name=f"source-{source.name}", daemon=True)
+                   for source in self.sources]
+        for thread in threads:
+            thread.start()
+        logger.info(f"listening with sensor sources "
+                    f"{', '.join(source.name for source in self.sources)}.")
+        if self._scanner is not None:
+            try:
+                self._scanner.run()
+            finally:
+                self.stop()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        for source in self.sources:
+            source.stop()
+
+    @staticmethod
+    def _run_source(source, callback):
+        def emit(data):
+            if data[1].timestamp is None:
+                timestamps.stamp(data[1])
+            callback(data)
+
+        try:
+            source.run(emit)
+        except Exception:
+            logger.exception(f"sensor source {source.name} failed.")
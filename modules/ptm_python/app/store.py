@@ -0,0 +1,479 @@
+"""This module contains a disk-backed, append-only queue of outgoing messages and a
+store-and-forward wrapper for ModuleClient which sends messages from that queue, so
+they survive connection losses and module restarts.
+"""
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+stored_messages = REGISTRY.counter(
+    "ptm_store_appended_total", "Number of messages appended to the store")
+dropped_messages = REGISTRY.counter(
+    "ptm_store_dropped_total", "Number of messages dropped because the store is full")
+evicted_segments = REGISTRY.counter(
+    "ptm_store_evicted_segments_total", "Number of segments evicted before being sent")
+sent_messages = REGISTRY.counter(
+    "ptm_store_sent_total", "Number of messages sent from the store by kind")
+
+# record header: body length and crc32 of the body. A zero length marks the end of
+# the data in a segment, since segments are preallocated with zeros.
+_HEADER = struct.Struct("<II")
+# body prefix: qos and topic length, followed by the topic and the payload. When the
+# _CAPTURE_TIMES bit of the qos byte is set, the topic is followed by the number of
+# capture times and the capture times (milliseconds since epoch) of the readings.
+_BODY_PREFIX = struct.Struct("<BH")
+_CAPTURE_TIMES = 0x80
+_CAPTURE_COUNT = struct.Struct("<H")
+_CAPTURE_TIME = struct.Struct("<Q")
+_CURSOR = struct.Struct("<QQ")
+_CURSOR_FILE = "cursor"
+_SEGMENT_SUFFIX = ".seg"
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+
+class SegmentQueue:
+    """A persistent FIFO of (topic, payload, qos, capture times) records.
+
+    Records are appended to memory-mapped segment files of ``segment_size`` bytes. The
+    position of the oldest unacknowledged record is kept in a cursor file, and segments
+    are deleted once all their records are committed. When appending would grow the
+    queue beyond ``max_bytes``, either the oldest segment is evicted (``drop-oldest``)
+    or the new record is refused (``drop-newest``).
+
+    Positions are (segment index, offset) tuples.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 1 << 20,
+                 max_bytes: int = 64 << 20, eviction: str = DROP_OLDEST):
+        """
+        :param str directory: The directory holding the segment files, created if needed.
+        :param int segment_size: The size (in bytes) of a segment file.
+        :param int max_bytes: The maximum size (in bytes) of all segment files together.
+        :param str eviction: What to do when the queue is full, drop-oldest or drop-newest.
+        """
+        if eviction not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown eviction policy: {eviction}")
+        if max_bytes < 2 * segment_size:
+            raise ValueError("max_bytes must hold at least two segments")
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+
+        self._lock = threading.Lock()
+        self._maps = {}
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(_SEGMENT_SUFFIX))
+        # the actual size of every segment file, larger than segment_size when the
+        # segment was created for a record that did not fit in one.
+        self._sizes = {segment: os.path.getsize(self._path(segment))
+                       for segment in self._segments}
+        if not self._segments:
+            self._segments.append(0)
+            self._map(0, create=True)
+
+        self._committed = self._load_cursor()
+        self._read_position = self._committed
+        self._write_position = (self._segments[-1], self._recover_end(self._segments[-1]))
+
+    def __bool__(self):
+        return self._read_position != self._write_position
+
+    @property
+    def write_position(self):
+        return self._write_position
+
+    def append(self, topic: str, payload, qos: int = 1, capture_times=()) -> bool:
+        """Appends a record. Returns False if the record was dropped because the queue is full.
+
+        The payload is stored as bytes, the way paho sends it: None is an empty payload,
+        and a str, int or float is encoded as UTF-8 text.
+        """
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode("utf-8")
+        elif isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic = topic.encode("utf-8")
+        if capture_times:
+            body = b"".join((_BODY_PREFIX.pack(qos | _CAPTURE_TIMES, len(topic)), topic,
+                             _CAPTURE_COUNT.pack(len(capture_times)),
+                             *(_CAPTURE_TIME.pack(timestamp) for timestamp in capture_times),
+                             payload))
+        else:
+            body = _BODY_PREFIX.pack(qos, len(topic)) + topic + payload
+        record = _HEADER.pack(len(body), zlib.crc32(body)) + body
+
+        with self._lock:
+            segment, offset = self._write_position
+            buffer = self._maps[segment]
+            # keep room for the zero length end marker after the record.
+            if offset + len(record) + _HEADER.size > len(buffer):
+                if not self._roll(len(record) + _HEADER.size):
+                    dropped_messages.inc()
+                    return False
+                segment, offset = self._write_position
+                buffer = self._maps[segment]
+
+            end = offset + len(record)
+            buffer[offset:end] = record
+            buffer[end:end + _HEADER.size] = bytes(_HEADER.size)
+            self._write_position = (segment, end)
+
+        stored_messages.inc()
+        return True
+
+    def read(self, max_records: int):
+        """Returns up to max_records (position after the record, topic, payload, qos,
+        capture times) from the read position, and advances it. Read records stay in the
+        queue until committed.
+        """
+        records = []
+        with self._lock:
+            segment, offset = self._read_position
+            while len(records) < max_records and (segment, offset) != self._write_position:
+                buffer = self._maps.get(segment) or self._map(segment)
+                length, crc = _HEADER.unpack_from(buffer, offset)
+                if length == 0:
+                    segment, offset = self._next_segment(segment), 0
+                    continue
+                start = offset + _HEADER.size
+                body = buffer[start:start + length]
+                offset = start + length
+                if zlib.crc32(body) != crc:
+                    logger.warning(f"skipping corrupted record in segment {segment}.")
+                    continue
+                qos, topic_length = _BODY_PREFIX.unpack_from(body)
+                topic_end = _BODY_PREFIX.size + topic_length
+                payload_start, times = topic_end, []
+                if qos & _CAPTURE_TIMES:
+                    qos &= ~_CAPTURE_TIMES
+                    count, = _CAPTURE_COUNT.unpack_from(body, topic_end)
+                    payload_start += _CAPTURE_COUNT.size + count * _CAPTURE_TIME.size
+                    times = [timestamp for timestamp, in _CAPTURE_TIME.iter_unpack(
+                        body[topic_end + _CAPTURE_COUNT.size:payload_start])]
+                records.append(((segment, offset),
+                                body[_BODY_PREFIX.size:topic_end].decode("utf-8"),
+                                body[payload_start:], qos, times))
+            self._read_position = (segment, offset)
+        return records
+
+    def commit(self, position):
+        """Marks every record before the position as delivered, and deletes the segments
+        which only hold delivered records.
+        """
+        with self._lock:
+            if position <= self._committed:
+                return
+            self._committed = position
+            while self._segments[0] < position[0]:
+                self._delete(self._segments.pop(0))
+            self._save_cursor()
+
+    def close(self):
+        with self._lock:
+            for buffer in self._maps.values():
+                buffer.flush()
+                buffer.close()
+            self._maps.clear()
+
+    def _roll(self, needed):
+        """Starts a new segment, evicting the oldest one if needed. Called with the lock held.
+        """
+        size = max(self.segment_size, needed)
+        while sum(self._sizes.values()) + size > self.max_bytes:
+            if self.eviction == DROP_NEWEST or len(self._segments) == 1:
+                return False
+            oldest = self._segments.pop(0)
+            self._delete(oldest)
+            evicted_segments.inc()
+            logger.warning(f"store is full, evicted segment {oldest}.")
+            if self._committed[0] <= oldest:
+                self._committed = (self._segments[0], 0)
+                self._save_cursor()
+            if self._read_position[0] <= oldest:
+                self._read_position = (self._segments[0], 0)
+
+        self._maps[self._write_position[0]].flush()
+        segment = self._segments[-1] + 1
+        self._segments.append(segment)
+        self._map(segment, create=True, size=size)
+        self._write_position = (segment, 0)
+        return True
+
+    def _next_segment(self, segment):
+        index = self._segments.index(segment)
+        return self._segments[index + 1]
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:016d}{_SEGMENT_SUFFIX}")
+
+    def _map(self, segment, create=False, size=None):
+        with open(self._path(segment), "w+b" if create else "r+b") as f:
+            if create:
+                f.truncate(size or self.segment_size)
+            buffer = self._maps[segment] = mmap.mmap(f.fileno(), 0)
+        self._sizes[segment] = len(buffer)
+        return buffer
+
+    def _delete(self, segment):
+        buffer = self._maps.pop(segment, None)
+        if buffer is not None:
+            buffer.close()
+        self._sizes.pop(segment, None)
+        os.remove(self._path(segment))
+
+    def _recover_end(self, segment):
+        """Returns the offset right after the last valid record of a segment.
+        """
+        buffer = self._maps.get(segment) or self._map(segment)
+        offset = 0
+        while offset + _HEADER.size <= len(buffer):
+            length, crc = _HEADER.unpack_from(buffer, offset)
+            end = offset + _HEADER.size + length
+            if length == 0 or end > len(buffer) \
+                    or zlib.crc32(buffer[offset + _HEADER.size:end]) != crc:
+                break
+            offset = end
+        # clear a partially written record so it reads as the end of the segment.
+        if offset + _HEADER.size <= len(buffer):
+            buffer[offset:offset + _HEADER.size] = bytes(_HEADER.size)
+        return offset
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, _CURSOR_FILE), "rb") as f:
+                position = _CURSOR.unpack(f.read(_CURSOR.size))
+        except (OSError, struct.error):
+            position = (self._segments[0], 0)
+        if position[0] < self._segments[0]:
+            position = (self._segments[0], 0)
+        return position
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, _CURSOR_FILE)
+        with open(path + ".tmp", "wb") as f:
+            f.write(_CURSOR.pack(*self._committed))
+        os.replace(path + ".tmp", path)
+
+
+class StoreAndForward:
+    """Wraps a ModuleClient so that every published message is first appended to a
+    SegmentQueue and then sent by a background thread while the client is connected.
+
+    Records are committed once acknowledged by the broker, so unacknowledged messages
+    are sent again after a restart. Messages stored before the last (re)connect form
+    the backlog, which is replayed at most ``drain_rate`` messages per second, in reads
+    of ``drain_batch`` records so the backlog is never loaded in memory at once.
+    Any other attribute is looked up on the wrapped client.
+
+    The capture times of the readings of a message, given to publish, are stored with
+    it, and their latency reported to the ``latency`` tracker when the message sent
+    from the store is acknowledged, after a restart too.
+    """
+
+    # publish takes the capture times of the readings, see publisher.BatchingPublisher.
+    stores_capture_times = True
+
+    def __init__(self, client, queue: SegmentQueue, drain_rate: float = 100,
+                 drain_batch: int = 100, max_inflight: int = 20, latency=None):
+        """
+        :param client: The ModuleClient to send messages through.
+        :param SegmentQueue queue: The queue holding the outgoing messages.
+        :param float drain_rate: Maximum number of backlog messages sent per second.
+        :param int drain_batch: Number of records read from the queue at once.
+        :param int max_inflight: Maximum number of unacknowledged messages.
+        :param timestamps.LatencyTracker latency: The tracker of the capture to PUBACK
+            latency, optional.
+        """
+        self._client = client
+        self._queue = queue
+        self._latency = latency
+        self.drain_rate = drain_rate
+        self.drain_batch = drain_batch
+        self.max_inflight = max_inflight
+
+        self._on_connect = None
+        self._on_publish = None
+        self._on_disconnect = None
+        self._condition = threading.Condition()
+        self._connected = False
+        self._running = False
+        self._thread = None
+        # messages sent but not yet acknowledged: (position after the record, info).
+        self._inflight = collections.deque()
+        # (device_id, capture times) of the messages in flight, by mid.
+        self._captures = {}
+        self._backlog_end = queue.write_position
+
+        client.on_connect = self._handle_connect
+        client.on_publish = self._handle_publish
+        client.on_disconnect = self._handle_disconnect
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False,
+                capture_times=None):
+        """Appends a message to the store. Returns None, as the message is sent later.
+
+        :param capture_times: The capture times (in milliseconds since epoch) of the
+            readings of the message, whose latency is reported when it is acknowledged.
+        """
+        if self._queue.append(topic, payload, qos, capture_times):
+            with self._condition:
+                self._condition.notify_all()
+        return None
+
+    def loop_start(self):
+        """Starts the wrapped client loop and the sending thread.
+        """
+        self._client.loop_start()
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="store-and-forward", daemon=True)
+        self._thread.start()
+
+    def disconnect(self):
+        """Stops the sending thread and disconnects the wrapped client.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._client.disconnect()
+        self._queue.close()
+
+    @property
+    def on_connect(self):
+        return self._on_connect
+
+    @on_connect.setter
+    def on_connect(self, func):
+        self._on_connect = func
+
+    @property
+    def on_publish(self):
+        return self._on_publish
+
+    @on_publish.setter
+    def on_publish(self, func):
+        self._on_publish = func
+
+    @property
+    def on_disconnect(self):
+        return self._on_disconnect
+
+    @on_disconnect.setter
+    def on_disconnect(self, func):
+        self._on_disconnect = func
+
+    @property
+    def on_message(self):
+        return self._client.on_message
+
+    @on_message.setter
+    def on_message(self, func):
+        # received messages do not go through the store.
+        self._client.on_message = func
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            with self._condition:
+                self._connected = True
+                self._backlog_end = self._queue.write_position
+                self._condition.notify_all()
+        if self._on_connect is not None:
+            self._on_connect(self, userdata, flags, rc)
+
+    def _handle_disconnect(self, client, userdata, rc):
+        with self._condition:
+            self._connected = False
+        if self._on_disconnect is not None:
+            self._on_disconnect(self, userdata, rc)
+
+    def _handle_publish(self, client, userdata, mid):
+        with self._condition:
+            capture = self._captures.pop(mid, None)
+            self._condition.notify_all()
+        if capture is not None:
+            self._latency.acknowledged(*capture)
+        if self._on_publish is not None:
+            self._on_publish(self, userdata, mid)
+
+    def _run(self):
+        next_backlog_send = time.monotonic()
+        while True:
+            with self._condition:
+                acknowledged = self._commit_acknowledged()
+                while self._running and not (
+                        self._connected and self._queue
+                        and len(self._inflight) < self.max_inflight):
+                    # the timeout guards against an acknowledgement racing the checks.
+                    self._condition.wait(1.0)
+                    acknowledged += self._commit_acknowledged()
+                running = self._running
+                count = min(self.drain_batch, self.max_inflight - len(self._inflight))
+            for capture in acknowledged:
+                self._latency.acknowledged(*capture)
+            if not running:
+                return
+
+            for position, topic, payload, qos, times in self._queue.read(count):
+                in_backlog = position <= self._backlog_end
+                if in_backlog:
+                    delay = next_backlog_send - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_backlog_send = max(next_backlog_send, time.monotonic()) \
+                        + 1 / self.drain_rate
+                info = self._client.publish(topic, payload, qos)
+                sent_messages.inc(kind="backlog" if in_backlog else "live")
+                with self._condition:
+                    self._inflight.append((position, info))
+                    if times and qos > 0 and self._latency is not None:
+                        self._captures[info.mid] = (_device_id_from_topic(topic), times)
+
+    def _commit_acknowledged(self):
+        """Commits the records acknowledged in order. Called with the condition held.
+        Returns the captures of the messages whose acknowledgement was handled before
+        their capture times were recorded.
+        """
+        position = None
+        acknowledged = []
+        while self._inflight and self._inflight[0][1].is_published():
+            position, info = self._inflight.popleft()
+            if self._captures:
+                capture = self._captures.pop(info.mid, None)
+                if capture is not None:
+                    acknowledged.append(capture)
+        if position is not None:
+            self._queue.commit(position)
+        return acknowledged
+
+
+def _device_id_from_topic(topic: str) -> str:
+    # topics have the form "$iothub/{device_id}/..."
+    return topic.split("/", 2)[1]
@@ -0,0 +1,151 @@
+"""This module contains the capture timestamps of the readings and the latency they
+are measured against.
+
+Readings are stamped when they are captured with a monotonic clock anchored to the
+wall clock, so the stamps of a module run are ordered the way the readings were
+received even if the wall clock steps (an NTP correction for instance). The stamp is a
+field of the reading, carried through the ingest, suppression and batching stages
+into the payload, and the latency from capture to PUBACK is tracked per device.
+"""
+
+import collections
+import datetime
+import threading
+import time
+
+from metrics import REGISTRY
+
+# the field of the decoded readings holding their capture time.
+FIELD = "timestamp"
+
+stage_latency = REGISTRY.histogram(
+    "ptm_capture_latency_seconds",
+    "Time from the capture of a reading to a stage: ingest (dequeued by a worker), "
+    "publish (handed to the upstream client) and puback (acknowledged)",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+device_latency = REGISTRY.gauge(
+    "ptm_device_capture_to_puback_seconds",
+    "Percentiles of the time from capture to PUBACK of the recent readings by device")
+
+# the percentiles reported per device.
+_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class CaptureClock:
+    """A monotonic clock anchored to the wall clock when it is created: its time is the
+    wall time of the anchor plus the monotonic time elapsed since.
+
+    The module-wide CLOCK is created at import, before the scanner processes are
+    forked, so their stamps use the same anchor (the monotonic clock is system-wide).
+    """
+
+    def __init__(self):
+        self._wall = time.time()
+        self._monotonic = time.monotonic()
+
+    def now(self) -> float:
+        """Returns the time, in seconds since the epoch.
+        """
+        return self._wall + time.monotonic() - self._monotonic
+
+    def now_ms(self) -> int:
+        """Returns the time, in milliseconds since the epoch.
+        """
+        return int((self._wall + time.monotonic() - self._monotonic) * 1000)
+
+
+CLOCK = CaptureClock()
+
+
+def stamp(reading, timestamp: int = None):
+    """Sets the capture time (in milliseconds since the epoch) of a decoded reading, a
+    dict or a sources.Reading, to now unless given. Returns the reading.
+    """
+    if timestamp is None:
+        timestamp = CLOCK.now_ms()
+    if isinstance(reading, dict):
+        reading[FIELD] = timestamp
+    else:
+        reading.timestamp = timestamp
+    return reading
+
+
+def capture_times(batch) -> list:
+    """Returns the capture times of the readings of a batch which have one: a list of
+    readings, or any batch with a capture_times method (such as raw.RawBatch).
+    """
+    method = getattr(batch, "capture_times", None)
+    if method is not None:
+        return method()
+    times = []
+    for reading in batch:
+        timestamp = reading.get(FIELD)
+        if timestamp is not None:
+            times.append(timestamp)
+    return times
+
+
+def creation_time(timestamp: int) -> str:
+    """Formats a capture time as the iothub-creation-time-utc message property.
+    """
+    return datetime.datetime.utcfromtimestamp(timestamp / 1000).isoformat(
+        timespec="milliseconds") + "Z"
+
+
+class LatencyTracker:
+    """Keeps the capture to PUBACK latency of the last ``window`` readings of every
+    device, and reports their percentiles in the ptm_device_capture_to_puback_seconds
+    gauge, computed when the metrics are collected. Share one tracker between the
+    publishers, as the values of the gauge functions are summed.
+    """
+
+    def __init__(self, window: int = 256):
+        """
+        :param int window: The number of recent readings per device the percentiles are
+            computed over.
+        """
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+        device_latency.add_function(self.percentiles)
+
+    def acknowledged(self, device_id: str, times, now: float = None):
+        """Records the latency of readings acknowledged now.
+
+        :param str device_id: The device of the readings.
+        :param times: The capture times of the readings, in milliseconds since epoch.
+        """
+        if not times:
+            return
+        if now is None:
+            now = CLOCK.now()
+        latencies = [now - timestamp / 1000 for timestamp in times]
+        with self._lock:
+            samples = self._samples.get(device_id)
+            if samples is None:
+                samples = self._samples[device_id] = collections.deque(maxlen=self.window)
+            samples.extend(latencies)
+        for latency in latencies:
+            stage_latency.observe(latency, stage="puback")
+
+    def percentiles(self) -> dict:
+        values = {}
+        with self._lock:
+            devices = [(device_id, sorted(samples))
+                       for device_id, samples in self._samples.items()]
+        for device_id, ordered in devices:
+            for quantile in _QUANTILES:
+                index = min(len(ordered) - 1, int(quantile * len(ordered)))
+                values[(("device", device_id), ("quantile", str(quantile)))] = ordered[index]
+        return values
+
+
+def observe(stage: str, times, now: float = None):
+    """Records the latency from capture to a stage of readings.
+    """
+    if not times:
+        return
+    if now is None:
+        now = CLOCK.now()
+    for timestamp in times:
+        stage_latency.observe(now - timestamp / 1000, stage=stage)
@@ -0,0 +1,278 @@
+"""This module contains a manager minting and renewing the SAS tokens of many
+identities with one signing mechanism, signing them concurrently and caching the
+signatures, so startup and renewal load stay flat as the number of identities grows.
+"""
+
+import logging
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import edge.sastoken as auth
+from metrics import REGISTRY
+from token_renewal import token_refreshes
+
+logger = logging.getLogger(__name__)
+
+signatures = REGISTRY.counter(
+    "ptm_token_signatures_total", "Number of SAS token signatures by source (cache or hsm)")
+
+# delay before retrying a failed renewal, doubled up to the maximum.
+_MIN_RETRY_DELAY = 1
+_MAX_RETRY_DELAY = 60
+
+
+class ManagedSasToken(auth.RenewableSasToken):
+    """A RenewableSasToken signed by a TokenManager. Its expiry time is set by the
+    manager, and refresh() goes through the manager signature cache.
+    """
+
+    def __init__(self, uri, manager, key_name=None, ttl=3600):
+        """
+        :param str uri: URI of the resource to be accessed
+        :param TokenManager manager: The manager signing the token
+        :param str key_name: Symmetric Key Name (optional)
+        :param int ttl: Time to live for the token, in seconds (default 3600)
+        """
+        self._uri = uri
+        self._signing_mechanism = manager.signing_mechanism
+        self._key_name = key_name
+        self._manager = manager
+        self._expiry_time = None  # This will be overwritten by the manager
+        self._token = None  # This will be overwritten by the manager
+
+        self.ttl = ttl
+
+    def refresh(self):
+        """
+        Refresh the SasToken lifespan, giving it a new expiry time, and generating a new token.
+        """
+        self._manager.refresh([self])
+
+
+class TokenManager:
+    """Mints and renews the SAS tokens of many identities.
+
+    Expiry times are rounded down to a multiple of ``bucket`` seconds, and each token
+    lifetime is shortened by a stable offset of up to ``spread`` of the ttl derived
+    from its URI, so tokens minted together do not all expire (and renew) at once,
+    while the ones falling in the same bucket renew together, as one batch.
+
+    Signatures are cached by (URI, expiry time): minting a token whose signature was
+    already requested in the same bucket, by another connection of the same identity
+    for instance, waits for that request instead of signing again. Signing requests run
+    on a bounded thread pool.
+
+    Tokens registered with ``schedule`` are renewed from one background thread once
+    ``renewal_ratio`` of their lifetime has elapsed.
+    """
+
+    def __init__(self, signing_mechanism, ttl: int = 3600, renewal_ratio: float = 0.8,
+                 max_workers: int = 4, bucket: int = 60, spread: float = 0.1):
+        """
+        :param signing_mechanism: The signing mechanism of all the tokens, such as an
+            IoTEdgeHsm. Its sign method must be thread-safe.
+        :param int ttl: The time to live (in seconds) of the tokens.
+        :param float renewal_ratio: Fraction of the ttl after which tokens are renewed.
+        :param int max_workers: The maximum number of concurrent signing requests.
+        :param int bucket: The granularity (in seconds) of the expiry times.
+        :param float spread: The maximum fraction of the ttl a token lifetime is
+            shortened by.
+        """
+        if not 0 < renewal_ratio < 1:
+            raise ValueError("renewal_ratio must be between 0 and 1")
+        if not 0 <= spread < 1 - renewal_ratio:
+            raise ValueError("spread must be between 0 and 1 - renewal_ratio")
+
+        self.signing_mechanism = signing_mechanism
+        self.ttl = ttl
+        self.renewal_ratio = renewal_ratio
+        self._max_offset = int(ttl * spread)
+        # a renewed token must not be due for renewal again right away.
+        self.bucket = max(1, min(bucket, (int(ttl * renewal_ratio) - self._max_offset) // 2))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="sastoken-sign")
+        # signature futures by (uri, expiry time).
+        self._signatures = {}
+        self._signatures_lock = threading.Lock()
+
+        self._registrations = []
+        self._registrations_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def token(self, uri: str, key_name: str = None) -> ManagedSasToken:
+        """Mints the token of a resource URI.
+
+        :raises: ValueError if the token cannot be signed.
+        """
+        return self.tokens([uri], key_name)[0]
+
+    def tokens(self, uris, key_name: str = None) -> list:
+        """Mints the tokens of several resource URIs, signing them concurrently.
+
+        :raises: ValueError if a token cannot be signed.
+        """
+        tokens = [ManagedSasToken(uri, self, key_name, self.ttl) for uri in uris]
+        self.refresh(tokens)
+        return tokens
+
+    def refresh(self, tokens):
+        """Gives new expiry times and signatures to tokens, signing them concurrently.
+        Tokens whose signing fails are left intact.
+
+        :raises: ValueError with the first signing error, once all the tokens are done.
+        """
+        now = time.time()
+        pending = []
+        with self._signatures_lock:
+            # signatures of older buckets will not be requested anymore.
+            oldest = now + self.ttl - self._max_offset - self.bucket
+            for key in [key for key in self._signatures if key[1] < oldest]:
+                del self._signatures[key]
+
+            for token in tokens:
+                expiry_time = self._expiry_time(token._uri, now)
+                key = (token._uri, expiry_time)
+                future = self._signatures.get(key)
+                if future is None:
+                    future = self._signatures[key] = self._executor.submit(
+                        self.signing_mechanism.sign, token._signing_message(expiry_time))
+                    signatures.inc(source="hsm")
+                else:
+                    signatures.inc(source="cache")
+                pending.append((token, key, future))
+
+        error = None
+        for token, key, future in pending:
+            try:
+                signature = future.result()
+            except Exception as e:
+                with self._signatures_lock:
+                    if self._signatures.get(key) is future:
+                        del self._signatures[key]
+                error = error or e
+                continue
+            token._expiry_time, token._token = key[1], token._format_token(signature, key[1])
+        if error is not None:
+            raise ValueError("Unable to build SasToken from given values", error)
+
+    def schedule(self, token: ManagedSasToken, renewed, name: str = "sastoken"):
+        """Returns a scheduler renewing a token in the background, with the same start
+        and stop methods as a TokenRenewalScheduler.
+
+        :param ManagedSasToken token: A token minted by this manager.
+        :param renewed: A callable applying the new credentials, called after every
+            renewal of the token.
+        :param str name: A name used in logs to identify the token.
+        """
+        return _Registration(self, token, renewed, name)
+
+    def stop(self):
+        """Stops renewing tokens and shuts the signing threads down.
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self._executor.shutdown(wait=False)
+
+    def _expiry_time(self, uri, now):
+        offset = zlib.crc32(uri.encode("utf-8")) % (self._max_offset + 1)
+        expiry_time = int(now + self.ttl - offset)
+        return expiry_time - expiry_time % self.bucket
+
+    def _add(self, registration):
+        with self._registrations_lock:
+            if registration in self._registrations:
+                return
+            self._registrations.append(registration)
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name="renew-sastokens",
+                                                daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _remove(self, registration):
+        with self._registrations_lock:
+            if registration in self._registrations:
+                self._registrations.remove(registration)
+
+    def _run(self):
+        while not self._stopped:
+            with self._registrations_lock:
+                registrations = list(self._registrations)
+            now = time.time()
+            due = [registration for registration in registrations
+                   if registration.next_time <= now]
+            if not due:
+                timeout = min((registration.next_time for registration in registrations),
+                              default=None)
+                self._wakeup.wait(None if timeout is None else timeout - now)
+                self._wakeup.clear()
+                continue
+
+            logger.info(f"renewing {len(due)} token(s).")
+            try:
+                self.refresh([registration.token for registration in due])
+            except ValueError:
+                # the tokens which failed still have their old expiry time.
+                pass
+            for registration in due:
+                registration.check(now)
+
+
+class _Registration:
+    """A token renewed by the TokenManager background thread.
+    """
+
+    def __init__(self, manager, token, renewed, name):
+        self.manager = manager
+        self.token = token
+        self.name = name
+        self._renewed = renewed
+        self._retry_delay = _MIN_RETRY_DELAY
+        self.next_time = self.next_renewal_time()
+
+    def start(self):
+        """Starts renewing the token. Calling start on a running scheduler does nothing.
+        """
+        self.next_time = self.next_renewal_time()
+        self.manager._add(self)
+
+    def stop(self):
+        """Stops renewing the token.
+        """
+        self.manager._remove(self)
+
+    def next_renewal_time(self) -> float:
+        """Returns the time (in UTC, since epoch) of the next scheduled renewal.
+        """
+        return self.token.expiry_time - self.token.ttl * (1 - self.manager.renewal_ratio)
+
+    def check(self, renewed_at):
+        """Applies the token if it was renewed at or after renewed_at, schedules a retry
+        otherwise.
+        """
+        renewal_time = self.next_renewal_time()
+        if renewal_time > renewed_at:
+            try:
+                self._renewed()
+            except Exception:
+                logger.exception(f"failed to apply the renewed {self.name} token.")
+            else:
+                token_refreshes.inc(result="success")
+                self._retry_delay = _MIN_RETRY_DELAY
+                self.next_time = renewal_time
+                return
+
+        token_refreshes.inc(result="failure")
+        remaining = self.token.expiry_time - time.time()
+        logger.error(
+            f"failed to renew {self.name} token, {remaining:.0f}s before expiry. "
+            f"Retrying in {self._retry_delay}s.")
+        self.next_time = time.time() + self._retry_delay
+        self._retry_delay = min(self._retry_delay * 2, _MAX_RETRY_DELAY)
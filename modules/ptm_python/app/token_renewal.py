@@ -0,0 +1,92 @@
+"""This module contains a background scheduler which renews a SAS token before it
+expires, so the broker never has to reject a connection because of an expired token.
+"""
+
+import logging
+import threading
+import time
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+token_refreshes = REGISTRY.counter(
+    "ptm_token_refresh_total", "Number of SAS token renewals by result")
+
+# delay before retrying a failed renewal, doubled up to the maximum.
+_MIN_RETRY_DELAY = 1
+_MAX_RETRY_DELAY = 60
+
+
+class TokenRenewalScheduler:
+    """Calls ``renew`` on a background thread once ``renewal_ratio`` of the token time
+    to live has elapsed, i.e. at ``expiry_time - ttl * (1 - renewal_ratio)``.
+
+    Failed renewals are retried with an exponential backoff until the token expires.
+    """
+
+    def __init__(self, token, renew, renewal_ratio: float = 0.8, name: str = "sastoken"):
+        """
+        :param token: The RenewableSasToken to watch (for its expiry_time and ttl).
+        :param renew: A callable renewing the token and applying the new credentials.
+        :param float renewal_ratio: Fraction of the ttl after which the token is renewed.
+        :param str name: A name used in logs to identify the token.
+        """
+        if not 0 < renewal_ratio < 1:
+            raise ValueError("renewal_ratio must be between 0 and 1")
+
+        self._token = token
+        self._renew = renew
+        self.renewal_ratio = renewal_ratio
+        self.name = name
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the renewal thread. Calling start on a running scheduler does nothing.
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"renew-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the renewal thread.
+        """
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def next_renewal_time(self) -> float:
+        """Returns the time (in UTC, since epoch) of the next scheduled renewal.
+        """
+        return self._token.expiry_time - self._token.ttl * (1 - self.renewal_ratio)
+
+    def _run(self):
+        retry_delay = _MIN_RETRY_DELAY
+        while not self._stopped.wait(max(0, self.next_renewal_time() - time.time())):
+            issued_at = self._token.expiry_time - self._token.ttl
+            age = time.time() - issued_at
+            logger.info(
+                f"renewing {self.name} token, age {age:.0f}s of {self._token.ttl}s ttl.")
+            try:
+                self._renew()
+            except Exception:
+                token_refreshes.inc(result="failure")
+                remaining = self._token.expiry_time - time.time()
+                logger.exception(
+                    f"failed to renew {self.name} token, {remaining:.0f}s before expiry. "
+                    f"Retrying in {retry_delay}s.")
+                if self._stopped.wait(retry_delay):
+                    return
+                retry_delay = min(retry_delay * 2, _MAX_RETRY_DELAY)
+                continue
+
+            token_refreshes.inc(result="success")
+            retry_delay = _MIN_RETRY_DELAY
+            logger.info(
+                f"renewed {self.name} token, new expiry in "
+                f"{self._token.expiry_time - time.time():.0f}s.")
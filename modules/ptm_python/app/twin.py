@@ -0,0 +1,90 @@
+"""This module contains the handling of the module twin desired properties, read
+and watched over the MQTT connection to the edgeHub broker with the IoT Hub twin
+topics of the module identity.
+"""
+
+import itertools
+import json
+import logging
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+
+class DesiredProperties:
+    """Requests the module twin desired properties every time the client connects,
+    and receives their updates. callback(properties, complete) is called with either
+    the complete desired properties (complete is True) or a patch of them, where a
+    None value means the property was removed.
+    """
+
+    def __init__(self, client, identity: str, callback):
+        """
+        :param client: The upstream client, with ModuleClient compatible publish,
+            subscribe and message_callback_add.
+        :param str identity: The module identity, "{device_id}/{module_id}".
+        :param callback: The function called with the desired properties.
+        """
+        self._client = client
+        self._callback = callback
+        self._prefix = f"$iothub/{identity}/twin"
+        self._version = None
+        self._request_ids = itertools.count(1)
+        self._pending = set()
+        client.message_callback_add(f"{self._prefix}/res/#", self._handle_response)
+        client.message_callback_add(f"{self._prefix}/desired/#", self._handle_patch)
+
+    def on_connect(self, client):
+        """To be called when a client connected. Subscribes to the twin topics and
+        requests the twin, if the client is the one the desired properties are read with.
+        Returns the result of the request publish, a coroutine with an AsyncModuleClient.
+        """
+        if client.client_id != self._client.client_id:
+            return None
+        self._client.subscribe(f"{self._prefix}/res/#", qos=0)
+        self._client.subscribe(f"{self._prefix}/desired/#", qos=0)
+
+        request_id = str(next(self._request_ids))
+        self._pending.add(request_id)
+        return self._client.publish(f"{self._prefix}/get/?$rid={request_id}", qos=0)
+
+    def _handle_response(self, client, userdata, message):
+        # topic: $iothub/{identity}/twin/res/{status}/?$rid={request_id}
+        path, _, query = message.topic.partition("?")
+        status = path.rstrip("/").rsplit("/", 1)[-1]
+        request_id = urllib.parse.parse_qs(query).get("$rid", [None])[0]
+        if request_id not in self._pending:
+            return
+        self._pending.discard(request_id)
+        if status != "200":
+            logger.warning(f"module twin request failed with status {status}.")
+            return
+
+        try:
+            desired = json.loads(message.payload)["desired"]
+        except (ValueError, KeyError, TypeError):
+            logger.exception("cannot decode the module twin.")
+            return
+        self._version = desired.get("$version")
+        self._notify(desired, True)
+
+    def _handle_patch(self, client, userdata, message):
+        try:
+            patch = json.loads(message.payload)
+        except ValueError:
+            logger.exception("cannot decode the module twin desired properties patch.")
+            return
+        version = patch.get("$version")
+        if self._version is not None and version is not None and version <= self._version:
+            # already part of the twin received when connecting.
+            return
+        self._version = version
+        self._notify(patch, False)
+
+    def _notify(self, properties, complete):
+        properties = {name: value for name, value in properties.items()
+                      if not name.startswith("$")}
+        try:
+            self._callback(properties, complete)
+        except Exception:
+            logger.exception("failed to apply the module twin desired properties.")
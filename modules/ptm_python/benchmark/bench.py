@@ -0,0 +1,223 @@
+"""Measures the throughput of the PTM pipeline (app/main.py) without sensors nor
+edgeHub: synthetic sensors feed the module, which gets its SAS token from a fake
+workload API and publishes to a local broker.
+
+Reports the readings and messages per second received by the broker, the
+end-to-end latency percentiles of the readings (JSON payloads only), and the CPU
+and memory used by the module process. Linux only, and requires openssl to
+generate the broker certificate.
+
+    python bench.py --sensors 100 --rate 1 --duration 30 --env BATCH_MAX_SIZE=50
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from broker import Broker
+from sensors import sensor_macs
+from workload_api import WorkloadApi
+
+_BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+# port of the edgeHub MQTT broker, as used by main.py.
+_MQTT_PORT = 8883
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of sorted values, None if there are none.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def create_certificate(directory):
+    """Creates a self-signed certificate for localhost. Returns (cert file, key file).
+    """
+    cert, key = os.path.join(directory, "broker.crt"), os.path.join(directory, "broker.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+class ModuleProcess:
+    """The module process, fed by synthetic sensors.
+    """
+
+    def __init__(self, env, log_file):
+        self.metrics_port = _free_port()
+        env = dict(os.environ, **env, METRICS_PORT=str(self.metrics_port))
+        self._process = subprocess.Popen(
+            [sys.executable, "-u", os.path.join(_BENCHMARK_DIR, "sensors.py")],
+            env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        self._ticks = os.sysconf("SC_CLK_TCK")
+
+    def running(self):
+        return self._process.poll() is None
+
+    def cpu_time(self):
+        """Returns the user and system CPU time (in seconds) used so far.
+        """
+        with open(f"/proc/{self._process.pid}/stat") as f:
+            # the command name, in parentheses, may contain spaces.
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / self._ticks
+
+    def memory(self):
+        """Returns the current and peak resident set size, in bytes.
+        """
+        status = {}
+        with open(f"/proc/{self._process.pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                status[name] = value.split()
+        return int(status["VmRSS"][0]) * 1024, int(status["VmHWM"][0]) * 1024
+
+    def advertisements(self):
+        """Returns the number of advertisements the module received, from its metrics.
+        """
+        url = f"http://127.0.0.1:{self.metrics_port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            lines = response.read().decode("utf-8").splitlines()
+        return sum(float(line.rpartition(" ")[2]) for line in lines
+                   if line.startswith("ptm_ble_advertisements_total"))
+
+    def stop(self):
+        self._process.send_signal(signal.SIGTERM)
+        try:
+            self._process.wait(10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+
+
+def run(sensors, rate, duration, warmup, ack_delay, env, log_path):
+    """Runs the module for warmup + duration seconds and returns the measurements
+    taken during the last duration seconds, as a dict.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = create_certificate(directory)
+        with open(cert) as f:
+            certificate = f.read()
+
+        workload_api = WorkloadApi(os.path.join(directory, "workload.sock"), certificate)
+        workload_api.start()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        broker = Broker(port=_MQTT_PORT, ssl_context=context, ack_delay=ack_delay)
+        broker.start()
+
+        macs = sensor_macs(sensors)
+        module_env = {
+            "IOTEDGE_IOTHUBHOSTNAME": "benchmark.azure-devices.net",
+            "IOTEDGE_GATEWAYHOSTNAME": "127.0.0.1",
+            "IOTEDGE_DEVICEID": "benchmark-gateway",
+            "IOTEDGE_MODULEID": "ptm",
+            "IOTEDGE_MODULEGENERATIONID": "1",
+            "IOTEDGE_WORKLOADURI": workload_api.uri,
+            "IOTEDGE_APIVERSION": "2019-01-30",
+            "AUTHORIZED_DEVICES": json.dumps(
+                {mac: f"sensor-{index}" for index, mac in enumerate(macs)}),
+            "BENCH_SENSORS": str(sensors),
+            "BENCH_RATE": str(rate),
+        }
+        module_env.update(env)
+
+        with open(log_path, "w") as log_file:
+            module = ModuleProcess(module_env, log_file)
+            try:
+                time.sleep(warmup)
+                if not module.running():
+                    raise RuntimeError(f"the module exited, see {log_path}")
+                broker.take_stats()
+                start, cpu, advertisements = \
+                    time.monotonic(), module.cpu_time(), module.advertisements()
+                time.sleep(duration)
+                stats = broker.take_stats()
+                elapsed = time.monotonic() - start
+                cpu = module.cpu_time() - cpu
+                advertisements = module.advertisements() - advertisements
+                rss, peak_rss = module.memory()
+            finally:
+                module.stop()
+                broker.stop()
+                workload_api.stop()
+
+    latencies = sorted(stats.latencies)
+    return {
+        "sensors": sensors,
+        "rate": rate,
+        "offered_per_second": sensors * rate,
+        "advertisements_per_second": advertisements / elapsed,
+        "readings_per_second": stats.readings / elapsed,
+        "messages_per_second": stats.messages / elapsed,
+        "bytes_per_second": stats.bytes / elapsed,
+        "latency_seconds": {name: percentile(latencies, fraction) for name, fraction in
+                            (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1))},
+        "cpu_percent": 100 * cpu / elapsed,
+        "rss_bytes": rss,
+        "peak_rss_bytes": peak_rss,
+        "sign_requests": workload_api.requests["sign"],
+    }
+
+
+def format_report(result):
+    def ms(value):
+        return "n/a" if value is None else f"{value * 1000:.1f} ms"
+
+    latency = result["latency_seconds"]
+    return "\n".join([
+        f"sensors           {result['sensors']} x {result['rate']} Hz "
+        f"({result['offered_per_second']:.0f} advertisements/s offered)",
+        f"advertisements/s  {result['advertisements_per_second']:.1f}",
+        f"readings/s        {result['readings_per_second']:.1f}",
+        f"messages/s        {result['messages_per_second']:.1f} "
+        f"({result['bytes_per_second'] / 1024:.1f} KiB/s)",
+        f"latency           p50 {ms(latency['p50'])}, p90 {ms(latency['p90'])}, "
+        f"p99 {ms(latency['p99'])}, max {ms(latency['max'])}",
+        f"cpu               {result['cpu_percent']:.1f} %",
+        f"rss               {result['rss_bytes'] / 2 ** 20:.1f} MiB "
+        f"(peak {result['peak_rss_bytes'] / 2 ** 20:.1f} MiB)",
+    ])
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sensors", type=int, default=10, help="number of sensors")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="advertisements per second of each sensor")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="measurement time, in seconds")
+    parser.add_argument("--warmup", type=float, default=5,
+                        help="time (in seconds) before measuring")
+    parser.add_argument("--ack-delay-ms", type=float, default=0,
+                        help="delay of the broker acknowledgements")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="module setting, such as BATCH_MAX_SIZE=50 (repeatable)")
+    parser.add_argument("--log", default="bench_module.log", help="module log file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    env = dict(setting.split("=", 1) for setting in args.env)
+    result = run(args.sensors, args.rate, args.duration, args.warmup,
+                 args.ack_delay_ms / 1000, env, args.log)
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+
+
+if __name__ == "__main__":
+    main()
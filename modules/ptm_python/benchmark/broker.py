@@ -0,0 +1,199 @@
+"""A minimal MQTT 3.1.1 broker standing in for the edgeHub. It accepts every
+connection, acknowledges every message and decodes the PTM telemetry payloads to
+count readings and measure their end-to-end latency. Messages are not routed to
+subscribers.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+logger = logging.getLogger(__name__)
+
+_CONNECT, _PUBLISH, _PUBREL, _SUBSCRIBE, _UNSUBSCRIBE, _PINGREQ, _DISCONNECT = \
+    1, 3, 6, 8, 10, 12, 14
+
+_EVENTS = "/messages/events"
+# header of the binary and raw payloads: format version, record count.
+_BATCH_HEADER = struct.Struct("<BH")
+
+
+class Stats:
+    """What the broker received since the stats were last taken.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.readings = 0
+        # end-to-end latencies (in seconds) of the readings carrying a benchmark_time.
+        self.latencies = []
+
+
+class Broker:
+    """Serves MQTT on a TCP port, with TLS if an ssl context is given, from an event
+    loop running on a background thread.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8883, ssl_context=None,
+                 ack_delay: float = 0):
+        """
+        :param str host: The address to listen on.
+        :param int port: The port to listen on.
+        :param ssl_context: The server TLS context, plain TCP if None.
+        :param float ack_delay: The time (in seconds) before a PUBACK is sent.
+        """
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.ack_delay = ack_delay
+        self._lock = threading.Lock()
+        self._stats = Stats()
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Starts listening, returns once the port is bound.
+        """
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._server = self._loop.run_until_complete(asyncio.start_server(
+                    self._handle, self.host, self.port, ssl=self.ssl_context))
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="broker", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def take_stats(self) -> Stats:
+        """Returns the stats accumulated since the last call and starts new ones.
+        """
+        with self._lock:
+            stats, self._stats = self._stats, Stats()
+        return stats
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                header, body = await _read_packet(reader)
+                kind = header >> 4
+                if kind == _CONNECT:
+                    writer.write(b"\x20\x02\x00\x00")
+                elif kind == _PUBLISH:
+                    self._publish(header, body, writer)
+                elif kind == _PUBREL:
+                    writer.write(b"\x70\x02" + body[:2])
+                elif kind == _SUBSCRIBE:
+                    # grant QoS 1 at most to every topic filter.
+                    granted, offset = bytearray(), 2
+                    while offset < len(body):
+                        length = struct.unpack_from("!H", body, offset)[0]
+                        granted.append(min(body[offset + 2 + length], 1))
+                        offset += 3 + length
+                    writer.write(_packet(0x90, body[:2] + granted))
+                elif kind == _UNSUBSCRIBE:
+                    writer.write(b"\xb0\x02" + body[:2])
+                elif kind == _PINGREQ:
+                    writer.write(b"\xd0\x00")
+                elif kind == _DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _publish(self, header, body, writer):
+        now = time.time()
+        qos = header >> 1 & 3
+        length = struct.unpack_from("!H", body)[0]
+        topic = body[2:2 + length].decode("utf-8")
+        offset = 2 + length
+        packet_id = body[offset:offset + 2]
+        if qos:
+            offset += 2
+        readings, latencies = _decode(topic, body[offset:], now)
+
+        with self._lock:
+            stats = self._stats
+            stats.messages += 1
+            stats.bytes += len(body) - offset
+            stats.readings += readings
+            stats.latencies.extend(latencies)
+
+        if qos:
+            ack = (b"\x40\x02" if qos == 1 else b"\x50\x02") + packet_id
+            if self.ack_delay:
+                self._loop.call_later(self.ack_delay, _write, writer, ack)
+            else:
+                writer.write(ack)
+
+
+def _write(writer, data):
+    if not writer.is_closing():
+        writer.write(data)
+
+
+async def _read_packet(reader):
+    header = (await reader.readexactly(1))[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header, await reader.readexactly(length)
+
+
+def _packet(header, body):
+    encoded, length = bytearray((header,)), len(body)
+    while True:
+        byte, length = length & 0x7F, length >> 7
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded) + bytes(body)
+
+
+def _decode(topic, payload, now):
+    """Returns the number of readings in a telemetry message and the latency of the
+    ones carrying a benchmark_time.
+    """
+    _, events, properties = topic.partition(_EVENTS)
+    if not events:
+        return 0, []
+    properties = urllib.parse.parse_qs(properties.lstrip("/"))
+    if properties.get("compression") == ["deflate"]:
+        payload = zlib.decompress(payload)
+
+    if properties.get("$.ct") == ["application/json"]:
+        readings = json.loads(payload)
+        if not isinstance(readings, list):
+            readings = [readings]
+        return len(readings), [now - reading["benchmark_time"] for reading in readings
+                               if isinstance(reading, dict) and "benchmark_time" in reading]
+    if "format" in properties and len(payload) >= _BATCH_HEADER.size:
+        return _BATCH_HEADER.unpack_from(payload)[1], []
+    return 1, []
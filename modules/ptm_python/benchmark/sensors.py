@@ -0,0 +1,97 @@
+"""Synthetic RuuviTag sensors replacing RuuviTagSensor.get_datas, to run the PTM
+without bluetooth hardware.
+
+Run as a script, it starts app/main.py with its scanner replaced by
+BENCH_SENSORS synthetic tags advertising BENCH_RATE times per second each.
+"""
+
+import math
+import os
+import runpy
+import sys
+import time
+
+# RuuviTag sensors advertise from static random addresses, which start with 0b11.
+_MAC_PREFIX = "F0:00"
+
+
+def sensor_macs(count: int):
+    """Returns the MAC addresses of count synthetic sensors.
+    """
+    return [f"{_MAC_PREFIX}:{i >> 24 & 0xFF:02X}:{i >> 16 & 0xFF:02X}:"
+            f"{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}" for i in range(count)]
+
+
+class SyntheticSensors:
+    """count sensors advertising rate times per second each. Their advertisements are
+    evenly spread over time and decode to RAWv2 (data format 5) readings, which also
+    carry a ``benchmark_time`` field with the time they were generated at.
+    """
+
+    def __init__(self, count: int, rate: float):
+        """
+        :param int count: The number of sensors.
+        :param float rate: The number of advertisements per second of each sensor.
+        """
+        self.count = count
+        self.rate = rate
+        self.macs = sensor_macs(count)
+
+    def reading(self, index: int, sequence: int) -> dict:
+        """Returns the reading of a sensor for a measurement sequence number.
+        """
+        phase = sequence / 600 + index
+        return {
+            "data_format": 5,
+            "humidity": round(40 + 10 * math.sin(phase), 2),
+            "temperature": round(21 + 2 * math.sin(phase / 2), 2),
+            "pressure": round(1013 + 5 * math.cos(phase), 2),
+            "acceleration": 1000.0,
+            "acceleration_x": 0,
+            "acceleration_y": 0,
+            "acceleration_z": 1000,
+            "tx_power": 4,
+            "battery": 2950,
+            "movement_counter": 0,
+            "measurement_sequence_number": sequence & 0xFFFF,
+            "mac": self.macs[index].replace(":", "").lower(),
+            "benchmark_time": time.time(),
+        }
+
+    def get_datas(self, callback, macs=[], run_flag=None, bt_device=""):
+        """Same signature as RuuviTagSensor.get_datas: calls callback((mac, reading))
+        for every advertisement of the given sensors (all of them if macs is empty)
+        until run_flag.running is False. Like the library, macs is checked for every
+        advertisement. When the callback is slower than the advertisements, they are
+        sent back to back.
+        """
+        interval = 1 / (self.rate * self.count)
+
+        start = time.monotonic()
+        sent = 0
+        while run_flag is None or run_flag.running:
+            index = sent % self.count
+            delay = start + sent * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            mac = self.macs[index]
+            if not macs or mac in macs:
+                callback((mac, self.reading(index, sent // self.count)))
+            sent += 1
+
+
+def main():
+    app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+    sys.path.insert(0, app_dir)
+    os.chdir(app_dir)
+
+    from ruuvitag_sensor.ruuvi import RuuviTagSensor
+
+    sensors = SyntheticSensors(int(os.environ.get("BENCH_SENSORS", "10")),
+                               float(os.environ.get("BENCH_RATE", "1")))
+    RuuviTagSensor.get_datas = sensors.get_datas
+    runpy.run_path(os.path.join(app_dir, "main.py"), run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""A fake IoT Edge workload API served over a unix socket, implementing the
+trust-bundle and sign endpoints used by edge.edge_hsm.IoTEdgeHsm.
+"""
+
+import base64
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+
+logger = logging.getLogger(__name__)
+
+_SIGN_PATH = re.compile(r"^/modules/[^/]+/genid/[^/]+/sign$")
+
+
+class WorkloadApi(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the workload API on a unix socket from a background thread. Signatures
+    are HMAC-SHA256 with a fixed key, and the trust bundle is the given certificate.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, certificate: str, key: bytes = b"benchmark"):
+        """
+        :param str path: The path of the unix socket, replaced if it exists.
+        :param str certificate: The PEM certificate returned as trust bundle.
+        :param bytes key: The signing key.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _Handler)
+        self.path = path
+        self.uri = f"unix://{path}"
+        self.certificate = certificate
+        self.key = key
+        self.requests = {"trust-bundle": 0, "sign": 0}
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="workload-api",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.remove(self.path)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/trust-bundle":
+            self._send(404, {"message": "not found"})
+            return
+        self.server.requests["trust-bundle"] += 1
+        self._send(200, {"certificate": self.server.certificate})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        if not _SIGN_PATH.match(self.path.split("?")[0]):
+            self._send(404, {"message": "not found"})
+            return
+        try:
+            data = base64.b64decode(json.loads(body)["data"])
+        except (ValueError, KeyError):
+            self._send(400, {"message": "invalid sign request"})
+            return
+        self.server.requests["sign"] += 1
+        digest = hmac.new(self.server.key, data, hashlib.sha256).digest()
+        self._send(200, {"digest": base64.b64encode(digest).decode()})
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients have no address.
+        return "workload-client"
+
+    def log_message(self, format, *args):
+        logger.debug("workload API: " + format, *args)
@@ -0,0 +1,8 @@
+"""The modules of the app are imported flat, the way main.py imports them from its
+directory in the module container.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
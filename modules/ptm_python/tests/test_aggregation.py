@@ -0,0 +1,99 @@
+import pytest
+
+from aggregation import AGGREGATES, BOTH, RAW, AggregationGroup, WindowAggregator
+
+
+class _Clock:
+    def __init__(self, now=1600000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _aggregator(*groups, clock=None):
+    emitted = []
+    aggregator = WindowAggregator(
+        groups, lambda device_id, aggregate: emitted.append((device_id, aggregate)),
+        clock or _Clock())
+    return aggregator, emitted
+
+
+def test_tumbling_window():
+    # windows are aligned on multiples of the hop.
+    clock = _Clock(1599999960.0)
+    aggregator, emitted = _aggregator(AggregationGroup(window=60), clock=clock)
+    for sequence, temperature in enumerate([20.0, 22.0, 21.0]):
+        assert not aggregator.add("d1", {"measurement_sequence_number": sequence,
+                                         "temperature": temperature, "humidity": None})
+        clock.now += 10
+    aggregator.emit_due()
+    assert emitted == []
+
+    clock.now = 1600000020.0
+    aggregator.emit_due()
+    [(device_id, aggregate)] = emitted
+    assert device_id == "d1"
+    assert aggregate["window_start"] == 1599999960
+    assert aggregate["window_end"] == 1600000020
+    assert aggregate["count"] == 3
+    assert aggregate["temperature"] == {"min": 20.0, "max": 22.0, "mean": 21.0}
+    # fields without a value in the window are left out.
+    assert "humidity" not in aggregate
+
+    # an emitted window is not emitted again.
+    aggregator.emit_due()
+    assert len(emitted) == 1
+
+
+def test_sliding_window():
+    clock = _Clock(1600000000.0)
+    aggregator, emitted = _aggregator(AggregationGroup(window=20, hop=10), clock=clock)
+    aggregator.add("d1", {"temperature": 1.0})
+    clock.now += 10
+    aggregator.add("d1", {"temperature": 3.0})
+    clock.now += 10
+    aggregator.emit_due()
+    # the window ending at +20 holds both panes, the one at +10 the first only.
+    assert [aggregate["temperature"]["mean"] for _, aggregate in emitted] == [1.0, 2.0]
+
+
+def test_repeated_advertisements_are_counted_once():
+    clock = _Clock()
+    aggregator, emitted = _aggregator(AggregationGroup(window=10), clock=clock)
+    for _ in range(5):
+        aggregator.add("d1", {"measurement_sequence_number": 7, "temperature": 10.0})
+    aggregator.add("d1", {"measurement_sequence_number": 8, "temperature": 20.0})
+    clock.now += 10
+    aggregator.emit_due()
+    [(_, aggregate)] = emitted
+    assert aggregate["count"] == 2
+    assert aggregate["temperature"]["mean"] == 15.0
+
+
+def test_groups_and_emit_modes():
+    aggregator, _ = _aggregator(
+        AggregationGroup(["cold-*"], emit=BOTH),
+        AggregationGroup(["raw-*"], emit=RAW),
+        AggregationGroup(["*"], emit=AGGREGATES))
+    # the first matching group applies.
+    assert aggregator.add("cold-1", {"temperature": 1.0})
+    assert aggregator.add("raw-1", {"temperature": 1.0})
+    assert not aggregator.add("other", {"temperature": 1.0})
+
+    aggregator, _ = _aggregator(AggregationGroup(["cold-*"]))
+    assert aggregator.add("other", {"temperature": 1.0})
+
+
+def test_from_dict():
+    group = AggregationGroup.from_dict(
+        {"devices": ["cold-room-*"], "window": 60, "hop": 10, "emit": "both"})
+    assert (group.window, group.hop, group.panes, group.emit) == (60, 10, 6, BOTH)
+    assert group.matches("cold-room-2") and not group.matches("office")
+
+
+@pytest.mark.parametrize("window, hop, emit", [(0, None, AGGREGATES), (60, 7, AGGREGATES),
+                                               (60, None, "nothing")])
+def test_invalid_groups(window, hop, emit):
+    with pytest.raises(ValueError):
+        AggregationGroup(window=window, hop=hop, emit=emit)
@@ -0,0 +1,72 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from commands import MessageRouter, TopicTrie
+
+
+@pytest.fixture
+def trie():
+    trie = TopicTrie()
+    trie.add("$iothub/+/methods/post/#", "method")
+    trie.add("$iothub/+/messages/c2d/post/#", "c2d")
+    trie.add("$iothub/sensor-1/twin/res/#", "twin")
+    trie.add("a/+/c", "single")
+    trie.add("a/#", "rest")
+    trie.add("#", "all")
+    return trie
+
+
+@pytest.mark.parametrize("topic, expected", [
+    ("$iothub/sensor-1/methods/post/reboot/?$rid=1", ["method"]),
+    ("$iothub/sensor-2/messages/c2d/post/%24.mid=1", ["c2d"]),
+    ("$iothub/sensor-1/twin/res/200/?$rid=2", ["twin"]),
+    ("$iothub/sensor-2/twin/res/200/?$rid=2", []),
+    ("a/b/c", ["all", "rest", "single"]),
+    ("a/b/d", ["all", "rest"]),
+    # "a/#" also matches its parent level.
+    ("a", ["all", "rest"]),
+    ("b", ["all"]),
+])
+def test_match(trie, topic, expected):
+    assert sorted(trie.match(topic)) == sorted(expected)
+
+
+def test_wildcards_do_not_match_the_first_level_of_dollar_topics():
+    trie = TopicTrie()
+    trie.add("#", "all")
+    trie.add("+/sensor-1/#", "single")
+    assert trie.match("$iothub/sensor-1/methods/post/reboot") == []
+
+
+def test_remove_prunes_empty_levels(trie):
+    trie.remove("$iothub/sensor-1/twin/res/#")
+    assert trie.match("$iothub/sensor-1/twin/res/200") == []
+    assert "sensor-1" not in trie._root.children["$iothub"].children
+    # unknown filters are ignored.
+    trie.remove("x/y")
+    trie.remove("a/+/c")
+    assert sorted(trie.match("a/b/c")) == ["all", "rest"]
+
+
+def test_router_handles_the_messages_of_a_device_in_order():
+    router = MessageRouter(workers=4)
+    received = []
+    done = threading.Event()
+
+    def handler(client, message):
+        received.append(message.payload)
+        if len(received) == 50:
+            done.set()
+
+    router.route("$iothub/+/messages/c2d/post/#", handler)
+    router.start()
+    try:
+        for i in range(50):
+            router.receive(None, None, SimpleNamespace(
+                topic="$iothub/sensor-1/messages/c2d/post/", payload=i))
+        assert done.wait(5)
+    finally:
+        router.stop()
+    assert received == list(range(50))
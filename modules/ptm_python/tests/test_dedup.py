@@ -0,0 +1,84 @@
+from dedup import Deadband, SuppressionTable, mac_to_int
+
+MAC = "FE:36:EA:1E:62:AF"
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _reading(sequence, temperature=20.0, humidity=40.0, pressure=100000):
+    return {"measurement_sequence_number": sequence, "temperature": temperature,
+            "humidity": humidity, "pressure": pressure}
+
+
+def test_mac_to_int():
+    assert mac_to_int(MAC) == 0xFE36EA1E62AF
+    assert mac_to_int("fe-36-ea-1e-62-af") == 0xFE36EA1E62AF
+
+
+def test_duplicates_are_dropped():
+    table = SuppressionTable(clock=_Clock())
+    assert table.accept(MAC, _reading(1))
+    assert not table.accept(MAC, _reading(1))
+    assert table.accept(MAC, _reading(2))
+
+
+def test_min_interval_and_heartbeat():
+    clock = _Clock()
+    table = SuppressionTable(min_interval=10, heartbeat=30, clock=clock)
+    assert table.accept(MAC, _reading(1))
+    clock.now += 5
+    assert not table.accept(MAC, _reading(2))
+    clock.now += 5
+    assert table.accept(MAC, _reading(3))
+    # the heartbeat forwards even a duplicate.
+    clock.now += 30
+    assert table.accept(MAC, _reading(3))
+
+
+def test_deadband():
+    table = SuppressionTable(deadband=Deadband(temperature=0.5), heartbeat=0, clock=_Clock())
+    assert table.accept(MAC, _reading(1, temperature=20.0))
+    assert not table.accept(MAC, _reading(2, temperature=20.4))
+    assert table.accept(MAC, _reading(3, temperature=20.6))
+    # a missing value is never within the deadband.
+    assert table.accept(MAC, {"measurement_sequence_number": 4})
+
+
+def test_alerts_skip_interval_and_deadband_but_not_duplicates():
+    table = SuppressionTable(deadband=Deadband(temperature=5), min_interval=60,
+                             clock=_Clock())
+    assert table.accept(MAC, _reading(1))
+    assert table.accept(MAC, _reading(2), alert=True)
+    assert not table.accept(MAC, _reading(2), alert=True)
+
+
+def test_min_interval_override():
+    clock = _Clock()
+    table = SuppressionTable(min_interval=0, heartbeat=30, clock=clock)
+    table.set_min_interval(MAC, 120)
+    assert table.accept(MAC, _reading(1))
+    # an override longer than the heartbeat delays the heartbeat.
+    clock.now += 60
+    assert not table.accept(MAC, _reading(2))
+    clock.now += 60
+    assert table.accept(MAC, _reading(3))
+    table.set_min_interval(MAC, None)
+    clock.now += 1
+    assert table.accept(MAC, _reading(4))
+
+
+def test_full_table_recycles_the_oldest_sensor():
+    clock = _Clock()
+    table = SuppressionTable(capacity=2, clock=clock)
+    macs = [f"00:00:00:00:00:{i:02X}" for i in range(16)]
+    for mac in macs:
+        clock.now += 1
+        assert table.accept(mac, _reading(1))
+    # the first sensors were forgotten, their reading is new again.
+    assert table.accept(macs[0], _reading(1))
@@ -0,0 +1,120 @@
+import json
+import struct
+import zlib
+
+import pytest
+
+import encoding
+
+HEADER = struct.Struct("<BHQ")
+RECORD = struct.Struct("<BhHHhhhHbBHI")
+
+
+def _decode(payload):
+    version, count, base = HEADER.unpack_from(payload)
+    assert version == encoding.RuuviBinaryEncoder.version
+    assert len(payload) == HEADER.size + count * RECORD.size
+    return base, [RECORD.unpack_from(payload, HEADER.size + i * RECORD.size)
+                  for i in range(count)]
+
+
+def _reading(**values):
+    reading = {"data_format": 5, "temperature": 24.3, "humidity": 53.49,
+               "pressure": 1000.44, "acceleration_x": -4, "acceleration_y": -4,
+               "acceleration_z": 1036, "battery": 2977, "tx_power": 4,
+               "movement_counter": 66, "measurement_sequence_number": 205,
+               "timestamp": 1600000000000}
+    reading.update(values)
+    return reading
+
+
+def test_binary_round_trip():
+    base, records = _decode(encoding.RuuviBinaryEncoder().encode(
+        [_reading(), _reading(timestamp=1600000000250)]))
+    assert base == 1600000000000
+    assert records[0] == (5, 4860, 21396, 50044, -4, -4, 1036, 2977, 4, 66, 205, 0)
+    assert records[1][-1] == 250
+
+
+def test_binary_missing_fields():
+    base, [record] = _decode(encoding.RuuviBinaryEncoder().encode([{}]))
+    assert base == 0
+    assert record == (0xFF, -0x8000, 0xFFFF, 0xFFFF, -0x8000, -0x8000, -0x8000,
+                      0xFFFF, -0x80, 0xFF, 0xFFFF, 0xFFFFFFFF)
+
+
+@pytest.mark.parametrize("field, value, expected", [
+    ("temperature", -163.835, -0x7FFF),
+    ("temperature", 163.835, 0x7FFF),
+    ("humidity", 0, 0),
+    ("humidity", 163.835, 0xFFFE),
+    ("pressure", 500.0, 0),
+    ("pressure", 1155.34, 0xFFFE),
+    ("tx_power", -127, -0x7F),
+    ("movement_counter", 254, 0xFE),
+    ("measurement_sequence_number", 65534, 0xFFFE),
+])
+def test_binary_edge_values(field, value, expected):
+    index = list(_reading()).index(field)
+    _, [record] = _decode(encoding.RuuviBinaryEncoder().encode([_reading(**{field: value})]))
+    assert record[index] == expected
+
+
+@pytest.mark.parametrize("field, value, missing", [
+    ("temperature", -163.84, -0x8000),
+    ("temperature", 200.0, -0x8000),
+    ("humidity", 163.84, 0xFFFF),
+    ("humidity", -0.5, 0xFFFF),
+    ("pressure", 499.99, 0xFFFF),
+    ("pressure", 1155.35, 0xFFFF),
+    ("acceleration_z", 40000, -0x8000),
+    ("battery", -1, 0xFFFF),
+    ("tx_power", 128, -0x80),
+    ("movement_counter", 256, 0xFF),
+    ("measurement_sequence_number", 70000, 0xFFFF),
+    ("humidity", float("nan"), 0xFFFF),
+])
+def test_binary_out_of_range_values_are_missing(field, value, missing):
+    index = list(_reading()).index(field)
+    _, [record, other] = _decode(encoding.RuuviBinaryEncoder().encode(
+        [_reading(**{field: value}), _reading()]))
+    assert record[index] == missing
+    # the other fields and readings are still encoded.
+    assert record[0] == 5
+    assert other[index] != missing
+
+
+def test_binary_capture_time_out_of_range_is_missing():
+    _, records = _decode(encoding.RuuviBinaryEncoder().encode(
+        [_reading(), _reading(timestamp=1600000000000 + (1 << 32))]))
+    assert records[1][-1] == 0xFFFFFFFF
+
+
+def test_json_round_trip():
+    readings = [_reading(), {"temperature": None}]
+    encoder = encoding.create_encoder("json")
+    assert json.loads(encoder.encode(readings)) == readings
+
+
+def test_deflate_round_trip():
+    readings = [_reading() for _ in range(10)]
+    encoder = encoding.create_encoder("binary", "deflate")
+    assert encoder.name == "binary+deflate"
+    assert encoder.properties["compression"] == "deflate"
+    payload = zlib.decompress(encoder.encode(readings))
+    assert payload == encoding.RuuviBinaryEncoder().encode(readings)
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        encoding.create_encoder("xml")
+    with pytest.raises(ValueError):
+        encoding.create_encoder("json", "lz4")
+
+
+def test_events_topic():
+    encoder = encoding.create_encoder("json")
+    topic = encoding.events_topic("sensor-1", encoder, {"alert": "true"})
+    assert topic.startswith("$iothub/sensor-1/messages/events/")
+    assert "$.ct=application%2Fjson" in topic
+    assert topic.endswith("alert=true")
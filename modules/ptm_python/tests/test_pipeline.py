@@ -0,0 +1,93 @@
+import asyncio
+import queue
+import threading
+
+import pytest
+
+import pipeline
+from pipeline import BLOCK, DROP_NEWEST, DROP_OLDEST, RingBuffer, Stage
+
+
+def _drain(buffer):
+    items = []
+    while True:
+        try:
+            items.append(buffer.get(timeout=0))
+        except queue.Empty:
+            return items
+
+
+def test_drop_oldest():
+    buffer = RingBuffer(3, DROP_OLDEST)
+    assert all(buffer.put(i) for i in range(3))
+    assert not buffer.put(3)
+    assert len(buffer) == 3
+    assert _drain(buffer) == [1, 2, 3]
+
+
+def test_drop_newest():
+    buffer = RingBuffer(3, DROP_NEWEST)
+    assert all(buffer.put(i) for i in range(3))
+    assert not buffer.put(3)
+    assert _drain(buffer) == [0, 1, 2]
+
+
+def test_block_waits_for_a_free_slot():
+    buffer = RingBuffer(1, BLOCK)
+    buffer.put(0)
+    producer = threading.Thread(target=buffer.put, args=(1,))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    assert buffer.get() == 0
+    producer.join(5)
+    assert buffer.get(timeout=1) == 1
+
+
+def test_get_timeout():
+    with pytest.raises(queue.Empty):
+        RingBuffer(1).get(timeout=0.01)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        RingBuffer(1, "drop-all")
+
+
+def test_stage_handles_the_items_of_a_key_in_order():
+    handled = []
+    stage = Stage("test", lambda item: handled.append(item), capacity=1000, workers=4,
+                  key=lambda item: item[0])
+    stage.start()
+    for i in range(100):
+        stage.submit((i % 3, i))
+    stage.stop()
+    assert sorted(handled) == sorted((i % 3, i) for i in range(100))
+    for key in range(3):
+        assert [i for k, i in handled if k == key] == list(range(key, 100, 3))
+
+
+def test_stage_survives_handler_errors():
+    handled = []
+
+    def handler(item):
+        if item == "bad":
+            raise RuntimeError("failed")
+        handled.append(item)
+
+    stage = Stage("test-errors", handler)
+    stage.start()
+    for item in ("a", "bad", "b"):
+        stage.submit(item)
+    stage.stop()
+    assert handled == ["a", "b"]
+
+
+@pytest.mark.parametrize("overflow, expected", [(DROP_OLDEST, [1, 2]),
+                                                (DROP_NEWEST, [0, 1])])
+def test_offer(overflow, expected):
+    items = asyncio.Queue(maxsize=2)
+    assert pipeline.offer(items, 0, overflow, "test")
+    assert pipeline.offer(items, 1, overflow, "test")
+    assert not pipeline.offer(items, 2, overflow, "test")
+    assert [items.get_nowait() for _ in range(items.qsize())] == expected
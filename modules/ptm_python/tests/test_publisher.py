@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from publisher import AsyncBatchingPublisher, BatchingPublisher, failed_batches
+
+
+class _Info:
+    def __init__(self, mid):
+        self.mid = mid
+
+    def is_published(self):
+        return True
+
+
+class _Client:
+    """Records the published messages, raising for the topics of failing devices.
+    """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.published = []
+        self._published = threading.Event()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        device_id = topic.split("/")[1]
+        if device_id in self.failing:
+            raise ValueError(f"cannot publish for {device_id}")
+        self.published.append(device_id)
+        self._published.set()
+        return _Info(len(self.published))
+
+
+class _FailingEncoder:
+    """Encodes as JSON, except the batches with a "bad" reading.
+    """
+
+    name = "json"
+    properties = {}
+
+    def encode(self, readings):
+        if any(reading.get("bad") for reading in readings):
+            raise ValueError("cannot encode")
+        return b"[]"
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def test_publish_failure_does_not_stop_the_flush_thread():
+    client = _Client(failing={"broken"})
+    publisher = BatchingPublisher(client, max_batch_size=1, max_delay=0.01)
+    failures = failed_batches.value(message_class="telemetry")
+    publisher.start()
+    try:
+        publisher.submit("broken", {"temperature": 1})
+        _wait_for(lambda: failed_batches.value(message_class="telemetry") > failures)
+        publisher.submit("ok", {"temperature": 2})
+        publisher.submit("ok", {"temperature": 3})
+        _wait_for(lambda: len(client.published) == 2)
+    finally:
+        publisher.stop()
+    assert client.published == ["ok", "ok"]
+
+
+def test_encode_failure_drops_the_batch_only():
+    client = _Client()
+    publisher = BatchingPublisher(client, max_batch_size=1, max_delay=0.01,
+                                  encoder=_FailingEncoder())
+    publisher.start()
+    try:
+        publisher.submit("a", {"bad": True})
+        publisher.submit("b", {"temperature": 1})
+        _wait_for(lambda: client.published == ["b"])
+    finally:
+        publisher.stop()
+
+
+def test_stop_flushes_after_a_failure():
+    client = _Client(failing={"broken"})
+    publisher = BatchingPublisher(client, max_batch_size=10, max_delay=60)
+    publisher.start()
+    publisher.submit("broken", {"temperature": 1})
+    publisher.submit("ok", {"temperature": 2})
+    publisher.stop(flush=True)
+    assert client.published == ["ok"]
+
+
+class _AsyncClient(_Client):
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        info = _Client.publish(self, topic, payload, qos, retain)
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(info.mid)
+        return future
+
+
+@pytest.mark.parametrize("client, encoder, expected", [
+    (_AsyncClient(failing={"a"}), None, ["b"]),
+    (_AsyncClient(), _FailingEncoder(), ["b"]),
+])
+def test_async_failure_drops_the_batch_only(client, encoder, expected):
+    async def run():
+        publisher = AsyncBatchingPublisher(client, max_batch_size=1, encoder=encoder)
+        publisher.submit("a", {"bad": True})
+        publisher.submit("b", {"temperature": 1})
+        await publisher.flush_due(force=True)
+
+    asyncio.run(run())
+    assert client.published == expected
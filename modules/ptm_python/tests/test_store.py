@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+import store
+
+
+def _queue(directory, segment_size=256, max_bytes=1024, eviction=store.DROP_OLDEST):
+    return store.SegmentQueue(str(directory), segment_size, max_bytes, eviction)
+
+
+def _payloads(records):
+    return [payload for _, _, payload, _, _ in records]
+
+
+def test_append_and_read(tmp_path):
+    queue = _queue(tmp_path)
+    assert not queue
+    assert queue.append("$iothub/a/messages/events/", b"one")
+    assert queue.append("$iothub/b/messages/events/", "two", qos=0)
+    assert queue.append("$iothub/c/messages/events/", None, capture_times=[1, 2])
+    assert queue
+
+    records = queue.read(10)
+    assert [(topic, payload, qos, times) for _, topic, payload, qos, times in records] == [
+        ("$iothub/a/messages/events/", b"one", 1, []),
+        ("$iothub/b/messages/events/", b"two", 0, []),
+        ("$iothub/c/messages/events/", b"", 1, [1, 2]),
+    ]
+    assert not queue
+    assert queue.read(10) == []
+
+
+def test_recovery_resumes_after_the_committed_records(tmp_path):
+    queue = _queue(tmp_path)
+    for i in range(5):
+        queue.append("t", b"%d" % i)
+    records = queue.read(2)
+    queue.commit(records[-1][0])
+    queue.close()
+
+    queue = _queue(tmp_path)
+    assert _payloads(queue.read(10)) == [b"2", b"3", b"4"]
+    # appends continue after the recovered records.
+    queue.append("t", b"5")
+    assert _payloads(queue.read(10)) == [b"5"]
+    queue.close()
+
+
+def test_recovery_discards_a_partially_written_record(tmp_path):
+    queue = _queue(tmp_path)
+    queue.append("t", b"complete")
+    queue.append("t", b"torn")
+    segment, end = queue.write_position
+    queue.close()
+    # corrupt the body of the last record, as if the module died while writing it.
+    path = os.path.join(str(tmp_path), f"{segment:016d}.seg")
+    with open(path, "r+b") as f:
+        f.seek(end - 1)
+        f.write(b"\xff")
+
+    queue = _queue(tmp_path)
+    assert _payloads(queue.read(10)) == [b"complete"]
+    queue.append("t", b"next")
+    assert _payloads(queue.read(10)) == [b"next"]
+    queue.close()
+
+
+def test_rollover_and_commit_delete_segments(tmp_path):
+    queue = _queue(tmp_path, segment_size=128, max_bytes=4096)
+    for i in range(20):
+        assert queue.append("t", b"x" * 40 + b"%02d" % i)
+    segments = sorted(name for name in os.listdir(str(tmp_path)) if name.endswith(".seg"))
+    assert len(segments) > 1
+
+    records = queue.read(100)
+    assert _payloads(records) == [b"x" * 40 + b"%02d" % i for i in range(20)]
+    queue.commit(records[-1][0])
+    assert len([name for name in os.listdir(str(tmp_path)) if name.endswith(".seg")]) == 1
+    queue.close()
+
+
+def test_record_larger_than_a_segment(tmp_path):
+    queue = _queue(tmp_path, segment_size=128, max_bytes=4096)
+    assert queue.append("t", b"y" * 1000)
+    assert _payloads(queue.read(1)) == [b"y" * 1000]
+    queue.close()
+
+    queue = _queue(tmp_path, segment_size=128, max_bytes=4096)
+    assert queue.append("t", b"z")
+    queue.close()
+
+
+def test_full_queue_evicts_the_oldest_segment(tmp_path):
+    queue = _queue(tmp_path, segment_size=128, max_bytes=256)
+    for i in range(10):
+        assert queue.append("t", b"x" * 40 + b"%02d" % i)
+    payloads = _payloads(queue.read(100))
+    # the oldest records were evicted, the newest are kept in order.
+    assert payloads and len(payloads) < 10
+    assert payloads == [b"x" * 40 + b"%02d" % i for i in range(10 - len(payloads), 10)]
+    queue.close()
+
+
+def test_full_queue_drops_the_newest_record(tmp_path):
+    queue = _queue(tmp_path, segment_size=128, max_bytes=256, eviction=store.DROP_NEWEST)
+    accepted = [queue.append("t", b"x" * 40 + b"%02d" % i) for i in range(10)]
+    assert accepted[0] and not accepted[-1]
+    assert _payloads(queue.read(100)) == [
+        b"x" * 40 + b"%02d" % i for i, ok in enumerate(accepted) if ok]
+    queue.close()
+
+
+def test_invalid_settings(tmp_path):
+    with pytest.raises(ValueError):
+        _queue(tmp_path, eviction="drop-all")
+    with pytest.raises(ValueError):
+        _queue(tmp_path, segment_size=256, max_bytes=300)
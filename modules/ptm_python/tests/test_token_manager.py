@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+import connection_pool
+import module_client
+from token_manager import TokenManager
+
+
+class _Signer:
+    def __init__(self, fail=False):
+        self.messages = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def sign(self, message):
+        if self.fail:
+            raise RuntimeError("hsm unavailable")
+        with self._lock:
+            self.messages.append(message)
+        return "c2lnbmF0dXJl"
+
+
+@pytest.fixture
+def manager():
+    manager = TokenManager(_Signer(), ttl=3600, renewal_ratio=0.8)
+    yield manager
+    manager.stop()
+
+
+def test_tokens_of_an_identity_are_signed_once(manager):
+    first = manager.token("hub/devices/d/modules/m")
+    second = manager.token("hub/devices/d/modules/m")
+    assert len(manager.signing_mechanism.messages) == 1
+    assert str(first) == str(second)
+    assert first.expiry_time == second.expiry_time
+
+
+def test_expiry_times_are_bucketed_and_spread(manager):
+    tokens = manager.tokens([f"hub/devices/d{i}/modules/m" for i in range(50)])
+    assert len(manager.signing_mechanism.messages) == 50
+    expiry_times = {token.expiry_time for token in tokens}
+    assert all(expiry_time % manager.bucket == 0 for expiry_time in expiry_times)
+    assert len(expiry_times) > 1
+    # the lifetimes are shortened by at most the spread, 10% of the ttl.
+    assert max(expiry_times) - min(expiry_times) <= 3600 * 0.1 + manager.bucket
+
+
+def test_signing_failure():
+    manager = TokenManager(_Signer(fail=True))
+    try:
+        with pytest.raises(ValueError):
+            manager.token("hub/devices/d/modules/m")
+    finally:
+        manager.stop()
+
+
+def test_invalid_ratios():
+    with pytest.raises(ValueError):
+        TokenManager(_Signer(), renewal_ratio=1)
+    with pytest.raises(ValueError):
+        TokenManager(_Signer(), renewal_ratio=0.95, spread=0.1)
+
+
+@pytest.mark.parametrize("size", [1, 3])
+def test_pool_connections_share_a_token_manager(monkeypatch, size):
+    tokens = object()
+    created = []
+    monkeypatch.setattr(module_client, "create_token_manager", lambda *args: tokens)
+    monkeypatch.setattr(module_client, "create_from_environment",
+                        lambda ttl, ratio, shard=None, tokens=None:
+                        created.append((shard, tokens)) or object())
+    pool = connection_pool.create_from_environment(size)
+    assert len(pool) == size
+    assert all(manager is tokens for _, manager in created)
+    # a single connection keeps the module client id.
+    assert sorted(shard for shard, _ in created) == ([None] if size == 1 else [0, 1, 2])